@@ -0,0 +1,117 @@
+"""
+Recall / latency / memory benchmark of the ANN backends in ann_index.
+
+Runs every backend over the same vectors and queries and reports recall@N against the exact backend,
+queries per second, p99 latency and index memory. Annoy is run for every combination of --trees and
+--search-k, so its settings can be tuned on real embeddings before each retrain.
+
+Usage:
+    python benchmarks/bench_ann_backends.py --items 200000 --vector-size 50
+    python benchmarks/bench_ann_backends.py --vectors /path/to/model/preference_vectors.npy --trees 10 50 100
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'container', 'serving_code'))
+import ann_index  # noqa: E402
+
+
+def load_vectors(args):
+    if args.vectors:
+        vectors = np.load(args.vectors, mmap_mode='r')
+        if args.items:
+            vectors = vectors[:args.items]
+        return np.ascontiguousarray(vectors, dtype=np.float32)
+    rng = np.random.RandomState(0)
+    # Clustered vectors are closer to trained embeddings than isotropic noise
+    centers = rng.standard_normal((max(args.items // 1000, 1), args.vector_size)).astype(np.float32)
+    assignment = rng.randint(0, len(centers), args.items)
+    noise = 0.5 * rng.standard_normal((args.items, args.vector_size)).astype(np.float32)
+    return centers[assignment] + noise
+
+
+def run_queries(index, queries, n, search_k=-1):
+    results = []
+    latencies = []
+    for query in queries:
+        start = time.time()
+        rows, _ = index.query(query, n, search_k)
+        latencies.append(time.time() - start)
+        results.append(set(int(r) for r in rows))
+    latencies = np.array(latencies)
+    return results, len(queries) / latencies.sum(), np.percentile(latencies, 99) * 1000.0
+
+
+def recall(results, truth):
+    return np.mean([len(r & t) / float(len(t)) for r, t in zip(results, truth)])
+
+
+def save_and_load(index, workdir, name):
+    path = os.path.join(workdir, name + index.suffix)
+    index.save(path)
+    return ann_index.create_index(index.kind, index.vector_size, index.metric).load(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--vectors', default=None, help='.npy matrix of exported embeddings')
+    parser.add_argument('--items', type=int, default=100000)
+    parser.add_argument('--vector-size', type=int, default=50)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--n', type=int, default=100, help='N of recall@N')
+    parser.add_argument('--metric', default=ann_index.DEFAULT_METRIC)
+    parser.add_argument('--trees', type=int, nargs='+', default=[10, 50])
+    parser.add_argument('--search-k', type=int, nargs='+', default=[-1])
+    args = parser.parse_args()
+
+    vectors = load_vectors(args)
+    rng = np.random.RandomState(1)
+    queries = vectors[rng.randint(0, len(vectors), args.queries)] + \
+        0.1 * rng.standard_normal((args.queries, vectors.shape[1])).astype(np.float32)
+    dim = vectors.shape[1]
+    print('{} items, {} dimensions, {} queries, metric {}\n'.format(len(vectors), dim, args.queries, args.metric))
+
+    workdir = tempfile.mkdtemp(prefix='bench_ann_')
+    try:
+        exact = save_and_load(ann_index.create_index('exact', dim, args.metric).build(vectors), workdir, 'exact')
+        truth, qps, p99 = run_queries(exact, queries, args.n)
+
+        print('{:<32} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+            'backend', 'recall@{}'.format(args.n), 'qps', 'p99 ms', 'index MB', 'build s'))
+        row = '{:<32} {:>10.4f} {:>10.1f} {:>10.3f} {:>10.1f} {:>10.1f}'
+        print(row.format('exact', 1.0, qps, p99, exact.memory_bytes() / 2.0 ** 20, 0.0))
+
+        for n_trees in args.trees:
+            start = time.time()
+            index = ann_index.create_index('annoy', dim, args.metric).build(vectors, n_trees=n_trees)
+            build_seconds = time.time() - start
+            index = save_and_load(index, workdir, 'annoy_{}'.format(n_trees))
+            for search_k in args.search_k:
+                results, qps, p99 = run_queries(index, queries, args.n, search_k)
+                label = 'annoy trees={} search_k={}'.format(n_trees, search_k)
+                print(row.format(label, recall(results, truth), qps, p99, index.memory_bytes() / 2.0 ** 20,
+                                 build_seconds))
+
+        if args.metric in ('angular', 'dot'):
+            start = time.time()
+            index = ann_index.create_index('int8', dim, args.metric).build(vectors)
+            build_seconds = time.time() - start
+            index = save_and_load(index, workdir, 'int8')
+            results, qps, p99 = run_queries(index, queries, args.n)
+            print(row.format('int8', recall(results, truth), qps, p99, index.memory_bytes() / 2.0 ** 20,
+                             build_seconds))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Users/sec of the sharded batch inference as processes per instance and instances scale.
+
+Builds a synthetic model in a fake /opt/ml/processing layout (model_data/model.tar.gz), then runs
+container/training_code/batch_inference.py for every combination of --processes and --instances.
+The instances of a job run in parallel on separate machines, so they are run here one after the other
+and the job's throughput is reported as the sum of the instances' users/sec, next to the slowest
+instance's wall-clock.
+
+Usage:
+    python benchmarks/bench_batch_inference.py --users 100000 --processes 1 2 4 8 --instances 1 2 4
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import glob
+import shutil
+import tarfile
+import argparse
+import tempfile
+
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'container', 'serving_code'))
+sys.path.insert(0, os.path.join(here, '..', 'container', 'training_code'))
+import ann_index  # noqa: E402
+import model_store  # noqa: E402
+import batch_inference  # noqa: E402
+
+
+def build_fake_layout(root, users, vector_size, backend, n_trees):
+    rng = np.random.RandomState(0)
+    centers = rng.standard_normal((max(users // 1000, 1), vector_size)).astype(np.float32)
+    vectors = centers[rng.randint(0, len(centers), users)] + \
+        0.5 * rng.standard_normal((users, vector_size)).astype(np.float32)
+    user_ids = np.array(['user{:08d}'.format(i) for i in range(users)])
+
+    model_dir = os.path.join(root, 'build')
+    index = ann_index.create_index(backend, vector_size).build(vectors, n_trees=n_trees)
+    model_store.save_model(model_dir, vectors, user_ids, indexes={model_store.DEFAULT_INDEX_NAME: index})
+
+    model_data = os.path.join(root, batch_inference.MODEL_DATA_DIR)
+    os.makedirs(model_data)
+    with tarfile.open(os.path.join(model_data, 'model.tar.gz'), 'w:gz') as tar:
+        for path in glob.glob(os.path.join(model_dir, '*')):
+            tar.add(path, arcname=os.path.basename(path))
+    shutil.rmtree(model_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--vector-size', type=int, default=50)
+    parser.add_argument('--top-n', type=int, default=100)
+    parser.add_argument('--backend', default=model_store.DEFAULT_BACKEND)
+    parser.add_argument('--trees', type=int, default=10)
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--instances', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--block-size', type=int, default=batch_inference.DEFAULT_BLOCK_SIZE)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='processing-')
+    try:
+        build_fake_layout(root, args.users, args.vector_size, args.backend, args.trees)
+        rows = []
+        for instances in args.instances:
+            for processes in args.processes:
+                summaries = []
+                for instance_index in range(instances):
+                    shutil.rmtree(os.path.join(root, batch_inference.OUTPUT_DIR), ignore_errors=True)
+                    summaries.append(batch_inference.run(
+                        root=root, processes=processes, instance_index=instance_index, instance_count=instances,
+                        top_n=args.top_n, block_size=args.block_size, backend=args.backend))
+                rows.append((instances, processes, sum(s['users'] for s in summaries),
+                             sum(s['users_per_second'] for s in summaries),
+                             max(s['score_seconds'] for s in summaries)))
+
+        print()
+        print('{:>10} {:>10} {:>10} {:>12} {:>14}'.format('instances', 'processes', 'users', 'users/sec',
+                                                           'wall-clock s'))
+        for row in rows:
+            print('{:>10} {:>10} {:>10} {:>12.0f} {:>14.2f}'.format(*row))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+Loading batch recommendations into DynamoDB with glue_batch_load_recs against a local DynamoDB.
+
+Writes a recommendations parquet like batch_inference.py's, then loads it into a LocalDynamoDB with a
+round-trip latency and, optionally, a provisioned write capacity:
+
+  full       every user written, with 1 worker (like writing one batch at a time) and with --workers
+  diff       a second load of the next model's output, in which --changed-fraction of the lists differ:
+             only those users are written, the rest are skipped against the first load's manifest
+  throttled  a full load into a table provisioned with --write-capacity WCU, starting at a write rate
+             well above it: the rate limiter backs off and unprocessed items are retried
+
+and checks that every user's newest item holds the user's current list.
+
+Usage:
+    python benchmarks/bench_bulk_load.py --users 20000 --workers 16 --ddb-latency-ms 10
+"""
+
+from __future__ import print_function
+
+import io
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.join(here, '..', 'container', 'training_code'))
+sys.path.insert(0, os.path.join(here, '..', 'external_lambda_functions'))
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+
+import glue_batch_load_recs  # noqa: E402
+from local_dynamodb import LocalDynamoDB, LocalTable  # noqa: E402
+
+
+def recommendations(users, list_length, seed, previous=None, changed_fraction=0.0):
+    rng = np.random.RandomState(seed)
+    if previous is not None:
+        lists = previous['recommendation_id'].values.copy()
+        changed = rng.rand(users) < changed_fraction
+        lists[changed] = [','.join(map(str, rng.randint(0, 10 ** 6, list_length))) for _ in range(changed.sum())]
+    else:
+        lists = [','.join(map(str, rng.randint(0, 10 ** 6, list_length))) for _ in range(users)]
+    return pd.DataFrame({'user_id': ['user-{}'.format(i) for i in range(users)], 'recommendation_id': lists})
+
+
+def run(frame, workdir, name, manifest_dir, model_id, workers, latency_seconds, write_capacity=None,
+        initial_rate=glue_batch_load_recs.DEFAULT_INITIAL_RATE, dynamodb=None):
+    source = os.path.join(workdir, name + '.parquet')
+    frame.to_parquet(source, row_group_size=5000, index=False)
+    dynamodb = dynamodb or LocalDynamoDB([LocalTable('recommendations', 'user_id', 'model_id')],
+                                         write_capacity=write_capacity, latency_seconds=latency_seconds)
+    with contextlib.redirect_stdout(io.StringIO()):
+        summary = glue_batch_load_recs.load(source, 'recommendations', manifest_dir, model_id=model_id,
+                                            workers=workers, initial_rate=initial_rate,
+                                            dynamodb_factory=lambda: dynamodb)
+    return summary, dynamodb
+
+
+def check(dynamodb, frame):
+    partitions = dynamodb.Table('recommendations').partitions
+    for user_id, ids in zip(frame['user_id'].values, frame['recommendation_id'].values):
+        items = partitions[user_id]
+        assert items[max(items)]['recommendation_id'] == ids, user_id
+
+
+def report(label, s):
+    print('{:<28} {:>7} {:>8} {:>8} {:>9} {:>8} {:>10} {:>9} {:>7} {:>9}'.format(
+        label, s['users'], s['changed'], s['skipped'], s['items_written'], s['seconds'], s['items_per_second'],
+        s['throttled_requests'], s['failed_items'], s['final_rate']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--list-length', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--ddb-latency-ms', type=float, default=10.0)
+    parser.add_argument('--changed-fraction', type=float, default=0.05)
+    parser.add_argument('--write-capacity', type=float, default=2000.0)
+    args = parser.parse_args()
+    latency = args.ddb_latency_ms / 1000.0
+    # Fast enough that only the round trips and the workers limit the unthrottled loads
+    unlimited = glue_batch_load_recs.DEFAULT_MAX_RATE
+
+    workdir = tempfile.mkdtemp()
+    try:
+        first = recommendations(args.users, args.list_length, seed=0)
+        second = recommendations(args.users, args.list_length, seed=1, previous=first,
+                                 changed_fraction=args.changed_fraction)
+        model_id = int(time.time())
+
+        print('{:<28} {:>7} {:>8} {:>8} {:>9} {:>8} {:>10} {:>9} {:>7} {:>9}'.format(
+            'load', 'users', 'changed', 'skipped', 'written', 'seconds', 'items/s', 'throttled', 'failed',
+            'rate'))
+        summary, _ = run(first, workdir, 'first', None, model_id, 1, latency, initial_rate=unlimited)
+        report('full, 1 worker', summary)
+
+        manifest_dir = os.path.join(workdir, 'manifest')
+        summary, dynamodb = run(first, workdir, 'first', manifest_dir, model_id, args.workers, latency,
+                                initial_rate=unlimited)
+        report('full, {} workers'.format(args.workers), summary)
+        check(dynamodb, first)
+
+        summary, dynamodb = run(second, workdir, 'second', manifest_dir, model_id + 86400, args.workers, latency,
+                                initial_rate=unlimited, dynamodb=dynamodb)
+        report('diff, {} workers'.format(args.workers), summary)
+        check(dynamodb, second)
+        assert summary['skipped'] + summary['changed'] == args.users
+
+        summary, dynamodb = run(first, workdir, 'first', None, model_id, args.workers, latency,
+                                write_capacity=args.write_capacity, initial_rate=5 * args.write_capacity)
+        report('throttled, {:.0f} WCU'.format(args.write_capacity), summary)
+        check(dynamodb, first)
+        print()
+        print('throttled load: {} requests, {} retried items, {} throttles'.format(
+            summary['requests'], summary['retried_items'], summary['throttles']))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+Unregistered-user POSTs answered from the precomputed cohort table vs the endpoint.
+
+Builds a synthetic model whose profiles follow a skewed population (a few large locations, birth years
+around 1990, a long tail of followed categories), writes its cohort table with
+cohort_recommendations.build (new_user_recommender is provided by local_recommender), then replays
+new users drawn from the same population through query_recommender.lambda_handler with stand-in
+DynamoDB, SSM and SageMaker runtime clients, once with COHORT_TABLE off and once on. Reports the table
+build time and size, the share of new users answered from the table, the endpoint invocations left
+and the request latency percentiles.
+
+Usage:
+    python benchmarks/bench_cohort_table.py --users 200000 --requests 2000 --endpoint-latency-ms 30
+"""
+
+from __future__ import print_function
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import contextlib
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'ap-northeast-1')
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.join(here, '..', 'container', 'serving_code'))
+sys.path.insert(0, os.path.join(here, '..', 'container', 'training_code'))
+sys.path.insert(0, os.path.join(here, '..', 'external_lambda_functions'))
+
+import numpy as np  # noqa: E402
+
+import local_aws  # noqa: E402
+import local_dynamodb  # noqa: E402
+import local_recommender  # noqa: E402
+import model_store  # noqa: E402
+
+N_LOCATIONS = 47
+N_CATEGORIES = 30
+
+
+class Population(object):
+    """Skewed feature distributions shared by the registered and the new users."""
+
+    def __init__(self, seed):
+        self.rng = np.random.RandomState(seed)
+        self.location_weights = 1.0 / np.arange(1, N_LOCATIONS + 1)
+        self.location_weights /= self.location_weights.sum()
+        self.category_weights = 1.0 / np.arange(1, N_CATEGORIES + 1) ** 1.2
+        self.category_weights /= self.category_weights.sum()
+
+    def sample(self, n):
+        rng = self.rng
+        years = np.clip(np.round(rng.normal(1990, 7, n)), 1960, 2004).astype(int)
+        categories = [sorted(rng.choice(N_CATEGORIES, rng.randint(3, 9), replace=False,
+                                        p=self.category_weights).tolist()) for _ in range(n)]
+        return {
+            'gender': rng.choice(['M', 'F'], n),
+            'locationId': rng.choice(N_LOCATIONS, n, p=self.location_weights) + 1,
+            'birthdate': ['{}-{:02d}-01'.format(y, rng.randint(1, 13)) for y in years],
+            'followingCategories': categories,
+        }
+
+
+def build_population_model(model_dir, n_users, vector_size, n_trees):
+    import annoy
+    import pandas as pd
+
+    features = Population(0).sample(n_users)
+    vectors = np.random.RandomState(1).standard_normal((n_users, vector_size)).astype(np.float32)
+    user_ids = np.array(['user{:07d}'.format(i) for i in range(n_users)])
+    profiles = pd.DataFrame(dict(features, user_id=user_ids))
+
+    index = annoy.AnnoyIndex(vector_size, model_store.DEFAULT_METRIC)
+    for i in range(n_users):
+        index.add_item(i, vectors[i])
+    index.build(n_trees)
+    model_store.save_model(model_dir, vectors, user_ids, profiles, {model_store.DEFAULT_INDEX_NAME: index},
+                           version='benchmark')
+
+
+def new_user_events(n_requests, page_ids):
+    features = Population(2).sample(n_requests)
+    rng = random.Random(0)
+    return [{'body': json.dumps({
+        'new_user_id': 'new{:07d}'.format(i),
+        'gender': str(features['gender'][i]),
+        'locationId': int(features['locationId'][i]),
+        'birthdate': features['birthdate'][i],
+        'followingCategories': features['followingCategories'][i],
+        'q_type': 'PAGINATED_QUERY',
+        'q_page_id': str(rng.randint(1, page_ids)),
+    })} for i in range(n_requests)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200000, help='Registered users in the synthetic model')
+    parser.add_argument('--vector-size', type=int, default=50)
+    parser.add_argument('--trees', type=int, default=10)
+    parser.add_argument('--min-users', type=int, default=20, help='Smallest cohort in the table')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--endpoint-latency-ms', type=float, default=30.0)
+    parser.add_argument('--ddb-latency-ms', type=float, default=5.0)
+    args = parser.parse_args()
+
+    local_recommender.install()
+    import cohort_recommendations
+    import query_recommender
+    import write_behind
+
+    root = tempfile.mkdtemp(prefix='bench_cohort_table_')
+    try:
+        model_dir = os.path.join(root, 'model')
+        build_population_model(model_dir, args.users, args.vector_size, args.trees)
+        with contextlib.redirect_stdout(io.StringIO()):
+            model = model_store.load_model(model_dir)
+            start = time.time()
+            summary = cohort_recommendations.build(model, os.path.join(root, 'cohorts'), 100, args.processes,
+                                                   min_users=args.min_users)
+            build_seconds = time.time() - start
+        table_path = os.path.join(root, 'cohorts', cohort_recommendations.TABLE_FILE)
+        print('{cohorts} cohorts covering {registered_users_covered:.1%} of the registered users, '
+              '{0:.1f} MB, built in {1:.1f} s\n'.format(summary['table_bytes'] / 2.0 ** 20, build_seconds,
+                                                         **summary))
+
+        events = new_user_events(args.requests, 10)
+        print('{:<10} {:>12} {:>12} {:>10} {:>10} {:>10} {:>10}'.format(
+            'cohorts', 'from table', 'endpoint', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms'))
+        for enabled in (False, True):
+            query_recommender.recommendations = local_dynamodb.LocalTable(
+                'recommendations', 'user_id', 'model_id', latency_seconds=args.ddb_latency_ms / 1000.0)
+            runtime = local_aws.LocalSageMakerRuntime(args.endpoint_latency_ms / 1000.0)
+            query_recommender.sm_rt_client = runtime
+            query_recommender.ssm_client = local_aws.LocalSSM({'recommender.retrain_freq': '7',
+                                                               'recommender.cohort_table': table_path})
+            query_recommender.write_queue = write_behind.WriteBehindQueue()
+            query_recommender.cohort_table_enabled = enabled
+
+            latencies = []
+            with contextlib.redirect_stdout(io.StringIO()):
+                for event in events:
+                    start = time.time()
+                    response = query_recommender.lambda_handler(event, None)
+                    latencies.append(time.time() - start)
+                    assert response['statusCode'] == 200, response
+                query_recommender.write_queue.flush()
+            from_table = len(events) - runtime.invocations
+            p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+            print('{:<10} {:>11.1%} {:>12} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}'.format(
+                'on' if enabled else 'off', from_table / float(len(events)), runtime.invocations,
+                np.mean(latencies) * 1000, p50, p95, p99))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Pairs/sec of the data-parallel CPU skip-gram as the number of workers grows.
+
+Writes synthetic pair shards in the streaming_preprocessing.py output layout (pairs/part-*.parquet and
+vocab.parquet), then trains container/training_code/cpu_skipgram.py on them as a local process group of
+1, 2, 4, ... workers (distributed_utils.launch_local, as the train entrypoint does without mpirun).
+Reports rank 0's examples/sec of the last epoch, the speedup over one worker and the final loss.
+
+The speedup is bounded by the cores of the machine: workers beyond the core count only add allreduce
+traffic.
+
+Usage:
+    python benchmarks/bench_distributed_training.py --vocab 20000 --pairs 2000000 --workers 1 2 4 8
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+import pandas as pd
+
+here = os.path.dirname(os.path.abspath(__file__))
+training_code = os.path.join(here, '..', 'container', 'training_code')
+serving_code = os.path.join(here, '..', 'container', 'serving_code')
+sys.path.insert(0, training_code)
+import training_metrics  # noqa: E402
+import distributed_utils  # noqa: E402
+
+
+def build_pairs(root, vocab_size, pairs, shards, seed=0):
+    rng = np.random.RandomState(seed)
+    ids = np.array(['user{:08d}'.format(i) for i in range(vocab_size)])
+    # Zipf-like popularity, and contexts close to their center so there is structure to learn
+    counts = np.maximum(1, (1e6 / np.arange(1, vocab_size + 1) ** 0.8).astype(np.int64))
+    pd.DataFrame({'id': ids, 'count': counts}).to_parquet(os.path.join(root, 'vocab.parquet'), index=False)
+    os.makedirs(os.path.join(root, 'pairs'))
+    per_shard = pairs // shards
+    for shard in range(shards):
+        centers = rng.randint(0, vocab_size, per_shard)
+        contexts = (centers + rng.randint(1, 20, per_shard)) % vocab_size
+        pd.DataFrame({'center': ids[centers], 'context': ids[contexts], 'count': np.ones(per_shard, np.int64)}) \
+            .to_parquet(os.path.join(root, 'pairs', 'part-{:05d}.parquet'.format(shard)), index=False)
+
+
+def run_workers(root, workers, epochs, batch_value, port):
+    cmd = [sys.executable, os.path.join(training_code, 'cpu_skipgram.py'), '--model-dir', '',
+           '--pairs-dir', root, '--epoch_count', str(epochs), '--batch_value', str(batch_value)]
+    env_path = os.pathsep.join([serving_code, os.environ.get('PYTHONPATH', '')])
+    os.environ['PYTHONPATH'] = env_path
+    processes = distributed_utils.launch_local(workers, cmd, port=port, stdout=subprocess.PIPE,
+                                               universal_newlines=True)
+    outputs = [process.communicate()[0] for process in processes]
+    if any(process.returncode for process in processes):
+        raise RuntimeError('Workers failed with return codes {}'.format([p.returncode for p in processes]))
+    return [m for m in map(training_metrics.parse_line, outputs[0].splitlines()) if m]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--vocab', type=int, default=20000)
+    parser.add_argument('--pairs', type=int, default=1000000)
+    parser.add_argument('--shards', type=int, default=16)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--epochs', type=int, default=2)
+    parser.add_argument('--batch-value', type=int, default=1024)
+    parser.add_argument('--port', type=int, default=distributed_utils.DEFAULT_PORT)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='pairs-')
+    try:
+        build_pairs(root, args.vocab, args.pairs, args.shards)
+        rows = []
+        for workers in args.workers:
+            history = run_workers(root, workers, args.epochs, args.batch_value, args.port)
+            rows.append((workers, history[-1]['examples_per_sec'], history[-1]['epoch_seconds'],
+                         history[-1]['loss']))
+            print('{} worker(s): {}'.format(workers, training_metrics.summarize(history)))
+
+        base = rows[0][1]
+        print()
+        print('{:>8} {:>12} {:>10} {:>10} {:>10}'.format('workers', 'pairs/sec', 'speedup', 'epoch s', 'loss'))
+        for workers, per_sec, seconds, loss in rows:
+            print('{:>8} {:>12.0f} {:>10.2f} {:>10.2f} {:>10.4f}'.format(workers, per_sec, per_sec / base,
+                                                                         seconds, loss))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
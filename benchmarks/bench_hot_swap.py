@@ -0,0 +1,172 @@
+"""
+Model hot swap in the serving app while it is under load.
+
+Builds two synthetic model versions (bench_model_loading.build_synthetic_model), serves the first with
+the recommender flask app and keeps --clients threads sending /invocations requests. Meanwhile it:
+
+  1. writes the version marker for the second model; the app's watcher fetches the model.tar.gz into the
+     versions directory, loads it in the background and swaps it in
+  2. POSTs /admin/rollback, which swaps the first model back from memory
+  3. POSTs /admin/reload with the second model's URI
+
+and reports how long each change took to show up in the responses' model_version, the request latency
+percentiles in the windows around the swaps against steady state, and the failed requests (there
+should be none). An endpoint update instead takes a new instance fleet, usually 5 to 10 minutes.
+
+Usage:
+    python benchmarks/bench_hot_swap.py --users 100000 --clients 4
+"""
+
+from __future__ import print_function
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import tarfile
+import argparse
+import tempfile
+import threading
+import contextlib
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.join(here, '..', 'container', 'serving_code'))
+
+import numpy as np  # noqa: E402
+
+import local_recommender  # noqa: E402
+from bench_model_loading import build_synthetic_model  # noqa: E402
+
+REQUEST = {'user_id': 'new-user', 'gender': 'F', 'locationId': 3, 'birthdate': 1990, 'followingCategories': [1, 2]}
+
+
+def build_version(root, name, users, vector_size, trees):
+    model_dir = os.path.join(root, name)
+    build_synthetic_model(model_dir, users, vector_size, trees)
+    archive = os.path.join(root, name + '.tar.gz')
+    with tarfile.open(archive, 'w:gz') as tar:
+        for filename in os.listdir(model_dir):
+            tar.add(os.path.join(model_dir, filename), arcname=filename)
+    return model_dir, archive
+
+
+class Load(object):
+    """Client threads sending requests and recording (time, latency, model_version or error)."""
+
+    def __init__(self, app, clients):
+        self.app = app
+        self.records = []
+        self.stopping = threading.Event()
+        self.threads = [threading.Thread(target=self.run) for _ in range(clients)]
+
+    def run(self):
+        client = self.app.test_client()
+        body = json.dumps(REQUEST)
+        while not self.stopping.is_set():
+            start = time.time()
+            try:
+                response = client.post('/invocations', data=body, content_type='application/json')
+                version = json.loads(response.data)['model_version'] if response.status_code == 200 else None
+                error = None if response.status_code == 200 else response.status_code
+            except Exception as e:
+                version, error = None, repr(e)
+            self.records.append((start, time.time() - start, version, error))
+
+    def __enter__(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+
+    def first_seen(self, version, after):
+        times = [t + latency for t, latency, v, _ in self.records if v == version and t >= after]
+        return min(times) - after if times else None
+
+
+def percentiles(latencies):
+    if not latencies:
+        return float('nan'), float('nan')
+    values = np.array(latencies) * 1000.0
+    return np.percentile(values, 50), np.percentile(values, 99)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--vector-size', type=int, default=50)
+    parser.add_argument('--trees', type=int, default=10)
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--poll-seconds', type=float, default=0.5)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='bench_hot_swap_')
+    try:
+        first_dir, _ = build_version(root, 'v1', args.users, args.vector_size, args.trees)
+        _, second_archive = build_version(root, 'v2', args.users, args.vector_size, args.trees)
+        marker_uri = os.path.join(root, 'marker', 'model_version.json')
+
+        os.environ.update({'MODEL_HOT_SWAP': 'true', 'MODEL_VERSION_MARKER_URI': marker_uri,
+                           'MODEL_VERSIONS_DIR': os.path.join(root, 'versions'),
+                           'MODEL_RELOAD_POLL_SECONDS': str(args.poll_seconds),
+                           'MODEL_ADMIN': 'true', 'MODEL_URI_PREFIXES': root,
+                           'RESULT_CACHE': 'off'})
+        local_recommender.install()
+        import model_versions
+        import recommender
+        recommender.model_path = first_dir
+        with contextlib.redirect_stdout(io.StringIO()):
+            recommender.RecommendationService.get_model()
+        app = recommender.app
+        admin = app.test_client()
+
+        events = []
+        with contextlib.redirect_stdout(io.StringIO()), Load(app, args.clients) as load:
+            time.sleep(2.0)
+            steady_end = time.time()
+
+            start = time.time()
+            model_versions.write_marker(marker_uri, {'version': 'v2', 'model_uri': second_archive})
+            while recommender.RecommendationService.versions.active['version'] != 'v2':
+                time.sleep(0.01)
+            events.append(('marker v2', start, 'v2', time.time() - start))
+            time.sleep(1.0)
+
+            start = time.time()
+            response = admin.post('/admin/rollback')
+            assert response.status_code == 200, response.data
+            events.append(('/admin/rollback', start, 'benchmark', time.time() - start))
+            time.sleep(1.0)
+
+            start = time.time()
+            response = admin.post('/admin/reload', data=json.dumps({'model_uri': second_archive, 'version': 'v2'}))
+            assert response.status_code == 200, response.data
+            events.append(('/admin/reload v2', start, 'v2', time.time() - start))
+            time.sleep(1.0)
+
+        # Both synthetic models are saved with version 'benchmark'; the markers label the second 'v2'
+        steady = [r[1] for r in load.records if r[0] < steady_end]
+        print('{} requests, {} failed'.format(len(load.records), sum(1 for r in load.records if r[3] is not None)))
+        print('steady state          p50 {:7.2f} ms   p99 {:7.2f} ms'.format(*percentiles(steady)))
+        print()
+        print('{:<18} {:>10} {:>14} {:>12} {:>12}'.format('change', 'swap s', 'first resp s', 'p50 ms', 'p99 ms'))
+        for label, start, version, seconds in events:
+            window = [r[1] for r in load.records if start <= r[0] <= start + seconds + 0.5]
+            seen = load.first_seen(version, start)
+            print('{:<18} {:>10.3f} {:>14} {:>12.2f} {:>12.2f}'.format(
+                label, seconds, '{:.3f}'.format(seen) if seen is not None else '-', *percentiles(window)))
+        state = json.loads(admin.get('/stats').data)['model']
+        print()
+        print('active {model_version}, previous {previous_version}, {swaps} swaps'.format(**state))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Batches/sec of the skip-gram input pipeline on its own, next to the training step it feeds.
+
+Writes synthetic pair shards (see bench_distributed_training.py), then measures:
+
+  sampler     negatives/sec of the alias table against inverse-CDF sampling (searchsorted) over the
+              same unigram^0.75 distribution
+  pipeline    batches/sec of InputPipeline.batches() alone, with no training step
+  step        batches/sec of the cpu_skipgram training step alone, on batches built up front
+  training    batches/sec of the step fed by the pipeline, synchronously and with prefetching
+
+The model is input-bound when the pipeline's batches/sec is not well above the step's; with prefetching
+the training batches/sec then approaches the slower of the two instead of their harmonic combination.
+
+Usage:
+    python benchmarks/bench_input_pipeline.py --vocab 100000 --pairs 4000000 --batch-value 32768
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'container', 'serving_code'))
+sys.path.insert(0, os.path.join(here, '..', 'container', 'training_code'))
+import cpu_skipgram  # noqa: E402
+import skipgram_input_pipeline  # noqa: E402
+from bench_distributed_training import build_pairs  # noqa: E402
+
+
+def timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return result, time.time() - start
+
+
+def bench_sampler(counts, draws, negatives):
+    rng = np.random.RandomState(0)
+    noise = counts ** skipgram_input_pipeline.DEFAULT_NOISE_POWER
+    table, build_seconds = timed(skipgram_input_pipeline.AliasTable, noise)
+    _, alias_seconds = timed(table.sample, rng, (draws // negatives, negatives))
+    cdf = np.cumsum(noise / noise.sum())
+    _, cdf_seconds = timed(lambda: np.searchsorted(cdf, rng.random_sample((draws // negatives, negatives))))
+    return build_seconds, draws / alias_seconds, draws / cdf_seconds
+
+
+def train_loop(batches, w_in, w_out, learning_rate=0.025):
+    count = 0
+    for centers, contexts, negatives in batches:
+        _, (in_rows, in_grads), (out_rows, out_grads) = cpu_skipgram.sgns_gradients(
+            w_in, w_out, centers, contexts, negatives)
+        w_in[in_rows] -= learning_rate * in_grads
+        w_out[out_rows] -= learning_rate * out_grads
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--vocab', type=int, default=100000)
+    parser.add_argument('--pairs', type=int, default=2000000)
+    parser.add_argument('--shards', type=int, default=16)
+    parser.add_argument('--batch-value', type=int, default=32768)
+    parser.add_argument('--vector-size', type=int, default=50)
+    parser.add_argument('--negatives', type=int, default=skipgram_input_pipeline.DEFAULT_NEGATIVES)
+    parser.add_argument('--subsample-threshold', type=float,
+                        default=skipgram_input_pipeline.DEFAULT_SUBSAMPLE_THRESHOLD)
+    parser.add_argument('--prefetch-batches', type=int, default=skipgram_input_pipeline.DEFAULT_PREFETCH_BATCHES)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='pairs-')
+    try:
+        build_pairs(root, args.vocab, args.pairs, args.shards)
+
+        def pipeline(prefetch_batches=0):
+            return skipgram_input_pipeline.InputPipeline(
+                root, args.batch_value, negatives=args.negatives, subsample_threshold=args.subsample_threshold,
+                prefetch_batches=prefetch_batches)
+
+        sync = pipeline()
+        counts = pd.read_parquet(os.path.join(root, 'vocab.parquet'))['count'].values.astype(np.float64)
+        build_seconds, alias_rate, cdf_rate = bench_sampler(counts, 10000000, args.negatives)
+        print('sampler    alias table built in {:.2f}s; {:.1f}M negatives/sec (alias) vs {:.1f}M/sec (cdf)'.format(
+            build_seconds, alias_rate / 1e6, cdf_rate / 1e6))
+
+        batches, pipeline_seconds = timed(lambda: list(sync.batches()))
+        pairs = sum(len(b[0]) for b in batches)
+        pipeline_rate = len(batches) / pipeline_seconds
+        print('pipeline   {} batches ({} pairs after subsampling) at {:.1f} batches/sec'.format(
+            len(batches), pairs, pipeline_rate))
+
+        def fresh_model():
+            rng = np.random.RandomState(0)
+            w_in = ((rng.rand(args.vocab, args.vector_size) - 0.5) / args.vector_size).astype(np.float32)
+            return w_in, np.zeros_like(w_in)
+
+        steps, step_seconds = timed(train_loop, batches, *fresh_model())
+        step_rate = steps / step_seconds
+        print('step       {:.1f} batches/sec'.format(step_rate))
+        del batches
+
+        for label, prefetch_batches in [('sync', 0), ('prefetch', args.prefetch_batches)]:
+            steps, seconds = timed(lambda: train_loop(pipeline(prefetch_batches).epoch(), *fresh_model()))
+            print('training   {:<9} {:.1f} batches/sec'.format(label, steps / seconds))
+
+        print()
+        print('input-bound' if pipeline_rate < 2 * step_rate else 'not input-bound',
+              '(pipeline {:.1f} vs step {:.1f} batches/sec)'.format(pipeline_rate, step_rate))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
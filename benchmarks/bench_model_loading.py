@@ -0,0 +1,145 @@
+"""
+Cold-start and memory benchmark for RecommendationService model loading.
+
+Builds a synthetic model directory in the layout written by model_store.save_model, then reports:
+  - cold-start load time with and without memory mapping
+  - per-worker RSS and total PSS when 1, 2, 4, ... forked workers query a model loaded in the parent,
+    which is what gunicorn --preload does
+
+Usage:
+    python benchmarks/bench_model_loading.py --users 500000 --vector-size 50 --workers 1 2 4 8
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'container', 'serving_code'))
+import model_store  # noqa: E402
+
+
+def build_synthetic_model(model_dir, n_users, vector_size, n_trees):
+    import annoy
+    import pandas as pd
+
+    rng = np.random.RandomState(0)
+    vectors = rng.standard_normal((n_users, vector_size)).astype(np.float32)
+    user_ids = np.array(['u{}'.format(i) for i in range(n_users)])
+    profiles = pd.DataFrame({
+        'user_id': user_ids,
+        'gender': rng.choice(['M', 'F'], n_users),
+        'locationId': rng.randint(0, 50, n_users),
+        'birthdate': rng.randint(1960, 2005, n_users),
+    })
+
+    index = annoy.AnnoyIndex(vector_size, model_store.DEFAULT_METRIC)
+    for i in range(n_users):
+        index.add_item(i, vectors[i])
+    index.build(n_trees)
+
+    model_store.save_model(model_dir, vectors, user_ids, profiles,
+                           {model_store.DEFAULT_INDEX_NAME: index}, version='benchmark')
+
+
+def memory_kb(pid):
+    """(rss, pss) in kB for a process, read from /proc."""
+    rss = pss = 0
+    rollup = '/proc/{}/smaps_rollup'.format(pid)
+    if os.path.exists(rollup):
+        with open(rollup) as f:
+            for line in f:
+                if line.startswith('Rss:'):
+                    rss = int(line.split()[1])
+                elif line.startswith('Pss:'):
+                    pss = int(line.split()[1])
+    return rss, pss
+
+
+def worker(model, model_dir, n_queries, ready_w, release_r):
+    """Touch the whole model the way a serving worker would, then wait to be measured."""
+    if model is None:
+        # No preloading: every worker reads its own copy, as the lazy get_model used to
+        model = model_store.load_model(model_dir, mmap=False)
+    vectors = model['preference_vectors']
+    float(np.asarray(vectors, dtype=np.float64).sum())
+    for i in range(n_queries):
+        model['index'].get_nns_by_vector(vectors[i % len(vectors)], 100)
+    if model['profiles'] is not None:
+        model['profiles'].column(0)
+    os.write(ready_w, b'x')
+    os.read(release_r, 1)
+    os._exit(0)
+
+
+def fork_workers(model, model_dir, n_workers, n_queries):
+    ready_r, ready_w = os.pipe()
+    release_r, release_w = os.pipe()
+    pids = []
+    for _ in range(n_workers):
+        pid = os.fork()
+        if pid == 0:
+            worker(model, model_dir, n_queries, ready_w, release_r)
+        pids.append(pid)
+    for _ in pids:
+        os.read(ready_r, 1)
+
+    usage = [memory_kb(pid) for pid in pids]
+    os.write(release_w, b'x' * n_workers)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    for fd in (ready_r, ready_w, release_r, release_w):
+        os.close(fd)
+    return usage
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200000)
+    parser.add_argument('--vector-size', type=int, default=50)
+    parser.add_argument('--trees', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--model-dir', default=None, help='Reuse an existing model directory')
+    args = parser.parse_args()
+
+    model_dir = args.model_dir or tempfile.mkdtemp(prefix='bench_model_')
+    try:
+        if args.model_dir is None:
+            start = time.time()
+            build_synthetic_model(model_dir, args.users, args.vector_size, args.trees)
+            print('Built synthetic model ({} users) in {:.1f}s'.format(args.users, time.time() - start))
+
+        print('\nCold-start load time')
+        for mmap in (False, True):
+            start = time.time()
+            model = model_store.load_model(model_dir, mmap=mmap)
+            # The first query is part of the cold start a request would see
+            model['index'].get_nns_by_vector(model['preference_vectors'][0], 100)
+            print('  mmap={:<5} {:8.3f}s'.format(str(mmap), time.time() - start))
+
+        print('\nForked workers')
+        print('  {:>7} {:>14} {:>14} {:>14}'.format('workers', 'rss/worker MB', 'pss/worker MB', 'total pss MB'))
+        modes = [('load per worker', None),
+                 ('preload, heap', model_store.load_model(model_dir, mmap=False)),
+                 ('preload, mmap', model_store.load_model(model_dir, mmap=True))]
+        for label, model in modes:
+            print('  {}'.format(label))
+            for n_workers in args.workers:
+                usage = fork_workers(model, model_dir, n_workers, args.queries)
+                rss = sum(u[0] for u in usage) / 1024.0 / n_workers
+                pss = sum(u[1] for u in usage) / 1024.0
+                print('  {:>7} {:>14.1f} {:>14.1f} {:>14.1f}'.format(n_workers, rss, pss / n_workers, pss))
+    finally:
+        if args.model_dir is None:
+            shutil.rmtree(model_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
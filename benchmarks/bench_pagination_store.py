@@ -0,0 +1,108 @@
+"""
+Bytes read and latency per GET query: comma-joined recommendation strings vs the packed, chunked layout.
+
+Loads the same synthetic recommendation lists into local stand-in tables in both layouts and replays
+paginated and range queries through query_recommender.lambda_handler.
+
+Usage:
+    python benchmarks/bench_pagination_store.py --users 1000 --recs 1000 --queries 2000
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+import argparse
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'ap-northeast-1')
+# The handler's per-invocation timing lines would drown the results
+os.environ.setdefault('REQUEST_TIMING_LOG', 'off')
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.join(here, '..', 'external_lambda_functions'))
+
+import numpy as np  # noqa: E402
+
+import local_dynamodb  # noqa: E402
+import packed_recommendations  # noqa: E402
+import query_recommender  # noqa: E402
+import warm_cache  # noqa: E402
+
+
+def populate(layout, n_users, n_recs, model_id, expiry_time):
+    table = local_dynamodb.LocalTable('recommendations', 'user_id', 'model_id')
+    chunks = local_dynamodb.LocalTable('recommendation_chunks', 'user_id', 'chunk_key')
+    rng = random.Random(0)
+    for u in range(n_users):
+        user_id = 'user{:07d}'.format(u)
+        ids = ['user{:07d}'.format(rng.randrange(n_users * 10)) for _ in range(n_recs)]
+        if layout == 'string':
+            table.put_item(Item={'user_id': user_id, 'model_id': model_id,
+                                 'recommendation_id': ','.join(ids), 'expiry_time': expiry_time})
+        else:
+            packed_recommendations.write_packed(table, chunks, user_id, model_id, ids, expiry_time)
+    return table, chunks
+
+
+def make_queries(n_queries, n_users, n_recs):
+    rng = random.Random(1)
+    queries = []
+    for _ in range(n_queries):
+        params = {'q_user_id': 'user{:07d}'.format(rng.randrange(n_users))}
+        if rng.random() < 0.8:
+            params['q_type'] = 'PAGINATED_QUERY'
+            params['q_page_id'] = str(rng.randint(1, n_recs // 10))
+        else:
+            first = rng.randint(1, n_recs // 100)
+            params['q_type'] = 'RANGE_QUERY'
+            params['q_page_id'] = '{}_{}'.format(first, first)
+        queries.append({'queryStringParameters': params})
+    return queries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--recs', type=int, default=1000, help='Recommendations per user')
+    parser.add_argument('--queries', type=int, default=2000)
+    args = parser.parse_args()
+
+    expiry_time = int(time.time()) + 14 * 24 * 3600
+    queries = make_queries(args.queries, args.users, args.recs)
+    results = {}
+
+    print('{:<8} {:>12} {:>14} {:>12} {:>10} {:>10}'.format(
+        'layout', 'round trips', 'bytes/query', 'stored MB', 'p50 ms', 'p99 ms'))
+    for layout in ('string', 'packed'):
+        table, chunks = populate(layout, args.users, args.recs, 1, expiry_time)
+        query_recommender.recommendations = table
+        query_recommender.recommendation_chunks = chunks
+        # Measure the storage layout, not the warm-container cache in front of it
+        query_recommender.user_cache = warm_cache.TTLCache(0, 0)
+        stored = (table.bytes_written + chunks.bytes_written) / 2.0 ** 20
+        table.reset_stats()
+        chunks.reset_stats()
+
+        latencies = []
+        bodies = []
+        for event in queries:
+            start = time.time()
+            response = query_recommender.lambda_handler(event, None)
+            latencies.append(time.time() - start)
+            bodies.append(response['body'])
+        results[layout] = bodies
+
+        round_trips = table.round_trips + chunks.round_trips
+        bytes_read = table.bytes_read + chunks.bytes_read
+        print('{:<8} {:>12.2f} {:>14.0f} {:>12.1f} {:>10.3f} {:>10.3f}'.format(
+            layout, round_trips / float(len(queries)), bytes_read / float(len(queries)), stored,
+            np.percentile(latencies, 50) * 1000, np.percentile(latencies, 99) * 1000))
+
+    same = results['string'] == results['packed']
+    print('\nIdentical responses in both layouts: {}'.format(same))
+
+
+if __name__ == '__main__':
+    main()
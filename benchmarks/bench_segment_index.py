@@ -0,0 +1,125 @@
+"""
+Per-segment ANN shards (segment_index) vs filtering a global top-N.
+
+Writes a synthetic model with model_store.save_model and segments options, so the (gender, region)
+shards are built the way training builds them. Users have a gender, a skewed locationId and clustered
+vectors. Locations are grouped into regions, each region lists the others as neighbours. New users
+then query with a target gender (the other one) and their region, in three ways:
+
+  global          the default index's top --n, filtered to the target gender in the user's region
+  global xK       the same over --overfetch times as many candidates
+  segments        the segment view used by the serving container (own region first, then neighbours)
+
+Reports the segment build time, query latency, the share of requests that get a full list and the
+share of results in the user's own region.
+
+Usage:
+    python benchmarks/bench_segment_index.py --users 200000 --queries 2000 --regions 8
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'container', 'serving_code'))
+import ann_index  # noqa: E402
+import model_store  # noqa: E402
+
+N_LOCATIONS = 47
+TARGET_GENDERS = {'M': ['F'], 'F': ['M']}
+
+
+def build_model(model_dir, args):
+    import pandas as pd
+
+    rng = np.random.RandomState(0)
+    centers = rng.standard_normal((max(args.users // 1000, 1), args.vector_size)).astype(np.float32)
+    vectors = centers[rng.randint(0, len(centers), args.users)]
+    vectors += 0.5 * rng.standard_normal(vectors.shape).astype(np.float32)
+    location_weights = 1.0 / np.arange(1, N_LOCATIONS + 1)
+    profiles = pd.DataFrame({
+        'user_id': ['u{}'.format(i) for i in range(args.users)],
+        'gender': rng.choice(['M', 'F'], args.users),
+        'locationId': rng.choice(N_LOCATIONS, args.users, p=location_weights / location_weights.sum()) + 1,
+    })
+
+    regions = dict((str(l), 'r{}'.format(l % args.regions)) for l in range(1, N_LOCATIONS + 1))
+    region_names = sorted(set(regions.values()))
+    neighbors = dict((r, [o for o in region_names if o != r]) for r in region_names)
+    segments = {'regions': regions, 'target_genders': TARGET_GENDERS, 'neighbors': neighbors,
+                'n_trees': args.trees}
+
+    index = ann_index.create_index('annoy', args.vector_size).build(vectors, n_trees=args.trees)
+    start = time.time()
+    model_store.save_model(model_dir, vectors, profiles['user_id'].values, profiles,
+                           {model_store.DEFAULT_INDEX_NAME: index}, version='benchmark', segments=segments)
+    return time.time() - start, vectors, regions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200000)
+    parser.add_argument('--vector-size', type=int, default=50)
+    parser.add_argument('--trees', type=int, default=10)
+    parser.add_argument('--regions', type=int, default=8)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--n', type=int, default=100)
+    parser.add_argument('--overfetch', type=int, default=10)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='bench_segment_index_')
+    try:
+        model_dir = os.path.join(root, 'model')
+        save_seconds, vectors, regions = build_model(model_dir, args)
+        model = model_store.load_model(model_dir)
+        genders = model['profiles'].column('gender').to_numpy(zero_copy_only=False).astype(str)
+        row_regions = np.array([regions[str(l)] for l in model['profiles'].column('locationId').to_numpy()])
+        print('model with {} segment shards saved in {:.1f} s\n'.format(
+            len(model['segments'].shards), save_seconds))
+
+        rng = np.random.RandomState(1)
+        samples = rng.randint(0, args.users, args.queries)
+        requests = [({'gender': genders[i], 'locationId': int(l)}, vectors[i])
+                    for i, l in zip(samples, rng.randint(1, N_LOCATIONS + 1, args.queries))]
+
+        def global_query(fetch):
+            def query(rec_input, vector):
+                target = TARGET_GENDERS[rec_input['gender']][0]
+                region = regions[str(rec_input['locationId'])]
+                rows = model['index'].get_nns_by_vector(vector, fetch)
+                return [r for r in rows if genders[r] == target and row_regions[r] == region][:args.n]
+            return query
+
+        def segment_query(rec_input, vector):
+            return model['segments'].view(rec_input).get_nns_by_vector(vector, args.n)
+
+        print('{:<14} {:>10} {:>10} {:>10} {:>12}'.format('search', 'p50 ms', 'p99 ms', 'full', 'own region'))
+        for label, query in (('global', global_query(args.n)),
+                             ('global x{}'.format(args.overfetch), global_query(args.n * args.overfetch)),
+                             ('segments', segment_query)):
+            latencies = []
+            full = own = returned = 0
+            for rec_input, vector in requests:
+                start = time.time()
+                rows = query(rec_input, vector)
+                latencies.append(time.time() - start)
+                region = regions[str(rec_input['locationId'])]
+                full += len(rows) >= args.n
+                own += sum(row_regions[r] == region for r in rows)
+                returned += len(rows)
+            p50, p99 = np.percentile(np.array(latencies) * 1000, [50, 99])
+            print('{:<14} {:>10.2f} {:>10.2f} {:>9.1%} {:>11.1%}'.format(
+                label, p50, p99, full / float(len(requests)), own / float(max(returned, 1))))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+"""
+Load test of the serving path: latency percentiles and throughput of the inference container and of
+the query Lambda, with the per-stage breakdown each of them now reports.
+
+serve mode builds a synthetic model (bench_model_loading.build_synthetic_model) and starts gunicorn
+with the command line of container/serving_code/serve, on a local TCP port instead of the nginx socket,
+for every combination of --workers and --worker-classes. --clients keep-alive client threads replay
+synthetic new-user payloads against /invocations for --seconds in a closed loop (each sends its next
+request once the previous one is answered); /metrics is scraped at the end for the stage means.
+new_user_recommender, which this tree does not include, is provided by local_recommender.
+
+lambda mode replays the query Lambda's requests through query_recommender.lambda_handler in-process with
+stand-in DynamoDB, SageMaker runtime and SSM clients, and reads the stage timings back from the
+request_timing lines the handler logs.
+
+Usage:
+    python benchmarks/bench_serving_load.py --mode serve --workers 1 2 4 --worker-classes gevent sync
+    python benchmarks/bench_serving_load.py --mode lambda --requests 2000
+"""
+
+from __future__ import print_function
+
+import io
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import contextlib
+import subprocess
+import http.client
+from importlib.machinery import SourceFileLoader
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'ap-northeast-1')
+here = os.path.dirname(os.path.abspath(__file__))
+serving_code = os.path.abspath(os.path.join(here, '..', 'container', 'serving_code'))
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.join(here, '..', 'external_lambda_functions'))
+
+import numpy as np  # noqa: E402
+
+from bench_model_loading import build_synthetic_model  # noqa: E402
+
+SHIM = 'from local_recommender import *  # noqa: F401,F403\n'
+
+
+def new_user_payload(rng, batch):
+    users = [{'user_id': 'new{:07d}'.format(rng.randrange(10 ** 7)),
+              'gender': rng.choice(['M', 'F']),
+              'locationId': rng.randint(0, 49),
+              'birthdate': rng.randint(1960, 2004),
+              'followingCategories': rng.sample(range(30), 3)} for _ in range(batch)]
+    if batch == 1:
+        return json.dumps(users[0]), 'application/json'
+    return '\n'.join(json.dumps(u) for u in users), 'application/jsonlines'
+
+
+def summarize(latencies, seconds):
+    """(requests, throughput per second, p50, p95, p99 in ms)"""
+    if not latencies:
+        return 0, 0.0, float('nan'), float('nan'), float('nan')
+    values = np.array(latencies) * 1000.0
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return len(latencies), len(latencies) / seconds, p50, p95, p99
+
+
+class HttpLoad(object):
+    """Closed-loop client threads, each on its own keep-alive connection."""
+
+    def __init__(self, port, clients, batch):
+        self.port = port
+        self.batch = batch
+        self.latencies = []
+        self.errors = 0
+        self.stopping = threading.Event()
+        self.threads = [threading.Thread(target=self.run, args=(i,)) for i in range(clients)]
+
+    def run(self, seed):
+        rng = random.Random(seed)
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        while not self.stopping.is_set():
+            body, content_type = new_user_payload(rng, self.batch)
+            start = time.time()
+            try:
+                connection.request('POST', '/invocations', body=body, headers={'Content-Type': content_type})
+                response = connection.getresponse()
+                response.read()
+                ok = response.status == 200
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+                ok = False
+            if ok:
+                self.latencies.append(time.time() - start)
+            else:
+                self.errors += 1
+        connection.close()
+
+    def measure(self, warmup, seconds):
+        for thread in self.threads:
+            thread.start()
+        time.sleep(warmup)
+        del self.latencies[:]
+        self.errors = 0
+        time.sleep(seconds)
+        # Requests still in flight when the window closes are not counted
+        latencies, errors = list(self.latencies), self.errors
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+        return latencies, errors
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def http_get(port, path):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        return response.status, response.read().decode('utf-8')
+    finally:
+        connection.close()
+
+
+def wait_until_healthy(port, process, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited with {}'.format(process.returncode))
+        try:
+            if http_get(port, '/ping')[0] == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError('The server did not become healthy in {} s'.format(timeout))
+
+
+def stage_means(metrics_text):
+    """Mean milliseconds per stage from the recommender_stage_seconds histogram."""
+    sums, counts = {}, {}
+    for name, stage, value in re.findall(r'recommender_stage_seconds_(sum|count)\{stage="(\w+)"\} (\S+)',
+                                         metrics_text):
+        (sums if name == 'sum' else counts)[stage] = float(value)
+    return dict((stage, sums[stage] / counts[stage] * 1000.0) for stage in sums if counts.get(stage))
+
+
+def start_server(serve, port, workers, worker_class, env):
+    serve.model_server_workers = workers
+    serve.model_server_worker_class = worker_class
+    command = serve.gunicorn_command(bind='127.0.0.1:{}'.format(port))
+    command[0] = shutil.which('gunicorn') or command[0]
+    return subprocess.Popen(command, cwd=serving_code, env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+
+
+def run_serve(args):
+    root = tempfile.mkdtemp(prefix='bench_serving_load_')
+    try:
+        model_dir = os.path.join(root, 'model')
+        build_synthetic_model(model_dir, args.users, args.vector_size, args.trees)
+        shim_dir = os.path.join(root, 'shim')
+        os.makedirs(shim_dir)
+        with open(os.path.join(shim_dir, 'new_user_recommender.py'), 'w') as f:
+            f.write(SHIM)
+
+        env = dict(os.environ)
+        env.update({'MODEL_PATH': model_dir,
+                    'MODEL_HOT_SWAP': 'false',
+                    'RESULT_CACHE': args.result_cache,
+                    'PYTHONPATH': os.pathsep.join([shim_dir, serving_code, here])})
+        serve = SourceFileLoader('serve', os.path.join(serving_code, 'serve')).load_module()
+
+        print('{:<8} {:>8} {:>8} {:>10} {:>10} {:>9} {:>9} {:>9} {:>7}'.format(
+            'class', 'workers', 'clients', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+        breakdowns = []
+        for worker_class in args.worker_classes:
+            for workers in args.workers:
+                port = free_port()
+                process = start_server(serve, port, workers, worker_class, env)
+                try:
+                    wait_until_healthy(port, process, args.startup_timeout)
+                    load = HttpLoad(port, args.clients, args.batch)
+                    latencies, errors = load.measure(args.warmup, args.seconds)
+                    means = stage_means(http_get(port, '/metrics')[1])
+                finally:
+                    process.terminate()
+                    process.wait()
+                n, throughput, p50, p95, p99 = summarize(latencies, args.seconds)
+                print('{:<8} {:>8} {:>8} {:>10} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>7}'.format(
+                    worker_class, workers, args.clients, n, throughput, p50, p95, p99, errors))
+                breakdowns.append(('{} x{}'.format(worker_class, workers), means))
+
+        print('\nMean ms per stage, from /metrics (warm-up included):')
+        stages = [s for s in ('decode', 'cache', 'preferences', 'ann', 'encode', 'invocation')
+                  if any(s in means for _, means in breakdowns)]
+        print('{:<12}'.format('') + ''.join('{:>13}'.format(s) for s in stages))
+        for label, means in breakdowns:
+            print('{:<12}'.format(label) + ''.join('{:>13.3f}'.format(means.get(s, float('nan'))) for s in stages))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def lambda_events(n_requests, n_users, n_recs):
+    """A mix of registered users' GETs and unregistered users' POSTs."""
+    import local_aws
+    rng = random.Random(0)
+    random.seed(0)
+    events = []
+    for _ in range(n_requests):
+        if rng.random() < 0.2:
+            events.append(local_aws.new_user_event('new{:07d}'.format(rng.randrange(10 ** 7)),
+                                                   rng.randint(1, n_recs // 10)))
+        else:
+            params = {'q_user_id': 'user{:07d}'.format(rng.randrange(n_users)),
+                      'q_type': 'PAGINATED_QUERY', 'q_page_id': str(rng.randint(1, n_recs // 10))}
+            events.append({'queryStringParameters': params})
+    return events
+
+
+def run_lambda(args):
+    import local_aws
+    import local_dynamodb
+    import query_recommender
+    import warm_cache
+    import write_behind
+
+    expiry_time = int(time.time()) + 14 * 24 * 3600
+    table = local_dynamodb.LocalTable('recommendations', 'user_id', 'model_id',
+                                      latency_seconds=args.ddb_latency_ms / 1000.0)
+    rng = random.Random(0)
+    for u in range(args.lambda_users):
+        table.items[('user{:07d}'.format(u), 1)] = {
+            'user_id': 'user{:07d}'.format(u), 'model_id': 1, 'expiry_time': expiry_time,
+            'recommendation_id': ','.join('user{:07d}'.format(rng.randrange(10 ** 6)) for _ in range(args.recs))}
+    query_recommender.recommendations = table
+    query_recommender.sm_rt_client = local_aws.LocalSageMakerRuntime(args.endpoint_latency_ms / 1000.0,
+                                                                     n_recs=args.recs)
+    query_recommender.ssm_client = local_aws.LocalSSM()
+    query_recommender.write_queue = write_behind.WriteBehindQueue()
+    # Every request goes through DynamoDB, as on a cold or a busy fleet
+    query_recommender.user_cache = warm_cache.TTLCache(0, 0)
+
+    records = []
+    start = time.time()
+    for event in lambda_events(args.requests, args.lambda_users, args.recs):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            query_recommender.lambda_handler(event, None)
+        records += [json.loads(line) for line in output.getvalue().splitlines()
+                    if line.startswith('{') and '"request_timing"' in line]
+    elapsed = time.time() - start
+
+    print('{} invocations in {:.1f} s, {:.0f}/s in one process\n'.format(len(records), elapsed,
+                                                                         len(records) / elapsed))
+    stages = sorted(set(k for r in records for k in r if k.endswith('_ms') and k != 'total_ms'))
+    print('{:<18} {:>8} {:>9} {:>9} {:>9}   mean ms per stage'.format('query type', 'count', 'p50 ms', 'p95 ms',
+                                                                      'p99 ms'))
+    for query_type in sorted(set(r['QueryType'] for r in records)):
+        selected = [r for r in records if r['QueryType'] == query_type]
+        p50, p95, p99 = np.percentile([r['total_ms'] for r in selected], [50, 95, 99])
+        means = ', '.join('{} {:.3f}'.format(s[:-3], np.mean([r[s] for r in selected if s in r]))
+                          for s in stages if any(s in r for r in selected))
+        print('{:<18} {:>8} {:>9.2f} {:>9.2f} {:>9.2f}   {}'.format(query_type, len(selected), p50, p95, p99, means))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=['serve', 'lambda', 'both'], default='both')
+    parser.add_argument('--users', type=int, default=100000, help='Registered users in the synthetic model')
+    parser.add_argument('--vector-size', type=int, default=50)
+    parser.add_argument('--trees', type=int, default=10)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--worker-classes', nargs='+', default=['gevent', 'sync'])
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--batch', type=int, default=1, help='Users per request; more than 1 sends JSON lines')
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--warmup', type=float, default=2.0)
+    parser.add_argument('--startup-timeout', type=float, default=120.0)
+    parser.add_argument('--result-cache', default='off', help='RESULT_CACHE of the server')
+    parser.add_argument('--requests', type=int, default=2000, help='Lambda invocations')
+    parser.add_argument('--lambda-users', type=int, default=1000)
+    parser.add_argument('--recs', type=int, default=500, help='Recommendations per user in the Lambda tables')
+    parser.add_argument('--ddb-latency-ms', type=float, default=5.0)
+    parser.add_argument('--endpoint-latency-ms', type=float, default=20.0)
+    args = parser.parse_args()
+
+    if args.mode in ('serve', 'both'):
+        run_serve(args)
+    if args.mode in ('lambda', 'both'):
+        if args.mode == 'both':
+            print()
+        run_lambda(args)
+
+
+if __name__ == '__main__':
+    main()
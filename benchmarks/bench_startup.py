@@ -0,0 +1,174 @@
+"""
+Import time and cold start of the inference container and of the query Lambda.
+
+  imports      python -X importtime of recommender (the serving app) and of query_recommender, in fresh
+               interpreters; the best of --repeat runs and the heaviest modules each pulls in
+  lambda       time from a fresh interpreter to a handler ready to serve a registered user's GET (only
+               DynamoDB) and an unregistered user's POST (DynamoDB, SSM, S3 and the SageMaker runtime):
+               the import plus the boto3 clients the request creates. No request is sent
+  serve        time from starting gunicorn with the command line of container/serving_code/serve (as
+               bench_serving_load.py does, with a synthetic model) to the first /ping 200, for every
+               --workers count, with and without --preload
+
+--max-import-ms and --max-ping-seconds make the run fail when a budget is exceeded, so a regression
+shows up in a local run or in CI.
+
+Usage:
+    python benchmarks/bench_startup.py --workers 1 4 --repeat 5
+    python benchmarks/bench_startup.py --skip-serve --max-import-ms 600
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from importlib.machinery import SourceFileLoader
+
+here = os.path.dirname(os.path.abspath(__file__))
+serving_code = os.path.abspath(os.path.join(here, '..', 'container', 'serving_code'))
+lambda_code = os.path.abspath(os.path.join(here, '..', 'external_lambda_functions'))
+sys.path.insert(0, here)
+
+from bench_model_loading import build_synthetic_model  # noqa: E402
+from bench_serving_load import SHIM, free_port, start_server, wait_until_healthy  # noqa: E402
+
+LAMBDA_READY = '''
+import time
+start = time.time()
+import query_recommender
+imported = time.time()
+for client in {clients}:
+    getattr(query_recommender, client).client
+print(imported - start, time.time() - start)
+'''
+GET_CLIENTS = ['recommendations']
+POST_CLIENTS = ['recommendations', 'ssm_client', 's3_client', 'sm_rt_client']
+
+
+def write_shim(directory):
+    with open(os.path.join(directory, 'new_user_recommender.py'), 'w') as f:
+        f.write(SHIM)
+
+
+def importtime(module, env, cwd):
+    """(total microseconds, [(cumulative microseconds, module)]) of importing module."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module], env=env, cwd=cwd,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.append((int(cumulative), name.rstrip()))
+    total = [us for us, name in modules if name.strip() == module][0]
+    # Only the modules imported directly by module or by its own imports, not their internals
+    top = sorted(((us, name.strip()) for us, name in modules if len(name) - len(name.lstrip()) <= 3
+                  and name.strip() != module), reverse=True)
+    return total, top
+
+
+def report_imports(label, module, env, cwd, repeat, show):
+    runs = [importtime(module, env, cwd) for _ in range(repeat)]
+    total, top = min(runs, key=lambda run: run[0])
+    print('{:<18} {:>10.1f} ms   (worst of {} runs {:.1f} ms)'.format(
+        label, total / 1000.0, repeat, max(run[0] for run in runs) / 1000.0))
+    for us, name in top[:show]:
+        print('    {:<30} {:>8.1f} ms'.format(name, us / 1000.0))
+    return total / 1000.0
+
+
+def report_lambda(env, repeat):
+    print('\n{:<18} {:>12} {:>12}'.format('lambda request', 'import ms', 'ready ms'))
+    for label, clients in (('GET', GET_CLIENTS), ('POST', POST_CLIENTS)):
+        runs = []
+        for _ in range(repeat):
+            output = subprocess.run([sys.executable, '-c', LAMBDA_READY.format(clients=clients)], env=env,
+                                    cwd=lambda_code, stdout=subprocess.PIPE, universal_newlines=True,
+                                    check=True).stdout
+            runs.append([float(v) * 1000.0 for v in output.split()])
+        imported, ready = min(runs, key=lambda run: run[1])
+        print('{:<18} {:>12.1f} {:>12.1f}'.format(label, imported, ready))
+
+
+def report_serve(args, root, shim_dir):
+    model_dir = os.path.join(root, 'model')
+    build_synthetic_model(model_dir, args.users, args.vector_size, args.trees)
+    env = dict(os.environ)
+    env.update({'MODEL_PATH': model_dir, 'MODEL_HOT_SWAP': 'false',
+                'PYTHONPATH': os.pathsep.join([shim_dir, serving_code, here])})
+    serve = SourceFileLoader('serve', os.path.join(serving_code, 'serve')).load_module()
+
+    print('\n{:<10} {:>8} {:>18}'.format('preload', 'workers', 'first /ping 200 s'))
+    slowest = 0.0
+    for preload in (True, False):
+        serve.model_server_preload = preload
+        env['MODEL_SERVER_PRELOAD'] = str(preload).lower()
+        for workers in args.workers:
+            port = free_port()
+            start = time.time()
+            process = start_server(serve, port, workers, args.worker_class, env)
+            try:
+                wait_until_healthy(port, process, args.startup_timeout)
+                seconds = time.time() - start
+            finally:
+                process.terminate()
+                process.wait()
+            slowest = max(slowest, seconds)
+            print('{:<10} {:>8} {:>18.2f}'.format(str(preload).lower(), workers, seconds))
+    return slowest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=3, help='Fresh interpreters per measurement')
+    parser.add_argument('--show', type=int, default=8, help='Heaviest imports listed per module')
+    parser.add_argument('--users', type=int, default=100000, help='Registered users in the synthetic model')
+    parser.add_argument('--vector-size', type=int, default=50)
+    parser.add_argument('--trees', type=int, default=10)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--worker-class', default='gevent')
+    parser.add_argument('--startup-timeout', type=float, default=120.0)
+    parser.add_argument('--skip-serve', action='store_true', help='Only the import and Lambda measurements')
+    parser.add_argument('--max-import-ms', type=float, default=None, help='Fail above this import time')
+    parser.add_argument('--max-ping-seconds', type=float, default=None, help='Fail above this time to /ping')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='bench_startup_')
+    try:
+        shim_dir = os.path.join(root, 'shim')
+        os.makedirs(shim_dir)
+        write_shim(shim_dir)
+        serving_env = dict(os.environ, MODEL_HOT_SWAP='false',
+                           PYTHONPATH=os.pathsep.join([shim_dir, serving_code, here]))
+        lambda_env = dict(os.environ, PYTHONPATH=lambda_code)
+        lambda_env.setdefault('AWS_DEFAULT_REGION', 'ap-northeast-1')
+
+        failures = []
+        imports = {
+            'recommender': report_imports('recommender', 'recommender', serving_env, serving_code, args.repeat,
+                                          args.show),
+            'query_recommender': report_imports('query_recommender', 'query_recommender', lambda_env, lambda_code,
+                                                args.repeat, args.show),
+        }
+        report_lambda(lambda_env, args.repeat)
+        if args.max_import_ms is not None:
+            failures += ['{} imports in {:.1f} ms'.format(m, ms) for m, ms in imports.items()
+                         if ms > args.max_import_ms]
+        if not args.skip_serve:
+            slowest = report_serve(args, root, shim_dir)
+            if args.max_ping_seconds is not None and slowest > args.max_ping_seconds:
+                failures.append('first /ping 200 after {:.2f} s'.format(slowest))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    if failures:
+        raise SystemExit('Startup budget exceeded: ' + '; '.join(failures))
+
+
+if __name__ == '__main__':
+    main()
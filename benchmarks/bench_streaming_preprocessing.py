@@ -0,0 +1,128 @@
+"""
+Peak RSS and throughput of the streaming preprocessing against loading the whole snapshot.
+
+Writes a synthetic interaction snapshot (user_id, target_id, ts) row group by row group, then runs
+container/training_code/streaming_preprocessing.py and, with --baseline, the same computation done on
+the fully loaded DataFrame. Each run is a separate process so its peak RSS is its own.
+
+To reproduce a snapshot several times larger than the machine's memory without a huge dataset, cap the
+address space of the runs with --memory-limit-mb: the baseline then fails while the streaming run stays
+within the cap.
+
+Usage:
+    python benchmarks/bench_streaming_preprocessing.py --rows 20000000 --memory-limit-mb 1024 --baseline
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+training_code = os.path.join(here, '..', 'container', 'training_code')
+
+
+def write_snapshot(path, rows, users, row_group_rows, seed=0):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    rng = np.random.RandomState(seed)
+    writer = None
+    for offset in range(0, rows, row_group_rows):
+        n = min(row_group_rows, rows - offset)
+        # Popular targets get most of the interactions, like real traffic
+        table = pa.Table.from_arrays([
+            pa.array(rng.randint(0, users, n)).cast(pa.string()),
+            pa.array(np.minimum(rng.zipf(1.3, n), users)).cast(pa.string()),
+            pa.array(rng.randint(0, 10 ** 9, n).astype(np.int64)),
+        ], names=['user_id', 'target_id', 'ts'])
+        if writer is None:
+            writer = pq.ParquetWriter(path, table.schema, compression='gzip')
+        writer.write_table(table)
+    writer.close()
+
+
+BASELINE = '''
+import sys, json, time, resource
+import pandas as pd
+sys.path.insert(0, {training_code!r})
+import streaming_preprocessing as sp
+start = time.time()
+frame = pd.read_parquet({input!r})
+pairs = sp.sentence_pairs(frame, 'user_id', 'target_id', 'ts', {window})
+counts = pairs.groupby(['center', 'context'], sort=False).size()
+elapsed = time.time() - start
+print(json.dumps({{'input_rows': len(frame), 'distinct_pairs': len(counts), 'seconds': round(elapsed, 3),
+                  'rows_per_second': round(len(frame) / elapsed, 1), 'peak_rss_mb': round(sp.peak_rss_mb(), 1)}}))
+'''
+
+STREAMING = '''
+import sys
+sys.path.insert(0, {training_code!r})
+import streaming_preprocessing as sp
+sp.preprocess({input!r}, {output!r}, time_column='ts', window={window}, partitions={partitions},
+              batch_rows={batch_rows})
+'''
+
+
+def run(name, code, memory_limit_mb):
+    def limit():
+        if memory_limit_mb:
+            import resource
+            limit_bytes = memory_limit_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit_bytes, limit_bytes))
+    start = time.time()
+    process = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             preexec_fn=limit, universal_newlines=True)
+    if process.returncode != 0:
+        reason = process.stderr.strip().splitlines()[-1] if process.stderr.strip() else 'exit code {}'.format(
+            process.returncode)
+        print('{:<10} failed after {:.1f}s: {}'.format(name, time.time() - start, reason))
+        return
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    print('{:<10} {:>12} {:>14} {:>10.1f} {:>14.0f} {:>14.1f}'.format(
+        name, result['input_rows'], result['distinct_pairs'], result['seconds'], result['rows_per_second'],
+        result['peak_rss_mb']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=5000000)
+    parser.add_argument('--users', type=int, default=200000)
+    parser.add_argument('--row-group-rows', type=int, default=500000)
+    parser.add_argument('--window', type=int, default=5)
+    parser.add_argument('--partitions', type=int, default=64)
+    parser.add_argument('--batch-rows', type=int, default=500000)
+    parser.add_argument('--memory-limit-mb', type=int, default=0, help='Address space cap of each run')
+    parser.add_argument('--baseline', action='store_true', help='Also run the whole-snapshot version')
+    parser.add_argument('--workdir', default=None, help='Where to write the snapshot and the spill files')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='preprocessing-', dir=args.workdir)
+    try:
+        snapshot = os.path.join(workdir, 'input.parquet.gzip')
+        start = time.time()
+        write_snapshot(snapshot, args.rows, args.users, args.row_group_rows)
+        print('Snapshot: {} rows, {:.1f} MB on disk, written in {:.1f}s'.format(
+            args.rows, os.path.getsize(snapshot) / 1e6, time.time() - start))
+
+        settings = dict(training_code=training_code, input=snapshot, output=os.path.join(workdir, 'out'),
+                        window=args.window, partitions=args.partitions, batch_rows=args.batch_rows)
+        print('{:<10} {:>12} {:>14} {:>10} {:>14} {:>14}'.format('run', 'rows', 'distinct pairs', 'seconds',
+                                                                  'rows/sec', 'peak RSS MB'))
+        run('streaming', STREAMING.format(**settings), args.memory_limit_mb)
+        if args.baseline:
+            run('in-memory', BASELINE.format(**settings), args.memory_limit_mb)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
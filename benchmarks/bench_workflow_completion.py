@@ -0,0 +1,231 @@
+"""
+End-to-end latency of the retraining workflow with each way of waiting for the processing jobs.
+
+Runs the workflow's state machine (preprocessing -> training -> batch inference -> DynamoDB load) in
+local_stepfunctions on a virtual clock, with the real query_processing_status and
+processing_job_callback handlers against a LocalSageMaker whose jobs take random run times:
+
+  fixed       the original loop: query, wait 60 seconds, check, query again
+  adaptive    CompletionMode=poll: query, check, wait the WaitSeconds the query returned (adaptive backoff)
+  callback    CompletionMode=callback: .waitForTaskToken, resumed by the job's state change event
+
+For each it reports the total and the overhead over the jobs' own run times (the time between a job
+ending and the workflow moving on), the Lambda invocations and the state transitions (which Step
+Functions bills). Then it checks the failure paths: a failed job, a lost state change event (the
+callback times out and falls back to polling) and a describe_processing_job error.
+
+Usage:
+    python benchmarks/bench_workflow_completion.py --runs 200
+"""
+
+from __future__ import print_function
+
+import io
+import os
+import sys
+import random
+import argparse
+import contextlib
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'container', 'training_code'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'ap-northeast-1')
+import query_processing_status  # noqa: E402
+import processing_job_callback  # noqa: E402
+from local_aws import LocalSageMaker  # noqa: E402
+from local_dynamodb import LocalTable  # noqa: E402
+from local_stepfunctions import LocalStateMachine, VirtualClock  # noqa: E402
+
+LAMBDA_INVOKE = 'arn:aws:states:::lambda:invoke'
+TRAINING_SYNC = 'arn:aws:states:::sagemaker:createTrainingJob.sync'
+GLUE_SYNC = 'arn:aws:states:::glue:startJobRun.sync'
+CALLBACK_TIMEOUT_SECONDS = 4 * 3600
+
+
+def processing_states(label, job_name_path, result_name, completion, next_state, fail_state):
+    """The states that create one processing job and wait for it, as the notebook builds them."""
+    create, query, check, wait = ('Create {} Job'.format(label), 'Query {} Results'.format(label),
+                                  'Check {} Status'.format(label), 'Wait-{}'.format(label))
+    mode, callback = '{} Completion Mode?'.format(label), 'Wait For {}'.format(label)
+    query_result = '$.{}LambdaResult'.format(result_name)
+    states = {
+        create: {'Type': 'Task', 'Resource': LAMBDA_INVOKE,
+                 'Parameters': {'FunctionName': 'create-job', 'Payload': {'ProcessingJobName.$': job_name_path}},
+                 'ResultPath': '$.Create{}LambdaResult'.format(result_name),
+                 'Next': query if completion == 'fixed' else mode},
+        query: {'Type': 'Task', 'Resource': LAMBDA_INVOKE,
+                'Parameters': {'FunctionName': 'query-processing-status',
+                               'Payload': {'ProcessingJobName.$': job_name_path}},
+                'Retry': [{'ErrorEquals': ['ProcessingStatusUnavailable'], 'IntervalSeconds': 10,
+                           'BackoffRate': 2.0, 'MaxAttempts': 4}],
+                'ResultPath': query_result, 'Next': wait if completion == 'fixed' else check},
+        fail_state: {'Type': 'Fail'},
+    }
+    status = query_result + '.Payload.ProcessingJobStatus'
+    running = {'Variable': status, 'StringEquals': 'InProgress'}
+    if completion == 'fixed':
+        states[wait] = {'Type': 'Wait', 'Seconds': 60, 'Next': check}
+        running['Next'] = query
+    else:
+        states[wait] = {'Type': 'Wait', 'SecondsPath': query_result + '.Payload.WaitSeconds', 'Next': query}
+        running['Next'] = wait
+        states[mode] = {'Type': 'Choice', 'Default': callback, 'Choices': [
+            {'Variable': '$.CompletionMode', 'StringEquals': 'poll', 'Next': query}]}
+        states[callback] = {
+            'Type': 'Task', 'Resource': LAMBDA_INVOKE + '.waitForTaskToken',
+            'Parameters': {'FunctionName': 'processing-job-callback',
+                           'Payload': {'ProcessingJobName.$': job_name_path, 'TaskToken.$': '$$.Task.Token'}},
+            'TimeoutSeconds': CALLBACK_TIMEOUT_SECONDS,
+            'ResultPath': '$.{}CallbackResult'.format(result_name),
+            'Catch': [{'ErrorEquals': ['ProcessingJobFailed'], 'Next': fail_state,
+                       'ResultPath': '$.{}CallbackError'.format(result_name)},
+                      {'ErrorEquals': ['States.Timeout'], 'Next': query,
+                       'ResultPath': '$.{}CallbackError'.format(result_name)}],
+            'Next': next_state}
+    states[check] = {'Type': 'Choice', 'Choices': [
+        running,
+        {'Variable': status, 'StringEquals': 'Failed', 'Next': fail_state},
+        {'Variable': status, 'StringEquals': 'Stopped', 'Next': fail_state},
+        {'Variable': status, 'StringEquals': 'Completed', 'Next': next_state}]}
+    return create, states
+
+
+def workflow_definition(completion):
+    batch_start, states = processing_states('Batch Inference', '$.BatchPredJobName', 'BatchPred', completion,
+                                            'Load Recommendations', 'Batch Inference Failed')
+    preprocessing_start, preprocessing = processing_states('Preprocessing', '$.PreprocessingJobName',
+                                                           'Preprocessing', completion, 'Train Model',
+                                                           'Preprocessing Failed')
+    states.update(preprocessing)
+    states['Train Model'] = {'Type': 'Task', 'Resource': TRAINING_SYNC, 'ResultPath': '$.TrainingJobResults',
+                             'Next': batch_start}
+    states['Load Recommendations'] = {'Type': 'Task', 'Resource': GLUE_SYNC, 'ResultPath': '$.GlueResults',
+                                      'Next': 'Recommender Workflow Succeeded'}
+    states['Recommender Workflow Succeeded'] = {'Type': 'Succeed'}
+    return {'StartAt': preprocessing_start, 'States': states}
+
+
+def quiet(handler):
+    """The handler with its print output (the describe responses) dropped."""
+    def invoke(event, context):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return handler(event, context)
+    return invoke
+
+
+class Simulation(object):
+    """One state machine with its local SageMaker, callback table and event wiring."""
+
+    def __init__(self, completion, training_seconds, glue_seconds, deliver_events=True):
+        self.clock = VirtualClock()
+        self.sagemaker = LocalSageMaker(self.clock)
+        self.run_seconds = {}
+        self.event_invocations = 0
+        self.job_status = {}
+        self.machine = LocalStateMachine(
+            workflow_definition(completion),
+            lambdas={'create-job': self.create_job,
+                     'query-processing-status': quiet(query_processing_status.lambda_handler),
+                     'processing-job-callback': quiet(processing_job_callback.lambda_handler)},
+            integrations={TRAINING_SYNC: lambda parameters: (training_seconds, {}),
+                          GLUE_SYNC: lambda parameters: (glue_seconds, {})},
+            clock=self.clock)
+        if deliver_events:
+            self.sagemaker.listeners.append(self.on_event)
+
+        query_processing_status.sm_client = self.sagemaker
+        query_processing_status.utcnow = self.clock.datetime
+        processing_job_callback.sm_client = self.sagemaker
+        processing_job_callback.sfn_client = self.machine
+        processing_job_callback.token_table = LocalTable('processing-job-callbacks', 'job_name')
+
+    def create_job(self, event, context):
+        name = event['ProcessingJobName']
+        self.sagemaker.create_processing_job(name, self.run_seconds[name], self.job_status.get(name, 'Completed'))
+        return {'statusCode': 200}
+
+    def on_event(self, event):
+        def invoke():
+            self.event_invocations += 1
+            quiet(processing_job_callback.lambda_handler)(event, None)
+        self.clock.schedule(self.machine.lambda_seconds, invoke)
+
+    def run(self, completion_mode, preprocessing_seconds, batch_seconds, training_seconds, glue_seconds):
+        self.run_seconds = {'preprocessing': preprocessing_seconds, 'batch': batch_seconds}
+        result = self.machine.run({'PreprocessingJobName': 'preprocessing', 'BatchPredJobName': 'batch',
+                                   'CompletionMode': completion_mode})
+        startup = self.sagemaker.startup_seconds
+        result['ideal_seconds'] = preprocessing_seconds + batch_seconds + 2 * startup + training_seconds + glue_seconds
+        result['lambda_invocations'] += self.event_invocations
+        return result
+
+
+def summarize(results):
+    n = float(len(results))
+    overheads = sorted(r['seconds'] - r['ideal_seconds'] for r in results)
+    return {
+        'total_minutes': sum(r['seconds'] for r in results) / n / 60,
+        'overhead_mean': sum(overheads) / n,
+        'overhead_p95': overheads[int(0.95 * (len(overheads) - 1))],
+        'lambda_invocations': sum(r['lambda_invocations'] for r in results) / n,
+        'transitions': sum(r['transitions'] for r in results) / n,
+    }
+
+
+def check_failure_paths(training_seconds, glue_seconds):
+    failed = Simulation('adaptive', training_seconds, glue_seconds)
+    failed.job_status = {'preprocessing': 'Failed'}
+    for mode in ['poll', 'callback']:
+        result = failed.run(mode, 600, 600, training_seconds, glue_seconds)
+        print('failed preprocessing job, {:<8} -> {} ({})'.format(mode, result['status'], result['error']))
+
+    lost = Simulation('adaptive', training_seconds, glue_seconds, deliver_events=False)
+    result = lost.run('callback', 600, 600, training_seconds, glue_seconds)
+    print('lost state change events, callback -> {} after {:.0f} min (timeout {} min, then polling)'.format(
+        result['status'], result['seconds'] / 60, CALLBACK_TIMEOUT_SECONDS // 60))
+
+    # The job is never created, so describe_processing_job fails on every query
+    missing = Simulation('adaptive', training_seconds, glue_seconds)
+    missing.machine.lambdas['create-job'] = lambda event, context: {'statusCode': 200}
+    result = missing.run('poll', 600, 600, training_seconds, glue_seconds)
+    print('describe_processing_job error, poll -> {} ({}) after {} retries'.format(
+        result['status'], result['error'], missing.sagemaker.describe_calls - 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=100)
+    parser.add_argument('--preprocessing-minutes', type=float, nargs=2, default=[5, 30])
+    parser.add_argument('--batch-minutes', type=float, nargs=2, default=[5, 40])
+    parser.add_argument('--training-minutes', type=float, default=45)
+    parser.add_argument('--glue-minutes', type=float, default=10)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    durations = [(rng.uniform(*args.preprocessing_minutes) * 60, rng.uniform(*args.batch_minutes) * 60)
+                 for _ in range(args.runs)]
+    training_seconds = args.training_minutes * 60
+    glue_seconds = args.glue_minutes * 60
+
+    rows = []
+    for completion, mode in [('fixed', 'poll'), ('adaptive', 'poll'), ('adaptive', 'callback')]:
+        results = []
+        for preprocessing_seconds, batch_seconds in durations:
+            simulation = Simulation(completion, training_seconds, glue_seconds)
+            result = simulation.run(mode, preprocessing_seconds, batch_seconds, training_seconds, glue_seconds)
+            assert result['status'] == 'SUCCEEDED', result
+            results.append(result)
+        rows.append((completion if mode == 'poll' else mode, summarize(results)))
+
+    print('{:>10} {:>12} {:>14} {:>14} {:>10} {:>12}'.format(
+        'mode', 'total min', 'overhead s', 'overhead p95', 'lambdas', 'transitions'))
+    for name, s in rows:
+        print('{:>10} {:>12.1f} {:>14.1f} {:>14.1f} {:>10.1f} {:>12.1f}'.format(
+            name, s['total_minutes'], s['overhead_mean'], s['overhead_p95'], s['lambda_invocations'],
+            s['transitions']))
+    print()
+    check_failure_paths(training_seconds, glue_seconds)
+
+
+if __name__ == '__main__':
+    main()
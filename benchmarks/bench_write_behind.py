@@ -0,0 +1,108 @@
+"""
+New-user POST latency with synchronous vs write-behind (deferred) DynamoDB puts.
+
+Replays unregistered-user requests through query_recommender.lambda_handler with stand-in SageMaker,
+SSM and DynamoDB clients. The DynamoDB stand-in adds a fixed round-trip latency and can fail a share
+of batches, to check that retried writes stay idempotent: every user ends up with exactly one item.
+
+The requests run back to back, as in a busy container. "carried wait ms" is the mean time an
+invocation waits, before returning, for the writes queued by the invocations before it: what is left
+of a deferred write once it has overlapped with the next invocation's own work. A frozen container
+makes no progress on the writes between invocations, so with real idle gaps the wait is no smaller.
+
+Usage:
+    python benchmarks/bench_write_behind.py --requests 300 --ddb-latency-ms 10 --failure-rate 0.1
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'ap-northeast-1')
+# The handler's per-invocation timing lines would drown the results
+os.environ.setdefault('REQUEST_TIMING_LOG', 'off')
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.join(here, '..', 'external_lambda_functions'))
+
+import numpy as np  # noqa: E402
+
+import local_aws  # noqa: E402
+import local_dynamodb  # noqa: E402
+import query_recommender  # noqa: E402
+import write_behind  # noqa: E402
+
+
+class FlakyTable(local_dynamodb.LocalTable):
+    """Fails a share of batch flushes after writing part of them, like a throttled batch."""
+
+    def __init__(self, failure_rate, *args, **kwargs):
+        super(FlakyTable, self).__init__(*args, **kwargs)
+        self.failure_rate = failure_rate
+        self.rng = random.Random(0)
+        self.failures = 0
+
+    def _round_trip(self):
+        super(FlakyTable, self)._round_trip()
+        if self.rng.random() < self.failure_rate:
+            self.failures += 1
+            raise RuntimeError('ProvisionedThroughputExceededException')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--users', type=int, default=200, help='Distinct users; repeats are retried requests')
+    parser.add_argument('--ddb-latency-ms', type=float, default=10.0)
+    parser.add_argument('--endpoint-latency-ms', type=float, default=5.0)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    random.seed(0)
+    events = [local_aws.new_user_event('new{:06d}'.format(rng.randrange(args.users)))
+              for _ in range(args.requests)]
+
+    # The handler logs its stage timings once per invocation; keep its flush waits
+    flush_waits = []
+    log = query_recommender.timings.log
+
+    def record_flush(*args, **kwargs):
+        flush_waits.append(query_recommender.timings.stages.get('flush', 0.0))
+        return log(*args, **kwargs)
+
+    query_recommender.timings.log = record_flush
+
+    print('{:<10} {:>10} {:>10} {:>16} {:>10} {:>10} {:>12}'.format(
+        'mode', 'p50 ms', 'p99 ms', 'carried wait ms', 'items', 'retries', 'all users'))
+    for mode in ('off', 'deferred'):
+        table = FlakyTable(args.failure_rate if mode != 'off' else 0.0, 'recommendations', 'user_id', 'model_id',
+                           latency_seconds=args.ddb_latency_ms / 1000.0)
+        query_recommender.recommendations = table
+        query_recommender.sm_rt_client = local_aws.LocalSageMakerRuntime(args.endpoint_latency_ms / 1000.0)
+        query_recommender.ssm_client = local_aws.LocalSSM()
+        query_recommender.write_behind_mode = mode
+        query_recommender.write_queue = write_behind.WriteBehindQueue(base_backoff_seconds=0.001)
+
+        latencies = []
+        del flush_waits[:]
+        for event in events:
+            start = time.time()
+            query_recommender.lambda_handler(event, None)
+            latencies.append(time.time() - start)
+        query_recommender.write_queue.flush()
+
+        users = set(json.loads(e['body'])['new_user_id'] for e in events)
+        written_users = set(key[0] for key in table.items)
+        stats = query_recommender.write_queue.stats()
+        print('{:<10} {:>10.2f} {:>10.2f} {:>16.2f} {:>10} {:>10} {:>12}'.format(
+            mode, np.percentile(latencies, 50) * 1000, np.percentile(latencies, 99) * 1000, np.mean(flush_waits),
+            len(table.items), stats['retries'], str(written_users == users and stats['failed'] == 0)))
+
+if __name__ == '__main__':
+    main()
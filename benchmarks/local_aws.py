@@ -0,0 +1,131 @@
+"""
+In-memory stand-ins for the boto3 clients the query Lambda uses besides DynamoDB, for local benchmarks.
+"""
+
+from __future__ import print_function
+
+import io
+import json
+import time
+import random
+
+
+class LocalSageMakerRuntime(object):
+    """invoke_endpoint returning n_recs random recommendations in the shape the endpoint returns."""
+
+    def __init__(self, latency_seconds=0.0, n_recs=100, n_users=100000):
+        self.latency_seconds = latency_seconds
+        self.n_recs = n_recs
+        self.n_users = n_users
+        self.invocations = 0
+
+    def invoke_endpoint(self, EndpointName, Body, ContentType, **kwargs):
+        self.invocations += 1
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        payload = json.loads(Body)
+        rng = random.Random(payload['user_id'])
+        recommendations = {
+            'index': 0,
+            'user_id': payload['user_id'],
+            'recommendation_id': ','.join('user{:07d}'.format(rng.randrange(self.n_users))
+                                          for _ in range(self.n_recs)),
+        }
+        return {'Body': io.BytesIO(json.dumps(recommendations).encode('utf-8'))}
+
+
+class LocalSageMaker(object):
+    """
+    Processing jobs on a local_stepfunctions.VirtualClock: describe_processing_job reports a job
+    InProgress until its run time is over, and the state change event of every job that ends is delivered
+    to the subscribed listeners event_seconds later, like an EventBridge rule.
+    """
+
+    def __init__(self, clock, startup_seconds=120.0, event_seconds=1.0):
+        self.clock = clock
+        self.startup_seconds = startup_seconds
+        self.event_seconds = event_seconds
+        self.jobs = {}
+        self.listeners = []
+        self.describe_calls = 0
+
+    def create_processing_job(self, ProcessingJobName, run_seconds, status='Completed', failure_reason=''):
+        created = self.clock.now
+        self.jobs[ProcessingJobName] = {
+            'created': created,
+            'started': created + self.startup_seconds,
+            'ended': created + self.startup_seconds + run_seconds,
+            'status': status,
+            'failure_reason': failure_reason,
+        }
+        self.clock.schedule(self.startup_seconds + run_seconds + self.event_seconds,
+                            lambda: self._notify(ProcessingJobName))
+        return {'ProcessingJobArn': 'arn:aws:sagemaker:local:0:processing-job/' + ProcessingJobName}
+
+    def _status(self, job):
+        return job['status'] if self.clock.now >= job['ended'] else 'InProgress'
+
+    def describe_processing_job(self, ProcessingJobName):
+        self.describe_calls += 1
+        if ProcessingJobName not in self.jobs:
+            raise ValueError('Could not find requested job with name {}'.format(ProcessingJobName))
+        job = self.jobs[ProcessingJobName]
+        response = {
+            'ProcessingJobName': ProcessingJobName,
+            'ProcessingJobStatus': self._status(job),
+            'CreationTime': self.clock.datetime(job['created']),
+        }
+        if self.clock.now >= job['started']:
+            response['ProcessingStartTime'] = self.clock.datetime(job['started'])
+        if response['ProcessingJobStatus'] != 'InProgress':
+            response['ProcessingEndTime'] = self.clock.datetime(job['ended'])
+            if job['failure_reason']:
+                response['FailureReason'] = job['failure_reason']
+        return response
+
+    def _notify(self, job_name):
+        job = self.jobs[job_name]
+        event = {
+            'source': 'aws.sagemaker',
+            'detail-type': 'SageMaker Processing Job State Change',
+            'detail': {'ProcessingJobName': job_name, 'ProcessingJobStatus': job['status'],
+                       'FailureReason': job['failure_reason']},
+        }
+        for listener in self.listeners:
+            listener(event)
+
+
+class ParameterNotFound(Exception):
+    pass
+
+
+class LocalSSM(object):
+
+    class exceptions(object):
+        ParameterNotFound = ParameterNotFound
+
+    def __init__(self, parameters=None, latency_seconds=0.0):
+        self.parameters = parameters or {'recommender.retrain_freq': '7'}
+        self.latency_seconds = latency_seconds
+        self.calls = 0
+
+    def get_parameter(self, Name, WithDecryption=False):
+        self.calls += 1
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        if Name not in self.parameters:
+            raise ParameterNotFound(Name)
+        return {'Parameter': {'Name': Name, 'Value': self.parameters[Name]}}
+
+
+def new_user_event(user_id, page_id=1, q_type='PAGINATED_QUERY'):
+    """API Gateway proxy event of an unregistered user's POST."""
+    return {'body': json.dumps({
+        'new_user_id': user_id,
+        'gender': random.choice(['M', 'F']),
+        'locationId': random.randint(1, 47),
+        'birthdate': '{}-01-01'.format(random.randint(1960, 2004)),
+        'followingCategories': random.sample(range(30), 3),
+        'q_type': q_type,
+        'q_page_id': str(page_id),
+    })}
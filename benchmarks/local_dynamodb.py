@@ -0,0 +1,254 @@
+"""
+In-memory stand-in for the boto3 DynamoDB Table resource, for local benchmarks.
+
+Supports the calls the Lambda functions and loaders make (put_item, get_item, delete_item, query with
+boto3 Key conditions, batch_writer) and counts round trips, items and bytes read and written, using
+DynamoDB's item size rules (attribute name + value bytes). LocalDynamoDB adds the service resource's
+batch_write_item, throttled against a provisioned write capacity.
+"""
+
+from __future__ import print_function
+
+import threading
+from decimal import Decimal
+
+from boto3.dynamodb import conditions
+
+
+def value_size(value):
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if hasattr(value, 'value') and isinstance(value.value, (bytes, bytearray)):
+        return len(value.value)
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    if isinstance(value, bool) or value is None:
+        return 1
+    if isinstance(value, (int, float, Decimal)):
+        return len(str(value)) // 2 + 1
+    if isinstance(value, dict):
+        return 3 + sum(len(k) + value_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return 3 + sum(value_size(v) for v in value)
+    return len(str(value))
+
+
+def item_size(item):
+    return sum(len(name) + value_size(value) for name, value in item.items())
+
+
+def _matches(condition, item):
+    if isinstance(condition, conditions.And):
+        return all(_matches(c, item) for c in condition._values)
+    if isinstance(condition, conditions.Or):
+        return any(_matches(c, item) for c in condition._values)
+    name = condition._values[0].name
+    if name not in item:
+        return False
+    actual = item[name]
+    operands = condition._values[1:]
+    if isinstance(condition, conditions.Equals):
+        return actual == operands[0]
+    if isinstance(condition, conditions.Between):
+        return operands[0] <= actual <= operands[1]
+    if isinstance(condition, conditions.BeginsWith):
+        return str(actual).startswith(operands[0])
+    if isinstance(condition, conditions.LessThan):
+        return actual < operands[0]
+    if isinstance(condition, conditions.LessThanEquals):
+        return actual <= operands[0]
+    if isinstance(condition, conditions.GreaterThan):
+        return actual > operands[0]
+    if isinstance(condition, conditions.GreaterThanEquals):
+        return actual >= operands[0]
+    raise NotImplementedError('Unsupported key condition {}'.format(type(condition).__name__))
+
+
+def _hash_key_value(condition, hash_key):
+    """The value the condition requires the hash key to equal, if any."""
+    if isinstance(condition, conditions.And):
+        for c in condition._values:
+            value = _hash_key_value(c, hash_key)
+            if value is not None:
+                return value
+    elif isinstance(condition, conditions.Equals) and condition._values[0].name == hash_key:
+        return condition._values[1]
+    return None
+
+
+class LocalTable(object):
+
+    def __init__(self, name, hash_key, range_key=None, latency_seconds=0.0):
+        self.name = self.table_name = name
+        self.hash_key = hash_key
+        self.range_key = range_key
+        self.latency_seconds = latency_seconds
+        self.items = {}
+        self.partitions = {}
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.round_trips = self.items_read = self.bytes_read = self.items_written = self.bytes_written = 0
+
+    def _key(self, item):
+        return (item[self.hash_key], item[self.range_key] if self.range_key else None)
+
+    def _round_trip(self):
+        self.round_trips += 1
+        if self.latency_seconds:
+            import time
+            time.sleep(self.latency_seconds)
+
+    def _read(self, items):
+        self.items_read += len(items)
+        self.bytes_read += sum(item_size(i) for i in items)
+        return [dict(i) for i in items]
+
+    def _write(self, item):
+        with self._lock:
+            key = self._key(item)
+            self.items[key] = dict(item)
+            self.partitions.setdefault(key[0], {})[key[1]] = self.items[key]
+            self.items_written += 1
+            self.bytes_written += item_size(item)
+
+    def put_item(self, Item, **kwargs):
+        self._round_trip()
+        self._write(Item)
+        return {'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    def get_item(self, Key, **kwargs):
+        self._round_trip()
+        item = self.items.get(self._key(Key))
+        return {'Item': self._read([item])[0]} if item is not None else {}
+
+    def delete_item(self, Key, ReturnValues='NONE', **kwargs):
+        self._round_trip()
+        with self._lock:
+            key = self._key(Key)
+            old = self.items.pop(key, None)
+            self.partitions.get(key[0], {}).pop(key[1], None)
+        return {'Attributes': dict(old)} if old is not None and ReturnValues == 'ALL_OLD' else {}
+
+    def query(self, KeyConditionExpression, ScanIndexForward=True, Limit=None, **kwargs):
+        self._round_trip()
+        hash_value = _hash_key_value(KeyConditionExpression, self.hash_key)
+        candidates = self.partitions.get(hash_value, {}).values() if hash_value is not None else self.items.values()
+        matches = [i for i in candidates if _matches(KeyConditionExpression, i)]
+        if self.range_key:
+            matches.sort(key=lambda i: i[self.range_key], reverse=not ScanIndexForward)
+        if Limit is not None:
+            matches = matches[:Limit]
+        items = self._read(matches)
+        return {'Items': items, 'Count': len(items)}
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return LocalBatchWriter(self, overwrite_by_pkeys=overwrite_by_pkeys)
+
+
+class LocalBatchWriter(object):
+    """Buffers puts and writes them 25 at a time like the boto3 batch writer."""
+
+    def __init__(self, table, flush_amount=25, overwrite_by_pkeys=None):
+        self.table = table
+        self.flush_amount = flush_amount
+        self.overwrite_by_pkeys = overwrite_by_pkeys
+        self.buffer = []
+
+    def put_item(self, Item):
+        if self.overwrite_by_pkeys:
+            # Like boto3, a later put of the same key replaces the buffered one
+            key = [Item[k] for k in self.overwrite_by_pkeys]
+            self.buffer = [i for i in self.buffer if [i[k] for k in self.overwrite_by_pkeys] != key]
+        self.buffer.append(Item)
+        if len(self.buffer) >= self.flush_amount:
+            self._flush()
+
+    def _flush(self):
+        if self.buffer:
+            self.table._round_trip()
+            for item in self.buffer:
+                self.table._write(item)
+            self.buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._flush()
+
+
+class LocalDynamoDB(object):
+    """
+    The DynamoDB service resource over LocalTables: Table(name) and batch_write_item.
+
+    With write_capacity (write units per second) batch writes are throttled like a provisioned table:
+    capacity accrues in a bucket holding up to burst_seconds of it, a put takes one unit per KB, puts
+    beyond the bucket come back as UnprocessedItems, and a request of which nothing could be written
+    raises ProvisionedThroughputExceededException. Each request takes latency_seconds, outside the lock,
+    so concurrent writers overlap their round trips.
+    """
+
+    def __init__(self, tables, write_capacity=None, burst_seconds=1.0, latency_seconds=0.0):
+        self.tables = dict((t.name, t) for t in tables)
+        self.write_capacity = write_capacity
+        self.burst_seconds = burst_seconds
+        self.latency_seconds = latency_seconds
+        self._lock = threading.Lock()
+        self._units = write_capacity * burst_seconds if write_capacity else 0.0
+        self._last = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.requests = self.throttled_requests = self.unprocessed_items = self.write_units = 0
+
+    def Table(self, name):
+        return self.tables[name]
+
+    def _take(self, units):
+        import time
+        with self._lock:
+            now = time.time()
+            if self._last is not None:
+                self._units = min(self.write_capacity * self.burst_seconds,
+                                  self._units + (now - self._last) * self.write_capacity)
+            self._last = now
+            if self._units < units:
+                return False
+            self._units -= units
+            return True
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        import math
+        import time
+        from botocore.exceptions import ClientError
+
+        if sum(len(requests) for requests in RequestItems.values()) > 25:
+            raise ClientError({'Error': {'Code': 'ValidationException',
+                                         'Message': 'Too many items requested for the BatchWriteItem call'}},
+                              'BatchWriteItem')
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        self.requests += 1
+        written = 0
+        unprocessed = {}
+        for name, requests in RequestItems.items():
+            table = self.tables[name]
+            for request in requests:
+                item = request['PutRequest']['Item']
+                units = max(1, int(math.ceil(item_size(item) / 1024.0)))
+                if self.write_capacity and not self._take(units):
+                    unprocessed.setdefault(name, []).append(request)
+                    continue
+                table._write(item)
+                self.write_units += units
+                written += 1
+        if unprocessed:
+            self.unprocessed_items += sum(len(r) for r in unprocessed.values())
+            if not written:
+                self.throttled_requests += 1
+                raise ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException',
+                                             'Message': 'The level of configured provisioned throughput for '
+                                                        'the table was exceeded'}}, 'BatchWriteItem')
+        return {'UnprocessedItems': unprocessed}
@@ -0,0 +1,39 @@
+"""
+Stand-in for new_user_recommender, which the serving container imports but this tree does not include.
+
+generate_new_preferences averages the preference vectors of the registered users sharing the new
+user's gender and locationId (falling back to all users), which is what the serving code expects of it:
+one float32 vector per distinct feature set. generate_recommendations queries the model's ANN index
+and returns {user_id, recommendation_id} with the ids comma-joined, excluding the user.
+
+install() registers the module under the name new_user_recommender, before recommender is imported.
+"""
+
+from __future__ import print_function
+
+import sys
+
+import numpy as np
+
+
+def generate_new_preferences(user_id, gender, location_id, birthdate, following_categories, rec_model):
+    vectors = rec_model['preference_vectors']
+    profiles = rec_model.get('profiles')
+    rows = None
+    if profiles is not None and 'gender' in profiles.column_names and 'locationId' in profiles.column_names:
+        genders = profiles.column('gender').to_numpy(zero_copy_only=False)
+        locations = profiles.column('locationId').to_numpy(zero_copy_only=False)
+        rows = np.flatnonzero((genders == gender) & (locations.astype(str) == str(location_id)))[:1000]
+    if rows is None or not len(rows):
+        rows = np.arange(min(len(vectors), 1000))
+    return np.asarray(vectors[rows], dtype=np.float32).mean(axis=0)
+
+
+def generate_recommendations(user_id, preference_vectors, rec_model, top_n):
+    rows = rec_model['index'].get_nns_by_vector(np.asarray(preference_vectors, dtype=np.float32), top_n + 1)
+    ids = [str(i) for i in np.take(rec_model['user_ids'], rows) if str(i) != str(user_id)][:top_n]
+    return {'user_id': user_id, 'recommendation_id': ','.join(ids)}
+
+
+def install():
+    sys.modules.setdefault('new_user_recommender', sys.modules[__name__])
@@ -0,0 +1,296 @@
+"""
+Local simulator of a Step Functions state machine on a virtual clock, for measuring workflow latency.
+
+Runs an Amazon States Language definition (the JSON Workflow.definition.to_json() produces) with the
+subset the recommender workflow uses: Task (lambda:invoke, with or without .waitForTaskToken, and
+other service integrations through callables), Choice, Wait (Seconds / SecondsPath), Pass, Succeed and
+Fail, with Parameters, ResultPath, Retry, Catch and TimeoutSeconds.
+
+Time is virtual: Wait states, retries and jobs advance a VirtualClock instead of sleeping, and events
+scheduled on the clock (a job finishing, an EventBridge delivery) fire in time order while a task waits
+for its callback. A run of an hour-long pipeline takes milliseconds.
+
+The Lambda functions are plain handlers called in-process; LocalStateMachine also offers the
+send_task_success / send_task_failure calls of the boto3 Step Functions client, so a callback handler
+can be given the simulator as its client.
+"""
+
+from __future__ import print_function
+
+import copy
+import heapq
+import json
+import uuid
+import datetime
+import itertools
+
+DEFAULT_LAMBDA_SECONDS = 0.2
+
+
+class VirtualClock(object):
+
+    def __init__(self, start=datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)):
+        self.start = start
+        self.now = 0.0
+        self._events = []
+        self._sequence = itertools.count()
+
+    def datetime(self, seconds=None):
+        return self.start + datetime.timedelta(seconds=self.now if seconds is None else seconds)
+
+    def schedule(self, delay, callback):
+        heapq.heappush(self._events, (self.now + delay, next(self._sequence), callback))
+
+    def advance_to(self, until):
+        """Fire the events due up to until, in time order."""
+        while self._events and self._events[0][0] <= until:
+            at, _, callback = heapq.heappop(self._events)
+            self.now = max(self.now, at)
+            callback()
+        self.now = max(self.now, until)
+
+    def advance(self, seconds):
+        self.advance_to(self.now + seconds)
+
+    def run_until(self, stop, deadline):
+        """Fire events until stop() or the deadline; True if stop() became true."""
+        while not stop():
+            if not self._events or self._events[0][0] > deadline:
+                self.now = max(self.now, deadline)
+                return stop()
+            at, _, callback = heapq.heappop(self._events)
+            self.now = max(self.now, at)
+            callback()
+        return True
+
+
+class StatesError(Exception):
+
+    def __init__(self, error, cause=''):
+        super(StatesError, self).__init__('{}: {}'.format(error, cause))
+        self.error = error
+        self.cause = cause
+
+
+def get_path(data, path, context=None):
+    if path is None:
+        return None
+    if path.startswith('$$'):
+        data, path = context or {}, path[1:]
+    value = data
+    for part in [p for p in path[1:].split('.') if p]:
+        value = value[part]
+    return value
+
+
+def set_path(data, path, value):
+    if path == '$':
+        return value
+    data = copy.deepcopy(data)
+    target = data
+    parts = [p for p in path[1:].split('.') if p]
+    for part in parts[:-1]:
+        target = target.setdefault(part, {})
+    target[parts[-1]] = value
+    return data
+
+
+def resolve(template, data, context=None):
+    """Parameters with their '<key>.$' paths replaced by the values they point to."""
+    if isinstance(template, dict):
+        resolved = {}
+        for key, value in template.items():
+            if key.endswith('.$'):
+                resolved[key[:-2]] = get_path(data, value, context)
+            else:
+                resolved[key] = resolve(value, data, context)
+        return resolved
+    if isinstance(template, list):
+        return [resolve(v, data, context) for v in template]
+    return template
+
+
+def _matches(errors, error):
+    return 'States.ALL' in errors or error in errors or \
+        ('States.TaskFailed' in errors and error not in ('States.Timeout',))
+
+
+def _choice_matches(rule, data):
+    if 'And' in rule:
+        return all(_choice_matches(r, data) for r in rule['And'])
+    if 'Or' in rule:
+        return any(_choice_matches(r, data) for r in rule['Or'])
+    if 'Not' in rule:
+        return not _choice_matches(rule['Not'], data)
+    try:
+        value = get_path(data, rule['Variable'])
+    except (KeyError, TypeError):
+        return False
+    for operator, test in [('StringEquals', lambda v, x: v == x), ('BooleanEquals', lambda v, x: v is x),
+                           ('NumericEquals', lambda v, x: v == x), ('NumericGreaterThan', lambda v, x: v > x),
+                           ('NumericLessThan', lambda v, x: v < x)]:
+        if operator in rule:
+            return test(value, rule[operator])
+    raise NotImplementedError('Unsupported choice rule {}'.format(rule))
+
+
+class LocalStateMachine(object):
+    """
+    lambdas:       {function name: handler(event, context)}
+    integrations:  {resource ARN: callable(parameters) -> (seconds, result)} for the other Task resources
+    """
+
+    def __init__(self, definition, lambdas, integrations=None, clock=None, lambda_seconds=DEFAULT_LAMBDA_SECONDS):
+        self.definition = json.loads(definition) if isinstance(definition, str) else definition
+        self.lambdas = lambdas
+        self.integrations = integrations or {}
+        self.clock = clock or VirtualClock()
+        self.lambda_seconds = lambda_seconds
+        self._callbacks = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.lambda_invocations = 0
+        self.transitions = 0
+        self.history = []
+
+    # The boto3 Step Functions client calls a callback handler makes
+    def send_task_success(self, taskToken, output):
+        if taskToken not in self._callbacks:
+            raise StatesError('TaskTimedOut', 'Task token {} is not waiting'.format(taskToken))
+        self._callbacks[taskToken] = ('success', json.loads(output))
+        return {}
+
+    def send_task_failure(self, taskToken, error='', cause=''):
+        if taskToken not in self._callbacks:
+            raise StatesError('TaskTimedOut', 'Task token {} is not waiting'.format(taskToken))
+        self._callbacks[taskToken] = ('failure', StatesError(error, cause))
+        return {}
+
+    def invoke_lambda(self, name, payload):
+        self.lambda_invocations += 1
+        self.clock.advance(self.lambda_seconds)
+        try:
+            return self.lambdas[name](copy.deepcopy(payload), None)
+        except StatesError:
+            raise
+        except Exception as e:
+            raise StatesError(type(e).__name__, str(e))
+
+    def _run_task(self, state, data):
+        resource = state['Resource']
+        token = uuid.uuid4().hex
+        parameters = resolve(state.get('Parameters', {}), data, {'Task': {'Token': token}})
+        timeout = state.get('TimeoutSeconds', 99999999)
+        started = self.clock.now
+
+        if resource.startswith('arn:aws:states:::lambda:invoke'):
+            if resource.endswith('.waitForTaskToken'):
+                self._callbacks[token] = None
+                try:
+                    self.invoke_lambda(parameters['FunctionName'], parameters.get('Payload', {}))
+                    done = self.clock.run_until(lambda: self._callbacks[token] is not None, started + timeout)
+                    if not done:
+                        raise StatesError('States.Timeout', 'No callback within {}s'.format(timeout))
+                    kind, result = self._callbacks[token]
+                finally:
+                    self._callbacks.pop(token, None)
+                if kind == 'failure':
+                    raise result
+                return result
+            payload = self.invoke_lambda(parameters['FunctionName'], parameters.get('Payload', {}))
+            return {'Payload': payload, 'StatusCode': 200}
+
+        if resource not in self.integrations:
+            raise NotImplementedError('No local integration for {}'.format(resource))
+        seconds, result = self.integrations[resource](parameters)
+        if seconds > timeout:
+            self.clock.advance(timeout)
+            raise StatesError('States.Timeout', '{} took longer than {}s'.format(resource, timeout))
+        self.clock.advance(seconds)
+        return result
+
+    def _task_with_retries(self, state, data):
+        attempts = {}
+        while True:
+            try:
+                return self._run_task(state, data)
+            except StatesError as e:
+                for retrier in state.get('Retry', []):
+                    if _matches(retrier['ErrorEquals'], e.error):
+                        index = id(retrier)
+                        attempts[index] = attempts.get(index, 0) + 1
+                        if attempts[index] > retrier.get('MaxAttempts', 3):
+                            raise
+                        self.clock.advance(retrier.get('IntervalSeconds', 1) *
+                                           retrier.get('BackoffRate', 2.0) ** (attempts[index] - 1))
+                        break
+                else:
+                    raise
+
+    def run(self, execution_input, max_transitions=100000):
+        """Run one execution. Returns {status, output, error, seconds, lambda_invocations, transitions}."""
+        started = self.clock.now
+        invocations = self.lambda_invocations
+        transitions = self.transitions
+        states = self.definition['States']
+        name = self.definition['StartAt']
+        data = copy.deepcopy(execution_input)
+        status, error = 'SUCCEEDED', None
+
+        while name is not None:
+            if self.transitions - transitions > max_transitions:
+                raise RuntimeError('More than {} transitions, is the workflow looping?'.format(max_transitions))
+            self.transitions += 1
+            self.history.append((self.clock.now, name))
+            state = states[name]
+            kind = state['Type']
+            next_name = state.get('Next')
+
+            if kind == 'Task':
+                try:
+                    result = self._task_with_retries(state, data)
+                    data = set_path(data, state.get('ResultPath', '$'), result) \
+                        if state.get('ResultPath', '$') is not None else data
+                except StatesError as e:
+                    for catcher in state.get('Catch', []):
+                        if _matches(catcher['ErrorEquals'], e.error):
+                            data = set_path(data, catcher.get('ResultPath', '$'), {'Error': e.error, 'Cause': e.cause})
+                            next_name = catcher['Next']
+                            break
+                    else:
+                        status, error = 'FAILED', e.error
+                        break
+            elif kind == 'Pass':
+                if 'Result' in state or 'Parameters' in state:
+                    value = state['Result'] if 'Result' in state else resolve(state['Parameters'], data)
+                    data = set_path(data, state.get('ResultPath', '$'), value)
+            elif kind == 'Choice':
+                next_name = next((rule['Next'] for rule in state['Choices'] if _choice_matches(rule, data)),
+                                 state.get('Default'))
+                if next_name is None:
+                    status, error = 'FAILED', 'States.NoChoiceMatched'
+                    break
+            elif kind == 'Wait':
+                seconds = state['Seconds'] if 'Seconds' in state else get_path(data, state['SecondsPath'])
+                self.clock.advance(seconds)
+            elif kind == 'Succeed':
+                break
+            elif kind == 'Fail':
+                status, error = 'FAILED', state.get('Error', name)
+                break
+            else:
+                raise NotImplementedError('Unsupported state type {}'.format(kind))
+
+            if state.get('End'):
+                break
+            name = next_name
+
+        return {
+            'status': status,
+            'error': error,
+            'output': data,
+            'seconds': self.clock.now - started,
+            'lambda_invocations': self.lambda_invocations - invocations,
+            'transitions': self.transitions - transitions,
+        }
@@ -0,0 +1,258 @@
+# Nearest-neighbour index backends used by RecommendationService.
+#
+# Every backend has the same build/save/load/query methods, and also answers get_nns_by_vector with
+# Annoy's signature and distance conventions, so code written against an AnnoyIndex keeps working:
+#
+#   AnnoyBackend      Annoy forest, mmap'ed from <name>.ann
+#   ExactBackend      brute-force search with one BLAS matrix-vector product over <name>.exact.npy.
+#                     For small candidate pools, and as the ground truth when tuning the others.
+#   QuantizedBackend  flat int8 scalar-quantized index in <name>.int8.npy (+ .scale.npy), a quarter of
+#                     the memory of the float32 vectors and scanned in blocks.
+
+from __future__ import print_function
+
+import os
+
+import numpy as np
+
+DEFAULT_METRIC = 'angular'
+EPSILON = 1e-12
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, EPSILON)
+
+
+def _top_n(scores, n):
+    """Row positions of the n highest scores, best first."""
+    n = min(n, len(scores))
+    if n <= 0:
+        return np.array([], dtype=np.int64)
+    top = np.argpartition(-scores, n - 1)[:n]
+    return top[np.argsort(-scores[top], kind='mergesort')]
+
+
+def _distances(scores, metric, vector_norm=None):
+    """Convert similarity scores back into the distances Annoy would report for the metric."""
+    if metric == 'angular':
+        return np.sqrt(np.maximum(2.0 - 2.0 * scores, 0.0))
+    if metric == 'euclidean':
+        # scores are -||x - q||^2 + ||q||^2 when ranking, see ExactBackend.query
+        return np.sqrt(np.maximum(vector_norm - scores, 0.0))
+    return scores
+
+
+class AnnIndex(object):
+    """Interface shared by the backends."""
+
+    kind = None
+    suffix = None
+
+    def __init__(self, vector_size, metric=DEFAULT_METRIC):
+        self.vector_size = vector_size
+        self.metric = metric
+
+    def build(self, vectors, **params):
+        raise NotImplementedError()
+
+    def save(self, path):
+        raise NotImplementedError()
+
+    def load(self, path, mmap=True):
+        raise NotImplementedError()
+
+    def query(self, vector, n, search_k=-1):
+        """Return (rows, distances) of the n nearest items, nearest first."""
+        raise NotImplementedError()
+
+    def get_n_items(self):
+        raise NotImplementedError()
+
+    def get_nns_by_vector(self, vector, n, search_k=-1, include_distances=False):
+        rows, distances = self.query(vector, n, search_k)
+        rows = [int(r) for r in rows]
+        if include_distances:
+            return rows, [float(d) for d in distances]
+        return rows
+
+    def memory_bytes(self):
+        """Bytes of index data, whether in the heap or mmap'ed."""
+        raise NotImplementedError()
+
+
+class AnnoyBackend(AnnIndex):
+    kind = 'annoy'
+    suffix = '.ann'
+
+    def __init__(self, vector_size, metric=DEFAULT_METRIC):
+        super(AnnoyBackend, self).__init__(vector_size, metric)
+        import annoy
+        self.index = annoy.AnnoyIndex(vector_size, metric)
+        self.path = None
+
+    def build(self, vectors, n_trees=10, **params):
+        for i, vector in enumerate(vectors):
+            self.index.add_item(i, vector)
+        self.index.build(n_trees)
+        return self
+
+    def save(self, path):
+        self.index.save(path)
+        self.path = path
+
+    def load(self, path, mmap=True):
+        # prefault=False keeps the file mmap'ed and lets the page cache share it between workers
+        self.index.load(path, prefault=not mmap)
+        self.path = path
+        return self
+
+    def query(self, vector, n, search_k=-1):
+        return self.index.get_nns_by_vector(vector, n, search_k=search_k, include_distances=True)
+
+    def get_nns_by_vector(self, vector, n, search_k=-1, include_distances=False):
+        return self.index.get_nns_by_vector(vector, n, search_k=search_k, include_distances=include_distances)
+
+    def get_n_items(self):
+        return self.index.get_n_items()
+
+    def memory_bytes(self):
+        return os.path.getsize(self.path) if self.path else 0
+
+    def __getattr__(self, name):
+        # Anything else an AnnoyIndex offers, e.g. get_item_vector
+        if name == 'index':
+            raise AttributeError(name)
+        return getattr(self.index, name)
+
+
+class ExactBackend(AnnIndex):
+    kind = 'exact'
+    suffix = '.exact.npy'
+
+    def __init__(self, vector_size, metric=DEFAULT_METRIC):
+        super(ExactBackend, self).__init__(vector_size, metric)
+        self.vectors = None
+        self.sq_norms = None
+
+    def _prepare(self):
+        if self.metric == 'euclidean':
+            self.sq_norms = np.einsum('ij,ij->i', self.vectors, self.vectors)
+
+    def build(self, vectors, **params):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        # Angular distance only depends on direction, so store unit vectors and rank by dot product
+        self.vectors = _normalize(vectors).astype(np.float32) if self.metric == 'angular' else vectors
+        self._prepare()
+        return self
+
+    def save(self, path):
+        np.save(path, self.vectors)
+
+    def load(self, path, mmap=True):
+        self.vectors = np.load(path, mmap_mode='r' if mmap else None)
+        self._prepare()
+        return self
+
+    def query(self, vector, n, search_k=-1):
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        if self.metric == 'angular':
+            vector = vector / max(float(np.linalg.norm(vector)), EPSILON)
+        scores = self.vectors.dot(vector)
+        vector_norm = None
+        if self.metric == 'euclidean':
+            vector_norm = float(vector.dot(vector))
+            # -||x - q||^2 = 2 x.q - ||x||^2 - ||q||^2; the constant ||q||^2 is added back in _distances
+            scores = 2.0 * scores - self.sq_norms
+        rows = _top_n(scores, n)
+        return rows, _distances(scores[rows], self.metric, vector_norm)
+
+    def get_n_items(self):
+        return len(self.vectors)
+
+    def memory_bytes(self):
+        return int(self.vectors.nbytes)
+
+
+class QuantizedBackend(AnnIndex):
+    """Flat index over int8 codes with one scale per dimension. Supports angular and dot metrics."""
+
+    kind = 'int8'
+    suffix = '.int8.npy'
+    block_rows = 65536
+
+    def __init__(self, vector_size, metric=DEFAULT_METRIC):
+        super(QuantizedBackend, self).__init__(vector_size, metric)
+        if metric not in ('angular', 'dot'):
+            raise ValueError('QuantizedBackend supports the angular and dot metrics, not {}'.format(metric))
+        self.codes = None
+        self.scale = None
+
+    def build(self, vectors, **params):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if self.metric == 'angular':
+            vectors = _normalize(vectors)
+        self.scale = (np.abs(vectors).max(axis=0) / 127.0).astype(np.float32)
+        self.scale[self.scale == 0] = 1.0
+        self.codes = np.clip(np.round(vectors / self.scale), -127, 127).astype(np.int8)
+        return self
+
+    @staticmethod
+    def _scale_path(path):
+        return path[:-len('.npy')] + '.scale.npy' if path.endswith('.npy') else path + '.scale.npy'
+
+    def save(self, path):
+        np.save(path, self.codes)
+        np.save(self._scale_path(path), self.scale)
+
+    def load(self, path, mmap=True):
+        self.codes = np.load(path, mmap_mode='r' if mmap else None)
+        self.scale = np.load(self._scale_path(path))
+        return self
+
+    def query(self, vector, n, search_k=-1):
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        if self.metric == 'angular':
+            vector = vector / max(float(np.linalg.norm(vector)), EPSILON)
+        # Fold the per-dimension scales into the query instead of dequantizing the codes
+        scaled_query = vector * self.scale
+        scores = np.empty(len(self.codes), dtype=np.float32)
+        for start in range(0, len(self.codes), self.block_rows):
+            block = self.codes[start:start + self.block_rows]
+            scores[start:start + len(block)] = block.astype(np.float32).dot(scaled_query)
+        rows = _top_n(scores, n)
+        return rows, _distances(scores[rows], self.metric)
+
+    def get_n_items(self):
+        return len(self.codes)
+
+    def memory_bytes(self):
+        return int(self.codes.nbytes + self.scale.nbytes)
+
+
+BACKENDS = dict((backend.kind, backend) for backend in (AnnoyBackend, ExactBackend, QuantizedBackend))
+
+
+def create_index(kind, vector_size, metric=DEFAULT_METRIC):
+    """Create an empty index of the given backend kind (annoy, exact or int8)."""
+    if kind not in BACKENDS:
+        raise ValueError('Unknown ANN backend {}, expected one of {}'.format(kind, sorted(BACKENDS)))
+    return BACKENDS[kind](vector_size, metric)
+
+
+def split_index_path(path):
+    """(name, kind) of an index file, or None if the file is not an index."""
+    filename = os.path.basename(path)
+    # Longest suffix first, .int8.npy and .exact.npy both end in .npy
+    for backend in sorted(BACKENDS.values(), key=lambda b: -len(b.suffix)):
+        if filename.endswith(backend.suffix):
+            return filename[:-len(backend.suffix)], backend.kind
+    return None
+
+
+def load_index(path, vector_size, metric=DEFAULT_METRIC, mmap=True):
+    """Load an index file, picking the backend from its suffix."""
+    name_kind = split_index_path(path)
+    if name_kind is None:
+        raise ValueError('{} is not an ANN index file'.format(path))
+    return create_index(name_kind[1], vector_size, metric).load(path, mmap=mmap)
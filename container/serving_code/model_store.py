@@ -0,0 +1,235 @@
+# Reads and writes the model artifacts used by the serving container.
+#
+# The artifacts are laid out so that they can be memory-mapped instead of copied into the heap:
+#
+#   model_meta.json          version, vector size, annoy metric
+#   preference_vectors.npy   float32 matrix, one row per registered user
+#   user_ids.npy             user_id for every row of preference_vectors.npy
+#   item_vectors.npy         optional float32 matrix of the users' item-side (context) vectors, in the same
+#                            row order, used by reciprocal_scoring
+#   profiles.arrow           user profiles as an Arrow IPC file (columnar)
+#   <name>.<backend suffix>  one or more ANN indexes, items numbered like the matrix rows. The suffix
+#                            picks the backend, see ann_index: .ann (Annoy), .exact.npy, .int8.npy
+#   segments/                optional indexes partitioned by (gender, region), see segment_index
+#
+# Loaded this way in the gunicorn master (see wsgi.py), every worker forked afterwards reads the
+# same physical pages, so the resident memory stays flat as the number of workers grows.
+
+from __future__ import print_function
+
+import os
+import json
+import glob
+import time
+import tarfile
+
+import numpy as np
+
+import ann_index
+import segment_index
+
+META_FILE = 'model_meta.json'
+PREFERENCE_VECTORS_FILE = 'preference_vectors.npy'
+USER_IDS_FILE = 'user_ids.npy'
+ITEM_VECTORS_FILE = 'item_vectors.npy'
+PROFILES_FILE = 'profiles.arrow'
+INDEX_SUFFIX = ann_index.AnnoyBackend.suffix
+
+DEFAULT_METRIC = 'angular'
+DEFAULT_INDEX_NAME = 'default'
+DEFAULT_BACKEND = ann_index.AnnoyBackend.kind
+
+
+def read_meta(model_dir):
+    """Read model_meta.json, falling back to an empty description for older artifacts."""
+    meta_path = os.path.join(model_dir, META_FILE)
+    if not os.path.exists(meta_path):
+        return {}
+    with open(meta_path, 'r') as f:
+        return json.load(f)
+
+
+def load_profiles(model_dir):
+    """Memory-map the profiles Arrow file. Returns None if the model has no profiles."""
+    profiles_path = os.path.join(model_dir, PROFILES_FILE)
+    if not os.path.exists(profiles_path):
+        return None
+
+    import pyarrow as pa
+    source = pa.memory_map(profiles_path, 'r')
+    return pa.ipc.open_file(source).read_all()
+
+
+def load_indexes(model_dir, vector_size, metric=DEFAULT_METRIC, mmap=True, backend=DEFAULT_BACKEND):
+    """
+    Load the ANN indexes of the model directory, as {name: {backend kind: index}}. Only the preferred
+    backend's file of each index is loaded; another backend's only if that one was not built.
+    """
+    paths = {}
+    for index_path in sorted(glob.glob(os.path.join(model_dir, '*'))):
+        name_kind = ann_index.split_index_path(index_path)
+        if name_kind is not None:
+            name, kind = name_kind
+            paths.setdefault(name, {})[kind] = index_path
+
+    indexes = {}
+    for name, by_kind in paths.items():
+        kind = backend if backend in by_kind else sorted(by_kind)[0]
+        index = ann_index.create_index(kind, vector_size, metric).load(by_kind[kind], mmap=mmap)
+        indexes[name] = {kind: index}
+    return indexes
+
+
+def select_index(indexes, name=DEFAULT_INDEX_NAME, backend=DEFAULT_BACKEND):
+    """The index called name, from the preferred backend if it was built, else from any backend."""
+    by_kind = indexes.get(name, {})
+    if backend in by_kind:
+        return by_kind[backend]
+    for kind in sorted(by_kind):
+        return by_kind[kind]
+    return None
+
+
+def load_model(model_dir, mmap=True, backend=DEFAULT_BACKEND):
+    """
+    Load the model artifacts from model_dir into the dict consumed by new_user_recommender.
+
+    Args:
+        model_dir (str): Directory holding the artifacts described at the top of this module
+        mmap (bool): Memory-map the arrays instead of reading them into the heap
+        backend (str): ANN backend to serve the default index from (annoy, exact or int8)
+    """
+    start = time.time()
+    meta = read_meta(model_dir)
+    mmap_mode = 'r' if mmap else None
+
+    # Load preferences_vectors
+    preference_vectors = np.load(os.path.join(model_dir, PREFERENCE_VECTORS_FILE), mmap_mode=mmap_mode)
+    user_ids = np.load(os.path.join(model_dir, USER_IDS_FILE), mmap_mode=mmap_mode, allow_pickle=False)
+    vector_size = int(meta.get('vector_size', preference_vectors.shape[1]))
+    item_vectors_path = os.path.join(model_dir, ITEM_VECTORS_FILE)
+    item_vectors = np.load(item_vectors_path, mmap_mode=mmap_mode) if os.path.exists(item_vectors_path) else None
+
+    # Load profiles
+    profiles = load_profiles(model_dir)
+
+    # Load the indexes from the selected backend (Annoy by default)
+    metric = meta.get('metric', DEFAULT_METRIC)
+    indexes = load_indexes(model_dir, vector_size, metric, mmap=mmap, backend=backend)
+    annoy_indexes = dict((name, by_kind[ann_index.AnnoyBackend.kind].index) for name, by_kind in indexes.items()
+                         if ann_index.AnnoyBackend.kind in by_kind)
+
+    # Load the per-segment indexes, if the model was trained with them
+    segments = segment_index.SegmentRegistry.load(model_dir, vector_size, mmap=mmap)
+
+    model = {
+        'version': str(meta.get('version', os.path.basename(os.path.normpath(model_dir)))),
+        'vector_size': vector_size,
+        'metric': metric,
+        'preference_vectors': preference_vectors,
+        'user_ids': user_ids,
+        'item_vectors': item_vectors,
+        'profiles': profiles,
+        'annoy_indexes': annoy_indexes,
+        'indexes': indexes,
+        'index': select_index(indexes, DEFAULT_INDEX_NAME, backend),
+        'segments': segments,
+    }
+    model['load_seconds'] = time.time() - start
+    print('Loaded model version {} from {} in {:.2f}s (mmap={}).'.format(
+        model['version'], model_dir, model['load_seconds'], mmap))
+    return model
+
+
+def save_model(model_dir, preference_vectors, user_ids, profiles=None, indexes=None, version=None,
+               metric=DEFAULT_METRIC, item_vectors=None, segments=None):
+    """
+    Write model artifacts in the memory-mappable layout read by load_model.
+
+    Args:
+        preference_vectors (array-like): (n_users, vector_size) preference matrix
+        user_ids (array-like): user_id of every row in preference_vectors
+        profiles (pyarrow.Table or pandas.DataFrame): optional user profiles
+        indexes (dict): optional {name: built index}, either ann_index backends or plain AnnoyIndex objects
+        item_vectors (array-like): optional (n_users, vector_size) item-side matrix, same rows
+        segments (dict): optional segment_index.build_segment_indexes options (regions, target_genders,
+            neighbors, backend, n_trees, ...). The per-segment indexes are built over preference_vectors
+            from the gender and locationId columns of profiles, which must then have them.
+    """
+    if not os.path.exists(model_dir):
+        os.makedirs(model_dir)
+
+    preference_vectors = np.ascontiguousarray(preference_vectors, dtype=np.float32)
+    # Fixed-width unicode keeps the ids mmap-able, unlike an object array
+    user_ids = np.asarray(user_ids)
+    if user_ids.dtype == object:
+        user_ids = user_ids.astype(str)
+    np.save(os.path.join(model_dir, PREFERENCE_VECTORS_FILE), preference_vectors)
+    np.save(os.path.join(model_dir, USER_IDS_FILE), user_ids)
+    if item_vectors is not None:
+        np.save(os.path.join(model_dir, ITEM_VECTORS_FILE), np.ascontiguousarray(item_vectors, dtype=np.float32))
+
+    if profiles is not None:
+        import pyarrow as pa
+        if not isinstance(profiles, pa.Table):
+            profiles = pa.Table.from_pandas(profiles, preserve_index=False)
+        with pa.OSFile(os.path.join(model_dir, PROFILES_FILE), 'wb') as sink:
+            writer = pa.ipc.new_file(sink, profiles.schema)
+            writer.write_table(profiles)
+            writer.close()
+
+    if segments is not None:
+        columns = profiles.column_names if profiles is not None else []
+        if 'gender' not in columns or 'locationId' not in columns:
+            raise ValueError('Segment indexes need profiles with gender and locationId')
+        if 'user_id' in columns:
+            ids = profiles.column('user_id').to_numpy(zero_copy_only=False).astype(str)
+            if not np.array_equal(ids, user_ids.astype(str)):
+                raise ValueError('Segment indexes need the profiles in the row order of user_ids')
+        segment_index.build_segment_indexes(model_dir, preference_vectors,
+                                            profiles.column('gender').to_numpy(zero_copy_only=False),
+                                            profiles.column('locationId').to_numpy(zero_copy_only=False),
+                                            metric=metric, **segments)
+
+    for name, index in (indexes or {}).items():
+        suffix = index.suffix if isinstance(index, ann_index.AnnIndex) else INDEX_SUFFIX
+        index.save(os.path.join(model_dir, name + suffix))
+
+    meta = {
+        'version': version if version is not None else str(int(time.time())),
+        'vector_size': int(preference_vectors.shape[1]),
+        'metric': metric,
+    }
+    with open(os.path.join(model_dir, META_FILE), 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+
+def _inside(root, path):
+    return path == root or path.startswith(root + os.sep)
+
+
+def safe_members(tar, target):
+    """
+    The members of tar, after checking that none would be written outside target: absolute names, '..'
+    components and links pointing out of target are refused, as are device files.
+    """
+    root = os.path.realpath(target)
+    members = tar.getmembers()
+    for member in members:
+        path = os.path.realpath(os.path.join(root, member.name))
+        if member.issym():
+            link = os.path.realpath(os.path.join(os.path.dirname(path), member.linkname))
+        elif member.islnk():
+            link = os.path.realpath(os.path.join(root, member.linkname))
+        else:
+            link = path
+        if not (_inside(root, path) and _inside(root, link)) or member.isdev():
+            raise ValueError('Refusing to extract {} outside {}'.format(member.name, target))
+    return members
+
+
+def extract_archive(archive, target):
+    """Extract the model archive (e.g. model.tar.gz) into target."""
+    with tarfile.open(archive) as tar:
+        tar.extractall(target, members=safe_members(tar, target))
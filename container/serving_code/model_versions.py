@@ -0,0 +1,374 @@
+# Hot swap of the model served by a running container, without an endpoint update.
+#
+# A model version marker is a small JSON document {"version": ..., "model_uri": ...} where model_uri is
+# a model.tar.gz or a prefix of artifacts in S3 (or a local directory). The retraining workflow writes it
+# to MODEL_VERSION_MARKER_URI after training and, with MODEL_HOT_SWAP=true (off by default), every worker
+# of every instance polls it:
+#
+#   1. a changed marker is fetched once per instance into <versions dir>/<version>/, under a file lock,
+#      and recorded in the instance's local marker <versions dir>/ACTIVE.json
+#   2. each worker whose active version differs from the local marker loads that version in the
+#      background and swaps it in. Requests read the model once when they start, so a request is
+#      served by one version from start to end and none waits for the load.
+#
+# ModelVersions keeps the version that was replaced loaded, so a rollback is a swap of two references.
+# A rollback (or a reload from the admin routes) writes the local marker and the other workers follow
+# at their next poll. A local rollback holds until the remote marker changes again.
+#
+# The artifacts are memory-mapped, so workers that load the same version share its pages through the
+# page cache, as they share the model preloaded in the gunicorn master.
+
+from __future__ import print_function
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+import traceback
+from contextlib import contextmanager
+
+import model_store
+
+DEFAULT_VERSIONS_DIR = '/tmp/model-versions'
+ACTIVE_MARKER_FILE = 'ACTIVE.json'
+LOCK_FILE = '.lock'
+DEFAULT_POLL_SECONDS = 30
+DEFAULT_KEEP_VERSIONS = 3
+
+
+class NoPreviousVersion(Exception):
+    """A rollback was requested but no previous version is loaded."""
+
+
+class HotSwapDisabled(Exception):
+    """A reload or rollback was requested but MODEL_HOT_SWAP is off."""
+
+
+class ModelUriNotAllowed(Exception):
+    """A reload named a model_uri outside the MODEL_URI_PREFIXES."""
+
+
+def run_blocking(function, *args):
+    """
+    Run a long blocking call. Under the gevent worker it runs on gevent's pool of real threads, so the
+    worker's other greenlets keep serving requests meanwhile.
+    """
+    try:
+        from gevent import monkey
+        patched = monkey.is_module_patched('threading')
+    except ImportError:
+        patched = False
+    if patched:
+        import gevent
+        return gevent.get_hub().threadpool.apply(function, args)
+    return function(*args)
+
+
+def _split_s3_uri(uri):
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def read_marker(uri, etag=None):
+    """
+    Read the marker at uri (s3:// or a local path). Returns (marker, etag); the marker is None when it
+    does not exist or is unchanged since etag.
+    """
+    if uri.startswith('s3://'):
+        import boto3
+        from botocore.exceptions import ClientError
+        bucket, key = _split_s3_uri(uri)
+        try:
+            kwargs = {'IfNoneMatch': etag} if etag else {}
+            response = boto3.client('s3').get_object(Bucket=bucket, Key=key, **kwargs)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('304', 'NotModified', 'NoSuchKey', '404'):
+                return None, etag
+            raise
+        return json.loads(response['Body'].read().decode('utf-8')), response['ETag']
+
+    try:
+        stat = os.stat(uri)
+    except OSError:
+        return None, etag
+    current = '{}-{}'.format(stat.st_mtime_ns, stat.st_size)
+    if current == etag:
+        return None, etag
+    with open(uri, 'r') as f:
+        return json.load(f), current
+
+
+def write_marker(path, marker):
+    """Replace the local marker at path atomically."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory or '.', prefix='.marker-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(marker, f)
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def file_lock(directory):
+    """
+    Exclusive lock shared by the workers of the instance. Taking it blocks until another worker's fetch
+    is done, so it is only taken inside calls made through run_blocking.
+    """
+    import fcntl
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(os.path.join(directory, LOCK_FILE), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _download_prefix(s3, bucket, prefix, target):
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            relative = os.path.relpath(obj['Key'], prefix)
+            if obj['Key'].endswith('/') or relative.startswith('..'):
+                continue
+            path = os.path.join(target, relative)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            s3.download_file(bucket, obj['Key'], path)
+
+
+def fetch_artifacts(model_uri, versions_dir, version):
+    """
+    The local directory holding the artifacts of model_uri, downloaded and extracted into
+    versions_dir/version the first time. A local directory is used in place.
+    """
+    if os.path.isdir(model_uri):
+        return model_uri
+    target = os.path.join(versions_dir, version.replace('/', '_'))
+    with file_lock(versions_dir):
+        if os.path.isdir(target):
+            return target
+        staging = tempfile.mkdtemp(dir=versions_dir, prefix='.fetch-')
+        try:
+            extracted = os.path.join(staging, 'model')
+            os.makedirs(extracted)
+            if model_uri.endswith('.tar.gz'):
+                archive = model_uri
+                if model_uri.startswith('s3://'):
+                    import boto3
+                    archive = os.path.join(staging, 'model.tar.gz')
+                    boto3.client('s3').download_file(*(_split_s3_uri(model_uri) + (archive,)))
+                model_store.extract_archive(archive, extracted)
+            elif model_uri.startswith('s3://'):
+                import boto3
+                bucket, prefix = _split_s3_uri(model_uri)
+                _download_prefix(boto3.client('s3'), bucket, prefix.rstrip('/') + '/', extracted)
+            else:
+                raise ValueError('Unsupported model_uri {}'.format(model_uri))
+            # Readers only ever see a complete directory
+            os.rename(extracted, target)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+    return target
+
+
+def prune_versions(versions_dir, keep_dirs, keep=DEFAULT_KEEP_VERSIONS):
+    """Delete all but the newest keep version directories, never one of keep_dirs."""
+    keep_dirs = set(os.path.abspath(d) for d in keep_dirs if d)
+    with file_lock(versions_dir):
+        candidates = [os.path.join(versions_dir, name) for name in os.listdir(versions_dir)
+                      if not name.startswith('.') and os.path.isdir(os.path.join(versions_dir, name))]
+        candidates.sort(key=os.path.getmtime, reverse=True)
+        for path in candidates[keep:]:
+            # Workers still mapping the files keep reading them after the unlink
+            if os.path.abspath(path) not in keep_dirs:
+                shutil.rmtree(path, ignore_errors=True)
+
+
+class ModelVersions(object):
+    """
+    The active model and the one it replaced. loader(model_dir) returns a model dict; the dicts are
+    never modified after activation, so a request holding one is unaffected by a swap.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.active = None
+        self.previous = None
+        self.swaps = 0
+        self.swapped_at = None
+        self.locks_pid = None
+
+    def _locks(self):
+        """
+        (lock, load_lock) of this process. Created on first use in each process rather than inherited from
+        the gunicorn master that preloaded the model: the gevent worker monkey-patches threading after the
+        fork, and an unpatched load_lock held across a background load would block the whole worker.
+        """
+        if self.locks_pid != os.getpid():
+            self._lock, self._load_lock = threading.Lock(), threading.Lock()
+            self.locks_pid = os.getpid()
+        return self._lock, self._load_lock
+
+    @property
+    def lock(self):
+        return self._locks()[0]
+
+    @property
+    def load_lock(self):
+        return self._locks()[1]
+
+    def activate(self, model):
+        with self.lock:
+            self.previous, self.active = self.active, model
+            self.swaps += 1
+            self.swapped_at = time.time()
+
+    def load(self, model_dir, version=None):
+        """Load the model in model_dir, in the background under gevent, labelled with version."""
+        model = run_blocking(self.loader, model_dir)
+        model['model_dir'] = model_dir
+        if version is not None:
+            model['version'] = str(version)
+        return model
+
+    def switch_to(self, version, model_dir):
+        """Make version active, from the previous model if it is that version. False if already active."""
+        with self.load_lock:
+            active, previous = self.active, self.previous
+            if active is not None and active['version'] == version:
+                return False
+            if previous is not None and previous['version'] == version:
+                self.activate(previous)
+                return True
+            self.activate(self.load(model_dir, version))
+            return True
+
+    def rollback(self):
+        """Swap the previous model back in. Returns the now active model."""
+        with self.load_lock:
+            if self.previous is None:
+                raise NoPreviousVersion('No previous model version is loaded')
+            self.activate(self.previous)
+            return self.active
+
+    def describe(self):
+        active, previous = self.active, self.previous
+        return {
+            'model_version': active['version'] if active is not None else None,
+            'previous_version': previous['version'] if previous is not None else None,
+            'swaps': self.swaps,
+            'swapped_at': self.swapped_at,
+            'load_seconds': round(active.get('load_seconds', 0.0), 3) if active is not None else None,
+        }
+
+
+class ModelWatcher(object):
+    """Polls the remote and the local marker and switches versions to follow them."""
+
+    def __init__(self, versions, versions_dir=DEFAULT_VERSIONS_DIR, marker_uri=None,
+                 poll_seconds=DEFAULT_POLL_SECONDS, keep=DEFAULT_KEEP_VERSIONS, model_uri_prefixes=()):
+        self.versions = versions
+        self.versions_dir = versions_dir
+        self.marker_uri = marker_uri
+        self.model_uri_prefixes = list(model_uri_prefixes)
+        self.poll_seconds = poll_seconds
+        self.keep = keep
+        self.local_marker = os.path.join(versions_dir, ACTIVE_MARKER_FILE)
+        self.remote_etag = None
+        self.local_etag = None
+        self.errors = 0
+        self.last_error = None
+        self.thread = None
+
+    def start(self):
+        if self.poll_seconds <= 0:
+            return self
+        self.thread = threading.Thread(target=self._run, name='model-watcher')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            try:
+                self.check()
+            except Exception as e:
+                self.errors += 1
+                self.last_error = '{}: {}'.format(type(e).__name__, e)
+                traceback.print_exc()
+            time.sleep(self.poll_seconds)
+
+    def check_model_uri(self, model_uri):
+        """Raise ModelUriNotAllowed unless model_uri lies under one of the model_uri_prefixes."""
+        if model_uri.startswith('s3://'):
+            allowed = '/../' not in model_uri + '/' and any(model_uri.startswith(p) for p in self.model_uri_prefixes)
+        else:
+            path = os.path.realpath(model_uri)
+            allowed = any(p and not p.startswith('s3://') and
+                          (path + os.sep).startswith(os.path.join(os.path.realpath(p), ''))
+                          for p in self.model_uri_prefixes)
+        if not allowed:
+            raise ModelUriNotAllowed('model_uri {} is not under MODEL_URI_PREFIXES'.format(model_uri))
+
+    def publish(self, version, model_uri):
+        """Fetch version for this instance and point the local marker at it."""
+        model_dir = run_blocking(fetch_artifacts, model_uri, self.versions_dir, version)
+        write_marker(self.local_marker, {'version': version, 'model_dir': model_dir})
+        return model_dir
+
+    def check(self):
+        """One poll. Returns True if this worker switched versions."""
+        if self.marker_uri:
+            marker, self.remote_etag = read_marker(self.marker_uri, self.remote_etag)
+            if marker is not None:
+                local, _ = read_marker(self.local_marker)
+                current = local.get('version') if local is not None else \
+                    (self.versions.active or {}).get('version')
+                if current != str(marker['version']):
+                    self.publish(str(marker['version']), marker['model_uri'])
+
+        marker, etag = read_marker(self.local_marker, self.local_etag)
+        if marker is None:
+            return False
+        switched = self.versions.switch_to(str(marker['version']), marker['model_dir'])
+        # Recorded only once switched, so a failed load is retried at the next poll
+        self.local_etag = etag
+        if switched:
+            active, previous = self.versions.active, self.versions.previous
+            run_blocking(prune_versions, self.versions_dir,
+                         [active.get('model_dir'), previous and previous.get('model_dir')],
+                         self.keep)
+        return switched
+
+    def record(self, model):
+        """Point the local marker at a model this worker switched to, for the other workers to follow."""
+        write_marker(self.local_marker, {'version': model['version'], 'model_dir': model['model_dir']})
+        self.local_etag = read_marker(self.local_marker)[1]
+
+
+def create_watcher_from_env(versions):
+    """
+    MODEL_HOT_SWAP             true, or false (default): serve only the model the container started with
+    MODEL_VERSION_MARKER_URI   s3:// URI (or local path) of the version marker, default none: only the
+                               admin routes change versions
+    MODEL_VERSIONS_DIR         where fetched versions and the local marker live, default /tmp/model-versions
+    MODEL_RELOAD_POLL_SECONDS  marker poll interval, default 30; 0 stops polling (admin routes only)
+    MODEL_VERSIONS_KEEP        version directories kept on disk, default 3
+    MODEL_URI_PREFIXES         comma-separated s3:// prefixes (or local directories) a reload from the admin
+                               routes may load a model_uri from, default none: only the marker is re-read
+    """
+    if os.environ.get('MODEL_HOT_SWAP', 'false').lower() != 'true':
+        return None
+    poll_seconds = float(os.environ.get('MODEL_RELOAD_POLL_SECONDS', DEFAULT_POLL_SECONDS))
+    return ModelWatcher(versions,
+                        versions_dir=os.environ.get('MODEL_VERSIONS_DIR', DEFAULT_VERSIONS_DIR),
+                        marker_uri=os.environ.get('MODEL_VERSION_MARKER_URI') or None,
+                        poll_seconds=poll_seconds,
+                        keep=int(os.environ.get('MODEL_VERSIONS_KEEP', DEFAULT_KEEP_VERSIONS)),
+                        model_uri_prefixes=[p.strip() for p in os.environ.get('MODEL_URI_PREFIXES', '').split(',')
+                                            if p.strip()])
@@ -0,0 +1,127 @@
+# Re-ranks ANN candidates by mutual preference.
+#
+# The Annoy search only answers "who does this user prefer". A reciprocal recommender should also ask
+# whether each candidate would prefer the user back. Skip-gram learns two vectors per user: the
+# preference vector (the center embedding, what the user likes, which the ANN indexes are built over)
+# and the item vector (the context embedding, how the user is seen by the users who like them, saved as
+# item_vectors.npy by model_store). For the K candidates returned by the index we gather the candidates'
+# preference vectors and score both directions:
+#
+#   forward   similarity of the user's preference vector to the candidate (from the ANN distances)
+#   backward  cosine of the candidate's preference vector with the user's item vector
+#
+# and rank by the harmonic mean of the two, so a candidate only ranks high if both directions agree.
+# Scoring the backward direction with the user's preference vector instead would only repeat the forward
+# score, so models without item vectors cannot be re-ranked. New users have no item vector of their own;
+# item_side_model lets new_user_recommender derive one the way it derives their preference vector.
+# Everything after the ANN call is vectorized over contiguous float32 matrices.
+
+from __future__ import print_function
+
+import time
+
+import numpy as np
+
+DEFAULT_CANDIDATES = 500
+EPSILON = 1e-6
+
+
+def ann_similarity(distances, metric):
+    """Convert Annoy distances into similarities in [0, 1]."""
+    distances = np.asarray(distances, dtype=np.float32)
+    if metric == 'angular':
+        # Annoy's angular distance is sqrt(2 - 2 cos)
+        cosine = 1.0 - np.square(distances) / 2.0
+        return (cosine + 1.0) / 2.0
+    if metric == 'dot':
+        return 1.0 / (1.0 + np.exp(-distances))
+    return 1.0 / (1.0 + distances)
+
+
+def cosine_to(matrix, vector):
+    """Cosine similarity of every row of matrix with vector, mapped to [0, 1]."""
+    vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+    norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(vector) + EPSILON) + EPSILON
+    return (matrix.dot(vector) / norms + 1.0) / 2.0
+
+
+def harmonic_mean(forward, backward):
+    return 2.0 * forward * backward / (forward + backward + EPSILON)
+
+
+def has_item_vectors(rec_model):
+    """True if the model can be re-ranked, i.e. it was saved with item vectors."""
+    return rec_model.get('item_vectors') is not None
+
+
+def item_side_model(rec_model):
+    """
+    The model with its item vectors in place of the preference vectors. Passed to
+    new_user_recommender.generate_new_preferences, it returns a new user's item vector, derived from the
+    same registered users as their preference vector.
+    """
+    return dict(rec_model, preference_vectors=rec_model['item_vectors'])
+
+
+def rerank(user_id, preference_vector, item_vector, rec_model, top_n, candidates=DEFAULT_CANDIDATES,
+           budget_ms=None):
+    """
+    Over-fetch candidates from the model's default ANN index and return the top_n by mutual score.
+
+    Args:
+        user_id (str): The querying user, excluded from the results
+        preference_vector (array): The user's preference vector, used for the ANN search
+        item_vector (array): The user's item vector (see item_side_model for new users), scored against
+            the candidates' preference vectors for the backward direction
+        rec_model (dict): The model loaded by model_store.load_model
+        top_n (int): Number of recommendations to return
+        candidates (int): Number of ANN candidates to re-rank
+        budget_ms (float): Latency budget of the whole stage, reported in the timings
+
+    Returns:
+        dict with user_id, recommendation_id (comma-separated, like generate_recommendations),
+        the mutual scores and per-stage timings in milliseconds
+    """
+    timings = {}
+    start = time.time()
+    preference_vector = np.ascontiguousarray(preference_vector, dtype=np.float32).reshape(-1)
+    if item_vector is None or not has_item_vectors(rec_model):
+        raise ValueError('Reciprocal re-ranking needs the item vectors of the users')
+
+    # Stage 1: over-fetch from the ANN index
+    rows, distances = rec_model['index'].get_nns_by_vector(preference_vector, candidates + 1,
+                                                            include_distances=True)
+    rows = np.asarray(rows, dtype=np.int64)
+    retrieved = time.time()
+    timings['retrieve_ms'] = (retrieved - start) * 1000.0
+
+    # Stage 2: gather the candidates' preference vectors into one contiguous matrix
+    candidate_ids = np.take(rec_model['user_ids'], rows)
+    candidate_preferences = np.ascontiguousarray(np.take(rec_model['preference_vectors'], rows, axis=0),
+                                                 dtype=np.float32)
+    gathered = time.time()
+    timings['gather_ms'] = (gathered - retrieved) * 1000.0
+
+    # Stage 3: score both directions and keep the top_n
+    forward = ann_similarity(distances, rec_model.get('metric', 'angular'))
+    backward = cosine_to(candidate_preferences, item_vector)
+    scores = harmonic_mean(forward, backward)
+    scores[candidate_ids.astype(str) == str(user_id)] = -1.0
+
+    n = min(top_n, len(scores))
+    top = np.argpartition(-scores, n - 1)[:n] if n > 0 else np.array([], dtype=np.int64)
+    top = top[np.argsort(-scores[top], kind='mergesort')]
+    top = top[scores[top] >= 0]
+    scored = time.time()
+    timings['score_ms'] = (scored - gathered) * 1000.0
+    timings['total_ms'] = (scored - start) * 1000.0
+    if budget_ms is not None:
+        timings['budget_ms'] = budget_ms
+        timings['within_budget'] = timings['total_ms'] <= budget_ms
+
+    return {
+        'user_id': user_id,
+        'recommendation_id': ','.join(str(i) for i in candidate_ids[top]),
+        'scores': [round(float(s), 6) for s in scores[top]],
+        'timings': timings,
+    }
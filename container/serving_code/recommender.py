@@ -1,46 +1,146 @@
-# Implements a flask server to do inference for a single user
+# Implements a flask server to do inference for a single user or a batch of users
 
 from __future__ import print_function
 
+# Only what the serving path uses is imported here: every gunicorn worker (or, with --preload, the master)
+# pays for these imports before the first /ping. pandas is not needed to serve, pyarrow and annoy are
+# imported by model_store and ann_index when a model is loaded, and boto3 by model_versions when it
+# reads from S3. benchmarks/bench_startup.py reports the import time.
 import os
 import json
-import pickle
-import sys
-import signal
+import time
 import traceback
+import multiprocessing
 import new_user_recommender
+import model_store
+import model_versions
+import result_cache
+import reciprocal_scoring
+import serving_metrics
 
 import flask
 
-import pandas as pd
-
-
-import random, itertools, gzip, math, json
 import numpy as np
-import annoy
 
 prefix = '/opt/ml/'
-model_path = os.path.join(prefix, 'model')
+# Where SageMaker extracts the model artifacts; MODEL_PATH points a local server at another directory
+model_path = os.environ.get('MODEL_PATH', os.path.join(prefix, 'model'))
+
+# Memory-map the model artifacts rather than copying them into every worker's heap
+model_mmap = os.environ.get('MODEL_SERVER_MMAP', 'true').lower() == 'true'
+
+# ANN backend the default index is served from: annoy, exact or int8 (see ann_index)
+ann_backend = os.environ.get('ANN_BACKEND', model_store.DEFAULT_BACKEND)
+
+# Batched invocations: largest accepted batch and number of threads running the ANN queries
+max_batch_size = int(os.environ.get('MODEL_SERVER_MAX_BATCH', 1000))
+ann_threads = int(os.environ.get('MODEL_SERVER_ANN_THREADS', min(4, multiprocessing.cpu_count())))
+
+JSON_LINES_CONTENT_TYPES = ('application/jsonlines', 'application/x-jsonlines', 'application/json-lines')
+
+# Search the per-segment indexes picked from the request fields, when the model has them
+segment_search = os.environ.get('SEGMENT_INDEX', 'true').lower() == 'true'
+
+# Reciprocal re-ranking of the ANN candidates: on/off, candidates over-fetched, latency budget of the stage.
+# Only models saved with item vectors can be re-ranked; others are served without it.
+reciprocal_rerank = os.environ.get('RECIPROCAL_RERANK', 'false').lower() == 'true'
+rerank_candidates = int(os.environ.get('RECIPROCAL_RERANK_CANDIDATES', reciprocal_scoring.DEFAULT_CANDIDATES))
+rerank_budget_ms = float(os.environ.get('RECIPROCAL_RERANK_BUDGET_MS', 20))
+
+# Model admin commands (reload, rollback) on /admin/* and, since SageMaker only forwards /invocations and
+# /ping, on /invocations with ADMIN_CONTENT_TYPE. Off by default: anyone who can invoke the endpoint could
+# use them. Hot swapping itself, and the model_uri a reload may name (MODEL_URI_PREFIXES), are configured
+# in model_versions.
+model_admin = os.environ.get('MODEL_ADMIN', 'false').lower() == 'true'
+ADMIN_CONTENT_TYPE = 'application/x-model-admin+json'
+
+# Per-stage timers of the serving path, reported on /metrics. Created at import so that with --preload
+# the counts of all the workers are shared (see serving_metrics)
+metrics = serving_metrics.create_metrics_from_env()
+
+# Width of the birth year buckets new users are grouped by in the result cache key
+cache_age_bucket_years = int(os.environ.get('RESULT_CACHE_AGE_BUCKET_YEARS', result_cache.DEFAULT_AGE_BUCKET_YEARS))
+
+def load_model(model_dir):
+    return model_store.load_model(model_dir, mmap=model_mmap, backend=ann_backend)
+
 
 # A singleton for holding the model. This simply loads the model and holds it.
 # It has a recommend function that does a prediction based on the model and the input data.
 
 class RecommendationService(object):
-    model = None                # Where we keep the model when it's loaded
+    # The active model and the one it replaced, see model_versions. Every request reads the active
+    # model once and uses it throughout, so a swap takes effect between requests.
+    versions = model_versions.ModelVersions(load_model)
+    watcher = None              # Follows the model version marker, started in each worker
+    watcher_pid = None
+    ann_pool = None             # Thread pool for the ANN queries of a batch, created on first use
+    # Created at import so that with --preload a shared cache is inherited by all the workers
+    cache = result_cache.create_cache_from_env()
 
     @classmethod
     def get_model(cls):
-        """Get the model object for this instance, loading it if it's not already loaded."""
-        if cls.model == None:
-            cls.model = {}
-            
-            # Load preferences_vectors
-            
-            # Load profiles
-
-            # Load annoy indexes
-           
-        return cls.model
+        """Get the active model for this instance, loading it if it's not already loaded."""
+        model = cls.versions.active
+        if model is None:
+            model = load_model(model_path)
+            model['model_dir'] = model_path
+            cls.versions.activate(model)
+        return model
+
+    @classmethod
+    def is_loaded(cls):
+        """True once get_model has finished loading, e.g. in the gunicorn master with --preload."""
+        return cls.versions.active is not None
+
+    @classmethod
+    def get_watcher(cls):
+        """
+        The model watcher of this process, started on the first request a worker serves: threads do not
+        survive the fork, and the gunicorn master (which loads the model with --preload) serves none.
+        """
+        if cls.watcher_pid != os.getpid():
+            cls.watcher_pid = os.getpid()
+            cls.watcher = model_versions.create_watcher_from_env(cls.versions)
+            if cls.watcher is not None:
+                cls.watcher.start()
+        return cls.watcher
+
+    @classmethod
+    def reload(cls, version=None, model_uri=None):
+        """
+        Switch this worker to model_uri (labelled version), or to the version marker's current version.
+        The instance's other workers follow within a poll interval.
+        """
+        watcher = cls.get_watcher()
+        if watcher is None:
+            raise model_versions.HotSwapDisabled('Model hot swapping is disabled (MODEL_HOT_SWAP)')
+        cls.get_model()
+        if model_uri:
+            watcher.check_model_uri(model_uri)
+            version = str(version or int(time.time()))
+            watcher.publish(version, model_uri)
+        else:
+            # Read the remote marker even if it looks unchanged
+            watcher.remote_etag = None
+        watcher.check()
+        return cls.versions.describe()
+
+    @classmethod
+    def rollback(cls):
+        """Switch this worker back to the previous version; the other workers follow."""
+        watcher = cls.get_watcher()
+        if watcher is None:
+            raise model_versions.HotSwapDisabled('Model hot swapping is disabled (MODEL_HOT_SWAP)')
+        watcher.record(cls.versions.rollback())
+        return cls.versions.describe()
+
+    @staticmethod
+    def with_version(recommendations, rec_model):
+        """A response with the version of the model that produced it; cached entries stay unchanged."""
+        response = dict(recommendations)
+        response['model_version'] = rec_model['version']
+        return response
 
     @classmethod
     def recommend(cls, rec_input):
@@ -51,48 +151,316 @@ class RecommendationService(object):
             input (json_file): The data on which to do the predictions
         """
         rec_model = cls.get_model()
-        
-        preference_vectors = new_user_recommender.generate_new_preferences(rec_input['user_id'], rec_input['gender'], rec_input['locationId'], rec_input['birthdate'], rec_input['followingCategories'], rec_model)
-        recommendations = new_user_recommender.generate_recommendations(rec_input['user_id'], preference_vectors, rec_model, 100)            
+        metrics.increment('users')
+
+        with metrics.timer('cache'):
+            cached = cls.get_cached(rec_input, rec_model)
+        if cached is not None:
+            metrics.increment('cache_hits')
+            return cls.with_version(cached, rec_model)
+        metrics.increment('cache_misses')
+
+        request_model = cls.model_for(rec_input, rec_model)
+        with metrics.timer('preferences'):
+            preference_vectors = new_user_recommender.generate_new_preferences(rec_input['user_id'], rec_input['gender'], rec_input['locationId'], rec_input['birthdate'], rec_input['followingCategories'], request_model)
+            item_vector = cls.generate_item_vector(rec_input, request_model)
+        with metrics.timer('ann'):
+            recommendations = cls.generate_recommendations(rec_input['user_id'], preference_vectors, request_model, 100,
+                                                           item_vector)
+
+        cls.put_cached(rec_input, rec_model, recommendations)
+        return cls.with_version(recommendations, rec_model)
+
+    @staticmethod
+    def reranks(rec_model):
+        return reciprocal_rerank and reciprocal_scoring.has_item_vectors(rec_model)
 
-        return recommendations
+    @classmethod
+    def generate_item_vector(cls, rec_input, rec_model):
+        """The new user's item vector for the reciprocal re-rank, or None when the model is not re-ranked."""
+        if not cls.reranks(rec_model):
+            return None
+        return new_user_recommender.generate_new_preferences(
+            rec_input['user_id'], rec_input['gender'], rec_input['locationId'], rec_input['birthdate'],
+            rec_input['followingCategories'], reciprocal_scoring.item_side_model(rec_model))
+
+    @classmethod
+    def generate_recommendations(cls, user_id, preference_vectors, rec_model, top_n, item_vector=None):
+        """Retrieve the top_n recommendations, re-ranked by mutual preference if enabled."""
+        if item_vector is not None and cls.reranks(rec_model):
+            return reciprocal_scoring.rerank(user_id, preference_vectors, item_vector, rec_model, top_n,
+                                             candidates=max(rerank_candidates, top_n), budget_ms=rerank_budget_ms)
+        return new_user_recommender.generate_recommendations(user_id, preference_vectors, rec_model, top_n)
+
+    @classmethod
+    def model_for(cls, rec_input, rec_model):
+        """
+        The model as seen by one request. If the model has segment indexes, its default index is
+        replaced by a view over the shards selected by the request's gender and locationId.
+        """
+        if not segment_search or rec_model.get('segments') is None:
+            return rec_model
+        request_model = dict(rec_model)
+        request_model['index'] = rec_model['segments'].view(rec_input)
+        return request_model
+
+    @classmethod
+    def get_cached(cls, rec_input, rec_model):
+        """Cached recommendations for users with the same features, re-personalized for this user."""
+        if cls.cache is None:
+            return None
+        cached = cls.cache.get(result_cache.feature_key(rec_input, cache_age_bucket_years), rec_model['version'])
+        if cached is None:
+            return None
+        return result_cache.personalize(cached, rec_input['user_id'])
+
+    @classmethod
+    def put_cached(cls, rec_input, rec_model, recommendations):
+        """Cache the recommendations without the re-rank's timings, which only describe this request."""
+        if cls.cache is not None:
+            entry = dict((k, v) for k, v in recommendations.items() if k != 'timings')
+            cls.cache.put(result_cache.feature_key(rec_input, cache_age_bucket_years), rec_model['version'], entry)
+
+    @classmethod
+    def get_ann_pool(cls):
+        """
+        Get the pool the ANN queries of a batch run on. Annoy releases the GIL while searching, so the
+        queries run in parallel on native threads. Under the gevent worker the threading module is
+        monkey-patched into greenlets, so gevent's own pool of real threads is used instead.
+        """
+        if cls.ann_pool is None:
+            try:
+                from gevent import monkey
+                patched = monkey.is_module_patched('threading')
+            except ImportError:
+                patched = False
+
+            if patched:
+                from gevent.threadpool import ThreadPool
+                cls.ann_pool = ThreadPool(ann_threads)
+            else:
+                from concurrent.futures import ThreadPoolExecutor
+                cls.ann_pool = ThreadPoolExecutor(max_workers=ann_threads)
+        return cls.ann_pool
+
+    @classmethod
+    def recommend_batch(cls, rec_inputs):
+        """
+        Generate the recommendations for a list of inputs and return them in input order.
+
+        Users found in the result cache are answered from it. For the others, users with the same
+        features get the same preference vector, so each distinct feature set is generated once. As in
+        recommend, each user's vectors and query use the model as seen by its request (model_for). The
+        vectors are stacked into a single float32 matrix and the ANN queries for its rows run in parallel.
+
+        Args:
+            rec_inputs (list): The user dicts, each with the fields expected by recommend
+        """
+        rec_model = cls.get_model()
+        metrics.increment('batches')
+        metrics.increment('users', len(rec_inputs))
+
+        with metrics.timer('cache'):
+            results = [cls.get_cached(rec_input, rec_model) for rec_input in rec_inputs]
+        misses = [i for i, result in enumerate(results) if result is None]
+        metrics.increment('cache_hits', len(rec_inputs) - len(misses))
+        metrics.increment('cache_misses', len(misses))
+        if not misses:
+            return [cls.with_version(result, rec_model) for result in results]
+
+        feature_rows = {}
+        row_of_input = []
+        request_models = []
+        preference_rows = []
+        item_rows = []
+        preferences_start = time.time()
+        for rec_input in (rec_inputs[i] for i in misses):
+            # The segment view depends on gender and locationId only, which are part of the features
+            request_model = cls.model_for(rec_input, rec_model)
+            request_models.append(request_model)
+            features = (rec_input['gender'], rec_input['locationId'], rec_input['birthdate'],
+                        json.dumps(rec_input['followingCategories'], sort_keys=True))
+            if features not in feature_rows:
+                feature_rows[features] = len(preference_rows)
+                preference_rows.append(new_user_recommender.generate_new_preferences(
+                    rec_input['user_id'], rec_input['gender'], rec_input['locationId'], rec_input['birthdate'],
+                    rec_input['followingCategories'], request_model))
+                item_rows.append(cls.generate_item_vector(rec_input, request_model))
+            row_of_input.append(feature_rows[features])
+
+        preference_matrix = np.ascontiguousarray(np.vstack(preference_rows), dtype=np.float32)
+        metrics.observe('preferences', time.time() - preferences_start)
+
+        def query(j):
+            rec_input = rec_inputs[misses[j]]
+            return cls.generate_recommendations(
+                rec_input['user_id'], preference_matrix[row_of_input[j]], request_models[j], 100,
+                item_rows[row_of_input[j]])
+
+        with metrics.timer('ann'):
+            computed = list(cls.get_ann_pool().map(query, range(len(misses))))
+        for i, recommendations in zip(misses, computed):
+            cls.put_cached(rec_inputs[i], rec_model, recommendations)
+            results[i] = recommendations
+        return [cls.with_version(result, rec_model) for result in results]
 
 
 # The flask app for serving predictions
 app = flask.Flask(__name__)
 
+@app.before_request
+def start_request():
+    flask.g.request_start = time.time()
+    RecommendationService.get_watcher()
+
+@app.after_request
+def finish_request(response):
+    """
+    Count the request, time the whole invocation and report the active model version (SageMaker returns
+    the X-Amzn-SageMaker-Custom-Attributes header as the CustomAttributes of the response).
+    """
+    route = flask.request.path.strip('/').split('/')[0]
+    metrics.count_request(route, response.status_code)
+    if route == 'invocations':
+        metrics.observe('invocation', time.time() - flask.g.get('request_start', time.time()))
+    if RecommendationService.is_loaded() and 'X-Model-Version' not in response.headers:
+        version = RecommendationService.versions.active['version']
+        response.headers['X-Model-Version'] = version
+        response.headers['X-Amzn-SageMaker-Custom-Attributes'] = 'model_version={}'.format(version)
+    return response
+
 @app.route('/ping', methods=['GET'])
 def ping():
     """
     Determine if the container is working and healthy. In this sample container, we declare
-    it healthy if we can load the model successfully.
+    it healthy if we can load the model successfully. With preloading the model is loaded before
+    the workers start; otherwise the first ping loads it and only reports healthy once it is done.
     """
-    health = RecommendationService.get_model() is not None  # You can insert a health check here
+    try:
+        RecommendationService.get_model()
+    except Exception:
+        traceback.print_exc()
+    health = RecommendationService.is_loaded()
 
     status = 200 if health else 404
     return flask.Response(response='\n', status=status, mimetype='application/json')
 
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Result cache counters of the worker that serves the request."""
+    cache = RecommendationService.cache
+    cache_stats = cache.stats() if cache is not None else {'type': 'off', 'pid': os.getpid()}
+    if RecommendationService.is_loaded():
+        cache_stats['model_version'] = RecommendationService.get_model()['version']
+    model_stats = RecommendationService.versions.describe()
+    watcher = RecommendationService.watcher
+    if watcher is not None:
+        model_stats.update({'marker_uri': watcher.marker_uri, 'poll_seconds': watcher.poll_seconds,
+                            'watch_errors': watcher.errors, 'last_watch_error': watcher.last_error})
+    return flask.Response(response=json.dumps({'result_cache': cache_stats, 'model': model_stats}), status=200,
+                          mimetype='application/json')
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Per-stage latency histograms and request counters of all the workers, in the Prometheus text format."""
+    info = {'version': RecommendationService.versions.active['version']} if RecommendationService.is_loaded() else None
+    return flask.Response(response=metrics.render(info), status=200, mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/reload', methods=['POST'])
+def admin_reload():
+    """
+    Load a model version and swap it in. The JSON body may give {"model_uri": ..., "version": ...}; without
+    it the version marker is read again.
+    """
+    return _admin('reload', _admin_body())
+
+@app.route('/admin/rollback', methods=['POST'])
+def admin_rollback():
+    """Swap the previous model version back in."""
+    return _admin('rollback', _admin_body())
+
+def _admin_body():
+    body = flask.request.data.decode('utf-8').strip()
+    return json.loads(body) if body else {}
+
+def _admin(action, body):
+    """Run an admin command and report the model versions, with the new version in the response headers."""
+    if not model_admin:
+        return flask.Response(response='Model admin commands are disabled', status=403, mimetype='text/plain')
+    try:
+        if action == 'reload':
+            state = RecommendationService.reload(body.get('version'), body.get('model_uri'))
+        elif action == 'rollback':
+            state = RecommendationService.rollback()
+        else:
+            return flask.Response(response='Unknown admin action {}'.format(action), status=400, mimetype='text/plain')
+    except model_versions.ModelUriNotAllowed as e:
+        return flask.Response(response=str(e), status=403, mimetype='text/plain')
+    except (model_versions.NoPreviousVersion, model_versions.HotSwapDisabled) as e:
+        return flask.Response(response=str(e), status=409, mimetype='text/plain')
+    except Exception as e:
+        traceback.print_exc()
+        return flask.Response(response='{} failed: {}'.format(action, e), status=500, mimetype='text/plain')
+    return flask.Response(response=json.dumps(state), status=200, mimetype='application/json')
+
 @app.route('/invocations', methods=['POST'])
 def transformation():
     """
-    Do inference on a single new user. In this server, we take user data as json, convert
-    it to python dict for internal use and then convert the recommendations back to JSON.
+    Do inference on a single new user or a batch of new users. In this server, we take user data as
+    json, convert it to python dict for internal use and then convert the recommendations back to JSON.
+
+    A JSON object is a single user and gets a JSON object back. A JSON array, or a JSON-lines body with
+    one user per line, is a batch and gets an array (or JSON lines) back in the same order.
     """
     data = None
+    content_type = (flask.request.content_type or '').split(';')[0].strip()
 
     # Convert from JSON to dict
-    if flask.request.content_type == 'application/json':
+    decode_start = time.time()
+    if content_type == 'application/json':
         data = flask.request.data.decode('utf-8')
-        data = json.loads(data)
-        # print(data)
+        try:
+            data = json.loads(data)
+        except ValueError:
+            # Several JSON documents, one per line
+            data = _parse_json_lines(data)
+            content_type = JSON_LINES_CONTENT_TYPES[0]
+        metrics.observe('decode', time.time() - decode_start)
+    elif content_type in JSON_LINES_CONTENT_TYPES:
+        data = _parse_json_lines(flask.request.data.decode('utf-8'))
+        metrics.observe('decode', time.time() - decode_start)
+    elif content_type == ADMIN_CONTENT_TYPE:
+        body = _admin_body()
+        return _admin(body.get('action'), body)
     else:
         return flask.Response(response='This predictor only supports JSON data', status=415, mimetype='text/plain')
 
-    # Generate recommendations
-    recommendations = RecommendationService.recommend(data)
+    if not isinstance(data, list):
+        # Generate recommendations
+        recommendations = RecommendationService.recommend(data)
+
+        # Convert to JSON
+        with metrics.timer('encode'):
+            recommendations_json = json.dumps(recommendations)
+
+        return flask.Response(response=recommendations_json, status=200, mimetype='application/json')
+
+    if len(data) > max_batch_size:
+        return flask.Response(response='Batch of {} users exceeds the limit of {}'.format(len(data), max_batch_size),
+                              status=413, mimetype='text/plain')
+
+    # Generate recommendations for the whole batch, in input order
+    recommendations = RecommendationService.recommend_batch(data) if data else []
+
+    with metrics.timer('encode'):
+        if content_type in JSON_LINES_CONTENT_TYPES:
+            recommendations_json = '\n'.join(json.dumps(r) for r in recommendations)
+        else:
+            recommendations_json = json.dumps(recommendations)
+
+    return flask.Response(response=recommendations_json, status=200, mimetype=content_type)
+
 
-    # Convert to JSON
-    recommendations_json = json.dumps(recommendations)
-    # print(recommendations_json)
-    
-    return flask.Response(response=recommendations_json, status=200, mimetype='application/json')
+def _parse_json_lines(body):
+    """Parse a JSON-lines body into a list of dicts, skipping blank lines."""
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
@@ -0,0 +1,216 @@
+# Caches new-user recommendations by feature signature.
+#
+# Unregistered users with the same (gender, locationId, birth year bucket, followingCategories) get the
+# same preference vector and so the same ANN candidates. The cache key leaves the user_id out; the only
+# per-user step, excluding the user from their own list, is re-applied on every hit.
+#
+# Entries expire after a TTL and whenever the model version changes. Two implementations:
+#   LocalRecommendationCache   LRU in the worker's own memory
+#   SharedRecommendationCache  fixed-size slots in an anonymous shared mmap. Created in the gunicorn
+#                              master (--preload), it is inherited by and shared between all workers.
+
+from __future__ import print_function
+
+import os
+import re
+import json
+import mmap
+import time
+import zlib
+import struct
+import threading
+from collections import OrderedDict
+
+DEFAULT_SIZE = 10000
+DEFAULT_TTL_SECONDS = 3600
+DEFAULT_SLOT_BYTES = 4096
+DEFAULT_AGE_BUCKET_YEARS = 1
+
+_YEAR = re.compile(r'(\d{4})')
+
+
+def birth_bucket(birthdate, bucket_years=DEFAULT_AGE_BUCKET_YEARS):
+    """Bucket a birthdate (a year, 'YYYY-MM-DD' or similar) into bucket_years wide bins."""
+    match = _YEAR.search(str(birthdate))
+    if match is None:
+        return str(birthdate)
+    year = int(match.group(1))
+    return year - year % bucket_years
+
+
+def feature_key(rec_input, bucket_years=DEFAULT_AGE_BUCKET_YEARS):
+    """Canonical cache key for a new-user request; independent of user_id and category order."""
+    categories = rec_input['followingCategories']
+    if isinstance(categories, (list, tuple)):
+        categories = tuple(sorted(str(c) for c in categories))
+    else:
+        categories = (str(categories),)
+    return (str(rec_input['gender']), str(rec_input['locationId']),
+            birth_bucket(rec_input['birthdate'], bucket_years), categories)
+
+
+def personalize(recommendations, user_id):
+    """
+    Copy cached recommendations for user_id, excluding the user from their own list. The re-rank's
+    'scores' are filtered with the ids so that they stay aligned.
+    """
+    result = dict(recommendations)
+    result['user_id'] = user_id
+    rec_ids = result.get('recommendation_id')
+    if isinstance(rec_ids, str):
+        rec_ids = rec_ids.split(',') if rec_ids else []
+    if not isinstance(rec_ids, list):
+        return result
+    keep = [str(r) != str(user_id) for r in rec_ids]
+    ids = [r for r, k in zip(rec_ids, keep) if k]
+    result['recommendation_id'] = ','.join(ids) if isinstance(result['recommendation_id'], str) else ids
+    scores = result.get('scores')
+    if isinstance(scores, list) and len(scores) == len(keep):
+        result['scores'] = [score for score, k in zip(scores, keep) if k]
+    return result
+
+
+class LocalRecommendationCache(object):
+    """Bounded LRU cache with a TTL, private to the process."""
+
+    def __init__(self, maxsize=DEFAULT_SIZE, ttl=DEFAULT_TTL_SECONDS):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, entry_version, value = entry
+            if entry_version != version or expires_at < time.time():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, version, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        return {
+            'type': 'local',
+            'pid': os.getpid(),
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'ttl_seconds': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+class SharedRecommendationCache(object):
+    """
+    Direct-mapped cache in an anonymous shared mmap, visible to every process forked after it is created.
+
+    Each slot holds one JSON-encoded entry behind a header of (key hash, expiry, version hash, length,
+    crc32). A key always maps to the same slot, so a new key evicts whatever was there. Writers do not
+    lock across processes; a reader that races a writer sees a crc mismatch and treats it as a miss.
+    Entries that do not fit in a slot are not cached. The counters are per process.
+    """
+
+    HEADER = struct.Struct('<QdIII')
+
+    def __init__(self, slots=DEFAULT_SIZE, ttl=DEFAULT_TTL_SECONDS, slot_bytes=DEFAULT_SLOT_BYTES):
+        self.slots = slots
+        self.ttl = ttl
+        self.slot_bytes = slot_bytes
+        self._buffer = mmap.mmap(-1, slots * slot_bytes)
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = self.oversized = 0
+
+    @staticmethod
+    def _hash(value):
+        return zlib.crc32(repr(value).encode('utf-8'))
+
+    def _slot(self, key):
+        encoded = repr(key).encode('utf-8')
+        key_hash = zlib.crc32(encoded) | (zlib.adler32(encoded) << 32)
+        return key_hash, (key_hash % self.slots) * self.slot_bytes
+
+    def get(self, key, version):
+        key_hash, offset = self._slot(key)
+        header = self.HEADER.unpack_from(self._buffer, offset)
+        slot_hash, expires_at, version_hash, length, crc = header
+        if slot_hash != key_hash or length == 0:
+            self.misses += 1
+            return None
+        if version_hash != self._hash(version) or expires_at < time.time():
+            self.expirations += 1
+            self.misses += 1
+            return None
+        start = offset + self.HEADER.size
+        payload = self._buffer[start:start + length]
+        if zlib.crc32(payload) != crc:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(payload.decode('utf-8'))
+
+    def put(self, key, version, value):
+        payload = json.dumps(value).encode('utf-8')
+        if len(payload) > self.slot_bytes - self.HEADER.size:
+            self.oversized += 1
+            return
+        key_hash, offset = self._slot(key)
+        with self._lock:
+            slot_hash, expires_at, _, length, _ = self.HEADER.unpack_from(self._buffer, offset)
+            if length and slot_hash != key_hash and expires_at >= time.time():
+                self.evictions += 1
+            start = offset + self.HEADER.size
+            self._buffer[start:start + len(payload)] = payload
+            self.HEADER.pack_into(self._buffer, offset, key_hash, time.time() + self.ttl,
+                                  self._hash(version), len(payload), zlib.crc32(payload))
+
+    def stats(self):
+        return {
+            'type': 'shared',
+            'pid': os.getpid(),
+            'slots': self.slots,
+            'slot_bytes': self.slot_bytes,
+            'ttl_seconds': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'oversized': self.oversized,
+        }
+
+
+def create_cache_from_env():
+    """
+    Create the cache configured by the environment, or None if it is disabled.
+
+    RESULT_CACHE              off, local (default) or shared
+    RESULT_CACHE_SIZE         entries (local) or slots (shared), default 10000
+    RESULT_CACHE_TTL          seconds, default 3600
+    RESULT_CACHE_SLOT_BYTES   bytes per slot of the shared cache, default 4096
+    """
+    mode = os.environ.get('RESULT_CACHE', 'local').lower()
+    size = int(os.environ.get('RESULT_CACHE_SIZE', DEFAULT_SIZE))
+    ttl = float(os.environ.get('RESULT_CACHE_TTL', DEFAULT_TTL_SECONDS))
+    if mode == 'off' or size <= 0:
+        return None
+    if mode == 'shared':
+        slot_bytes = int(os.environ.get('RESULT_CACHE_SLOT_BYTES', DEFAULT_SLOT_BYTES))
+        return SharedRecommendationCache(size, ttl, slot_bytes)
+    return LocalRecommendationCache(size, ttl)
@@ -0,0 +1,188 @@
+# ANN indexes partitioned by segment, selected per request from the rec_input fields.
+#
+# Filtering a global top-100 on gender or location throws most of the candidates away and can leave
+# too few results. Instead the users are split into shards by (gender, region), each with its own index,
+# and a request only searches the shards it can be recommended from:
+#
+#   1. the shards of the target genders in the user's own region
+#   2. if those hold fewer than the requested number of candidates, the neighbouring regions' shards,
+#      in the order given by the manifest (or largest first), until the result is full
+#
+# The shards live in <model_dir>/segments, described by segments/segments.json:
+#
+#   {"metric": "angular",
+#    "target_genders": {"M": ["F"], "F": ["M"]},     who each gender is shown; all genders if absent
+#    "regions": {"<locationId>": "<region>"},        the region of a locationId; itself if absent
+#    "neighbors": {"<region>": ["<region>", ...]},   fallback order; by shard size if absent
+#    "shards": {"<gender>|<region>": {"index": "<file>", "rows": "<file>", "gender": ..., "region": ...,
+#                                     "size": n}}}
+#
+# Shard item i is row rows[i] of the model's preference_vectors/user_ids.
+
+from __future__ import print_function
+
+import os
+import json
+
+import numpy as np
+
+import ann_index
+
+SEGMENTS_DIR = 'segments'
+MANIFEST_FILE = 'segments.json'
+DEFAULT_BACKEND = ann_index.AnnoyBackend.kind
+
+
+def shard_key(gender, region):
+    return '{}|{}'.format(gender, region)
+
+
+def build_segment_indexes(model_dir, vectors, genders, location_ids, backend=DEFAULT_BACKEND,
+                          metric=ann_index.DEFAULT_METRIC, regions=None, target_genders=None, neighbors=None,
+                          **build_params):
+    """
+    Build one index per (gender, region) shard and write them with their manifest. Run at training time,
+    by model_store.save_model. Rows without a gender are left out of the shards.
+
+    Args:
+        vectors (array): (n_users, vector_size) vectors the indexes are built over, in model row order
+        genders (array): gender of every row
+        location_ids (array): locationId of every row
+        backend (str): ann_index backend of the shards
+        regions (dict): {locationId: region}; a locationId is its own region if missing
+        target_genders (dict): {gender: [genders recommended to it]}
+        neighbors (dict): {region: [regions to fall back to, nearest first]}
+        build_params: passed to the backend's build, e.g. n_trees
+    """
+    regions = dict((str(k), str(v)) for k, v in (regions or {}).items())
+    segments_dir = os.path.join(model_dir, SEGMENTS_DIR)
+    if not os.path.exists(segments_dir):
+        os.makedirs(segments_dir)
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    known = np.array([g is not None and g == g and str(g) != '' for g in genders], dtype=bool)
+    genders = np.asarray(genders).astype(str)
+    row_regions = np.array([regions.get(str(l), str(l)) for l in location_ids])
+
+    shards = {}
+    for gender in np.unique(genders[known]):
+        for region in np.unique(row_regions[known & (genders == gender)]):
+            rows = np.flatnonzero(known & (genders == gender) & (row_regions == region)).astype(np.int64)
+            key = shard_key(gender, region)
+            basename = 'segment_{}'.format(len(shards))
+            index = ann_index.create_index(backend, vectors.shape[1], metric).build(vectors[rows], **build_params)
+            index.save(os.path.join(segments_dir, basename + index.suffix))
+            np.save(os.path.join(segments_dir, basename + '.rows.npy'), rows)
+            shards[key] = {
+                'index': basename + index.suffix,
+                'rows': basename + '.rows.npy',
+                'gender': str(gender),
+                'region': str(region),
+                'size': int(len(rows)),
+            }
+
+    manifest = {
+        'metric': metric,
+        'target_genders': target_genders or {},
+        'regions': regions,
+        'neighbors': neighbors or {},
+        'shards': shards,
+    }
+    with open(os.path.join(segments_dir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+class SegmentRegistry(object):
+    """The shards of a model and the rules for picking them for a request."""
+
+    def __init__(self, manifest, shards):
+        self.manifest = manifest
+        self.shards = shards            # {key: (index, rows)}
+        self.regions = manifest.get('regions', {})
+        self.target_genders = manifest.get('target_genders', {})
+        self.neighbors = manifest.get('neighbors', {})
+        self.metric = manifest.get('metric', ann_index.DEFAULT_METRIC)
+        self.genders = sorted(set(s['gender'] for s in manifest['shards'].values()))
+
+    @classmethod
+    def load(cls, model_dir, vector_size, mmap=True):
+        """Load the registry of model_dir, or return None if the model has no segment indexes."""
+        segments_dir = os.path.join(model_dir, SEGMENTS_DIR)
+        manifest_path = os.path.join(segments_dir, MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+
+        metric = manifest.get('metric', ann_index.DEFAULT_METRIC)
+        shards = {}
+        for key, shard in manifest['shards'].items():
+            index = ann_index.load_index(os.path.join(segments_dir, shard['index']), vector_size, metric, mmap=mmap)
+            rows = np.load(os.path.join(segments_dir, shard['rows']), mmap_mode='r' if mmap else None)
+            shards[key] = (index, rows)
+        return cls(manifest, shards)
+
+    def shard_tiers(self, rec_input):
+        """Keys of the shards to search for rec_input, as a list of fallback tiers."""
+        targets = self.target_genders.get(str(rec_input['gender']), self.genders)
+        region = self.regions.get(str(rec_input['locationId']), str(rec_input['locationId']))
+        shard_sizes = self.manifest['shards']
+
+        # Own region first, then each listed neighbour, then everything else largest first
+        tiers = [[shard_key(g, region) for g in targets if shard_key(g, region) in self.shards]]
+        for neighbour in self.neighbors.get(region, []):
+            tiers.append([shard_key(g, neighbour) for g in targets if shard_key(g, neighbour) in self.shards])
+        seen = set(key for tier in tiers for key in tier)
+        rest = [k for k in self.shards if k not in seen and shard_sizes[k]['gender'] in targets]
+        tiers.extend([k] for k in sorted(rest, key=lambda k: -shard_sizes[k]['size']))
+        return [tier for tier in tiers if tier]
+
+    def query(self, rec_input, vector, n, search_k=-1):
+        """
+        Return (rows, distances) of the n nearest users the rec_input can be recommended, as model rows.
+
+        The shards of a tier are merged by distance; a later tier only fills the places the earlier
+        ones could not.
+        """
+        rows = []
+        distances = []
+        for tier in self.shard_tiers(rec_input):
+            remaining = n - len(rows)
+            if remaining <= 0:
+                break
+            tier_rows = []
+            tier_distances = []
+            for key in tier:
+                index, shard_rows = self.shards[key]
+                local, shard_distances = index.get_nns_by_vector(vector, remaining, search_k=search_k,
+                                                                  include_distances=True)
+                tier_rows.extend(int(shard_rows[i]) for i in local)
+                tier_distances.extend(shard_distances)
+            # Annoy reports the dot metric as a similarity, larger is nearer
+            sort_keys = -np.asarray(tier_distances) if self.metric == 'dot' else np.asarray(tier_distances)
+            order = np.argsort(sort_keys, kind='mergesort')[:remaining]
+            rows.extend(tier_rows[i] for i in order)
+            distances.extend(tier_distances[i] for i in order)
+        return rows, distances
+
+    def view(self, rec_input):
+        """An index-like object that searches the shards of rec_input, for use as rec_model['index']."""
+        return SegmentView(self, rec_input)
+
+
+class SegmentView(object):
+    """Annoy-compatible get_nns_by_vector over the shards picked for one request."""
+
+    def __init__(self, registry, rec_input):
+        self.registry = registry
+        self.rec_input = rec_input
+
+    def query(self, vector, n, search_k=-1):
+        return self.registry.query(self.rec_input, vector, n, search_k)
+
+    def get_nns_by_vector(self, vector, n, search_k=-1, include_distances=False):
+        rows, distances = self.query(vector, n, search_k)
+        if include_distances:
+            return rows, distances
+        return rows
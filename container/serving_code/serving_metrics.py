@@ -0,0 +1,162 @@
+# Per-stage latency histograms and request counters for the serving path, exposed in the Prometheus text
+# format on /metrics.
+#
+# The stages of an /invocations request:
+#
+#   decode        parsing the JSON (or JSON lines) body
+#   cache         result cache lookups
+#   preferences   generating the new users' preference vectors
+#   ann           the ANN search and re-ranking
+#   encode        serializing the response
+#   invocation    the whole request, decode to encode
+#
+# The counts live in an anonymous shared mmap created at import. With --preload that is in the gunicorn
+# master, so every worker inherits the same mapping and writes its own row of it: /metrics, served by
+# any one worker, reports the sum over all of them without any locking on the hot path. Without
+# --preload every worker creates its own and /metrics reports the worker that served it.
+#
+#   METRICS              on (default) or off
+#   METRICS_MAX_WORKERS  rows, default 64; workers started after that share the last rows
+
+from __future__ import print_function
+
+import os
+import mmap
+import time
+import multiprocessing
+from contextlib import contextmanager
+
+import numpy as np
+
+STAGES = ('decode', 'cache', 'preferences', 'ann', 'encode', 'invocation')
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+ROUTES = ('invocations', 'ping', 'stats', 'metrics', 'admin')
+STATUS_CLASSES = ('2xx', '4xx', '5xx')
+COUNTERS = ('users', 'batches', 'cache_hits', 'cache_misses')
+DEFAULT_MAX_WORKERS = 64
+
+
+class ServingMetrics(object):
+    """Histograms of STAGES and counters, one row per worker process in a shared mapping."""
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        self.max_workers = max_workers
+        n_buckets = len(BUCKETS) + 1
+        # Per row: stage bucket counts, stage sums, request counts by route and status, counters
+        self._layout = [('buckets', (len(STAGES), n_buckets)), ('sums', (len(STAGES),)),
+                        ('requests', (len(ROUTES), len(STATUS_CLASSES))), ('counters', (len(COUNTERS),))]
+        row_values = sum(int(np.prod(shape)) for _, shape in self._layout)
+        self._mmap = mmap.mmap(-1, max(max_workers * row_values * 8, mmap.PAGESIZE))
+        self._table = np.ndarray((max_workers, row_values), dtype=np.float64, buffer=self._mmap)
+        self._next_row = multiprocessing.Value('i', 0)
+        self._row_pid = None
+        self._row = None
+        self._stage_index = dict((name, i) for i, name in enumerate(STAGES))
+        self._route_index = dict((name, i) for i, name in enumerate(ROUTES))
+        self._counter_index = dict((name, i) for i, name in enumerate(COUNTERS))
+        self._bounds = np.array(BUCKETS)
+
+    def _views(self, table):
+        views = {}
+        offset = 0
+        for name, shape in self._layout:
+            size = int(np.prod(shape))
+            views[name] = table[..., offset:offset + size].reshape(table.shape[:-1] + shape)
+            offset += size
+        return views
+
+    def _own_row(self):
+        """This process's row, claimed on first use after the fork."""
+        pid = os.getpid()
+        if self._row_pid != pid:
+            with self._next_row.get_lock():
+                index = min(self._next_row.value, self.max_workers - 1)
+                self._next_row.value += 1
+            self._row = self._views(self._table[index])
+            self._row_pid = pid
+        return self._row
+
+    def observe(self, stage, seconds):
+        row = self._own_row()
+        i = self._stage_index[stage]
+        row['buckets'][i, np.searchsorted(self._bounds, seconds)] += 1
+        row['sums'][i] += seconds
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.time() - start)
+
+    def count_request(self, route, status):
+        row = self._own_row()
+        klass = min(max(int(status) // 100 - 2, 0), len(STATUS_CLASSES) - 1)
+        row['requests'][self._route_index.get(route, self._route_index['invocations']), klass] += 1
+
+    def increment(self, counter, value=1):
+        self._own_row()['counters'][self._counter_index[counter]] += value
+
+    def totals(self):
+        """The sums over all workers' rows."""
+        rows = min(self._next_row.value, self.max_workers)
+        return self._views(self._table[:max(rows, 1)].sum(axis=0))
+
+    def render(self, info=None):
+        """The Prometheus text exposition of the totals, with info as labels of recommender_model_info."""
+        totals = self.totals()
+        lines = ['# HELP recommender_stage_seconds Time spent in each stage of the serving path.',
+                 '# TYPE recommender_stage_seconds histogram']
+        for i, stage in enumerate(STAGES):
+            cumulative = np.cumsum(totals['buckets'][i])
+            for bound, count in zip(BUCKETS, cumulative):
+                lines.append('recommender_stage_seconds_bucket{{stage="{}",le="{}"}} {:.0f}'.format(stage, bound, count))
+            lines.append('recommender_stage_seconds_bucket{{stage="{}",le="+Inf"}} {:.0f}'.format(stage, cumulative[-1]))
+            lines.append('recommender_stage_seconds_sum{{stage="{}"}} {:.6f}'.format(stage, totals['sums'][i]))
+            lines.append('recommender_stage_seconds_count{{stage="{}"}} {:.0f}'.format(stage, cumulative[-1]))
+
+        lines += ['# HELP recommender_requests_total Requests by route and status class.',
+                  '# TYPE recommender_requests_total counter']
+        for i, route in enumerate(ROUTES):
+            for j, klass in enumerate(STATUS_CLASSES):
+                lines.append('recommender_requests_total{{route="{}",status="{}"}} {:.0f}'.format(
+                    route, klass, totals['requests'][i, j]))
+
+        for i, counter in enumerate(COUNTERS):
+            lines += ['# TYPE recommender_{}_total counter'.format(counter),
+                      'recommender_{}_total {:.0f}'.format(counter, totals['counters'][i])]
+
+        lines += ['# TYPE recommender_workers gauge',
+                  'recommender_workers {}'.format(min(self._next_row.value, self.max_workers))]
+        if info:
+            labels = ','.join('{}="{}"'.format(k, str(v).replace('"', '')) for k, v in sorted(info.items()))
+            lines += ['# TYPE recommender_model_info gauge', 'recommender_model_info{{{}}} 1'.format(labels)]
+        return '\n'.join(lines) + '\n'
+
+
+class NullMetrics(object):
+    """Stands in when METRICS=off."""
+
+    @contextmanager
+    def timer(self, stage):
+        yield
+
+    def observe(self, stage, seconds):
+        pass
+
+    def count_request(self, route, status):
+        pass
+
+    def increment(self, counter, value=1):
+        pass
+
+    def render(self, info=None):
+        return ''
+
+
+def create_metrics_from_env():
+    if os.environ.get('METRICS', 'on').lower() == 'off':
+        return NullMetrics()
+    return ServingMetrics(int(os.environ.get('METRICS_MAX_WORKERS', DEFAULT_MAX_WORKERS)))
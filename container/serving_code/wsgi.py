@@ -1,7 +1,28 @@
+import gc
+import os
+import traceback
+
 import recommender as myapp
 
 # This is just a simple wrapper for gunicorn to find your app.
 # If you want to change the algorithm file, simply change "predictor" above to the
 # new file.
 
+# When serve starts gunicorn with --preload this module is imported once in the master process.
+# Loading the model here means every worker is forked with the model already in memory and shares
+# its pages copy-on-write instead of loading its own copy on the first request.
+# get_model only loads the model: no thread is started in the master (the model watcher is started by
+# each worker on its first request). If the load fails the container still starts and the workers load
+# the model lazily, as without --preload, so only the requests fail rather than the whole server.
+if os.environ.get('MODEL_SERVER_PRELOAD', 'true').lower() == 'true':
+    try:
+        myapp.RecommendationService.get_model()
+    except Exception:
+        print('Preloading the model failed, the workers will load it on their first request:')
+        traceback.print_exc()
+    else:
+        # Keep the garbage collector from touching (and so copying) the preloaded objects in the workers
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+
 app = myapp.app
@@ -0,0 +1,201 @@
+# Sharded, multi-process batch inference: the recommendations of every registered user, written as
+# parquet for the Glue job that loads them into DynamoDB.
+#
+# Sharding over instances: every instance of the processing job gets the whole model (the model_data
+# input is FullyReplicated) and scores the users whose crc32(user_id) % instance_count is its own index
+# in /opt/ml/config/resourceconfig.json. The split is stable across model versions and needs no
+# coordination between instances.
+#
+# Within an instance the model is loaded memory-mapped once, before the worker processes are forked, so
+# every worker reads the same page-cache pages of the vectors and the ANN index (as the serving
+# container does with gunicorn --preload). Workers score blocks of users and each writes its own file:
+#
+#   <output>/part-<instance>-<block>.parquet    columns user_id, recommendation_id (comma-separated)
+#
+# Incremental runs (TRAINING_MODE=incremental with previous_model_data mounted) only score the users
+# incremental_training.users_to_rescore selects.
+#
+# With COHORT_TABLE=true the first instance also writes the lists of the common cold-start cohorts to
+# <root>/cohort_table/cohort_table.bin, see cohort_recommendations.py. It is a separate output so the
+# Glue job loading processed_data never reads it.
+#
+# Runs locally against a fake layout with --root, see benchmarks/bench_batch_inference.py.
+
+from __future__ import print_function
+
+import os
+import json
+import glob
+import time
+import zlib
+import argparse
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+import model_store
+import reciprocal_scoring
+import incremental_training
+import cohort_recommendations
+
+PROCESSING_ROOT = '/opt/ml/processing'
+RESOURCE_CONFIG = '/opt/ml/config/resourceconfig.json'
+MODEL_DATA_DIR = 'model_data'
+PREVIOUS_MODEL_DATA_DIR = 'previous_model_data'
+OUTPUT_DIR = 'processed_data'
+COHORT_TABLE_DIR = 'cohort_table'
+DEFAULT_TOP_N = 100
+DEFAULT_BLOCK_SIZE = 2048
+
+# Set in the parent before the pool forks, read by the workers
+_model = None
+_settings = None
+
+
+def instance_shard(resource_config_path=RESOURCE_CONFIG):
+    """(index, count) of this instance among the processing job's hosts; (0, 1) outside SageMaker."""
+    if not os.path.exists(resource_config_path):
+        return 0, 1
+    with open(resource_config_path, 'r') as f:
+        config = json.load(f)
+    hosts = sorted(config['hosts'])
+    return hosts.index(config['current_host']), len(hosts)
+
+
+def shard_rows(user_ids, instance_index, instance_count):
+    """Rows of the users that belong to this instance."""
+    if instance_count <= 1:
+        return np.arange(len(user_ids))
+    hashes = np.fromiter((zlib.crc32(str(u).encode('utf-8')) for u in user_ids), dtype=np.uint64,
+                         count=len(user_ids))
+    return np.flatnonzero(hashes % instance_count == instance_index)
+
+
+def extract_model(input_dir, model_dir):
+    """Unpack the model.tar.gz in input_dir, or use input_dir itself if it already holds the artifacts."""
+    archives = glob.glob(os.path.join(input_dir, '*.tar.gz'))
+    if not archives:
+        return input_dir
+    if not os.path.exists(os.path.join(model_dir, model_store.PREFERENCE_VECTORS_FILE)):
+        model_store.extract_archive(archives[0], model_dir)
+    return model_dir
+
+
+def score_block(block):
+    """Recommendations of the users in one block of model rows, written as one parquet file."""
+    block_id, rows = block
+    vectors = _model['preference_vectors']
+    item_vectors = _model['item_vectors']
+    user_ids = _model['user_ids']
+    top_n = _settings['top_n']
+    recommendations = []
+    for row in rows:
+        user_id = str(user_ids[row])
+        vector = np.asarray(vectors[row], dtype=np.float32)
+        if _settings['rerank']:
+            item_vector = np.asarray(item_vectors[row], dtype=np.float32)
+            result = reciprocal_scoring.rerank(user_id, vector, item_vector, _model, top_n,
+                                               candidates=max(_settings['candidates'], top_n))
+            recommendations.append(result['recommendation_id'])
+        else:
+            # The user is its own nearest neighbour, so fetch one more and drop it
+            nearest = _model['index'].get_nns_by_vector(vector, top_n + 1)
+            ids = [str(user_ids[i]) for i in nearest if i != row][:top_n]
+            recommendations.append(','.join(ids))
+
+    frame = pd.DataFrame({'user_id': [str(user_ids[r]) for r in rows], 'recommendation_id': recommendations})
+    path = os.path.join(_settings['output_dir'], 'part-{:03d}-{:06d}.parquet'.format(
+        _settings['instance_index'], block_id))
+    frame.to_parquet(path, index=False)
+    return len(rows)
+
+
+def select_rows(model, root, training_mode, instance_index, instance_count):
+    rows = shard_rows(model['user_ids'], instance_index, instance_count)
+    previous_dir = os.path.join(root, PREVIOUS_MODEL_DATA_DIR)
+    if training_mode == 'incremental' and os.path.exists(previous_dir):
+        previous_model_dir = extract_model(previous_dir, os.path.join(root, 'previous_model'))
+        previous_ids, previous_vectors = incremental_training.load_vectors(previous_model_dir)
+        rescore_ids, summary = incremental_training.users_to_rescore(
+            previous_ids, previous_vectors, model['user_ids'], model['preference_vectors'], index=model['index'])
+        print('Incremental run: {}'.format(json.dumps(summary)))
+        rows = rows[np.isin(np.asarray(model['user_ids'])[rows], rescore_ids)]
+    return rows
+
+
+def run(root=PROCESSING_ROOT, processes=None, instance_index=None, instance_count=None, top_n=DEFAULT_TOP_N,
+        block_size=DEFAULT_BLOCK_SIZE, rerank=False, candidates=reciprocal_scoring.DEFAULT_CANDIDATES,
+        backend=model_store.DEFAULT_BACKEND, training_mode='full', resource_config=RESOURCE_CONFIG,
+        cohort_table=False):
+    """Score this instance's shard of users. Returns a summary with the users/sec of the scoring."""
+    global _model, _settings
+    start = time.time()
+    if instance_index is None or instance_count is None:
+        instance_index, instance_count = instance_shard(resource_config)
+    processes = processes or multiprocessing.cpu_count()
+
+    model_dir = extract_model(os.path.join(root, MODEL_DATA_DIR), os.path.join(root, 'model'))
+    _model = model_store.load_model(model_dir, mmap=True, backend=backend)
+    if rerank and not reciprocal_scoring.has_item_vectors(_model):
+        print('The model has no item vectors; scoring without the reciprocal re-rank.')
+        rerank = False
+    output_dir = os.path.join(root, OUTPUT_DIR)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    _settings = {'top_n': top_n, 'rerank': rerank, 'candidates': candidates, 'output_dir': output_dir,
+                 'instance_index': instance_index}
+
+    rows = select_rows(_model, root, training_mode, instance_index, instance_count)
+    blocks = list(enumerate(np.array_split(rows, max(1, int(np.ceil(len(rows) / float(block_size)))))))
+    loaded = time.time()
+
+    if processes > 1:
+        # fork, so the workers inherit the memory-mapped model instead of loading it again
+        pool = multiprocessing.get_context('fork').Pool(processes)
+        try:
+            scored = sum(pool.imap_unordered(score_block, blocks))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        scored = sum(score_block(block) for block in blocks)
+
+    elapsed = time.time() - loaded
+    summary = {
+        'instance_index': instance_index,
+        'instance_count': instance_count,
+        'processes': processes,
+        'users': int(scored),
+        'files': len(blocks),
+        'load_seconds': round(loaded - start, 3),
+        'score_seconds': round(elapsed, 3),
+        'users_per_second': round(scored / elapsed, 1) if elapsed > 0 else None,
+    }
+    # The cohorts do not depend on the shard, so one instance builds the whole table
+    if cohort_table and instance_index == 0:
+        summary['cohort_table'] = cohort_recommendations.build(
+            _model, os.path.join(root, COHORT_TABLE_DIR), top_n, processes, rerank=rerank, candidates=candidates,
+            segment_search=os.environ.get('SEGMENT_INDEX', 'true').lower() == 'true')
+    print(json.dumps(summary))
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sharded batch inference')
+    parser.add_argument('--root', default=os.environ.get('PROCESSING_ROOT', PROCESSING_ROOT),
+                        help='Processing directory holding model_data/ and processed_data/')
+    parser.add_argument('--processes', type=int, default=int(os.environ.get('BATCH_PROCESSES', 0)) or None)
+    parser.add_argument('--instance-index', type=int, default=None, help='Overrides resourceconfig.json')
+    parser.add_argument('--instance-count', type=int, default=None, help='Overrides resourceconfig.json')
+    parser.add_argument('--top-n', type=int, default=int(os.environ.get('BATCH_TOP_N', DEFAULT_TOP_N)))
+    parser.add_argument('--block-size', type=int, default=int(os.environ.get('BATCH_BLOCK_SIZE', DEFAULT_BLOCK_SIZE)))
+    parser.add_argument('--backend', default=os.environ.get('ANN_BACKEND', model_store.DEFAULT_BACKEND))
+    args = parser.parse_args()
+
+    run(root=args.root, processes=args.processes, instance_index=args.instance_index,
+        instance_count=args.instance_count, top_n=args.top_n, block_size=args.block_size,
+        rerank=os.environ.get('RECIPROCAL_RERANK', 'false').lower() == 'true',
+        candidates=int(os.environ.get('RECIPROCAL_RERANK_CANDIDATES', reciprocal_scoring.DEFAULT_CANDIDATES)),
+        backend=args.backend, training_mode=os.environ.get('TRAINING_MODE', 'full'),
+        cohort_table=os.environ.get('COHORT_TABLE', 'false').lower() == 'true')
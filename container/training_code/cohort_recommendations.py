@@ -0,0 +1,242 @@
+# Precomputed recommendations of the common cold-start cohorts, for the query Lambda to answer
+# unregistered users without calling the endpoint.
+#
+# A cohort is the (gender, locationId, birth year bucket, top categories) of a user:
+#
+#   birth year bucket   the birth year rounded down to a multiple of bucket_years (5 by default)
+#   top categories      the top_categories (3 by default) of the followed categories that are followed
+#                       by the most registered users, in the order of category_rank
+#
+# The registered users' profiles are grouped by cohort and every cohort with at least min_users members
+# (at most max_cohorts of them, largest first) gets the list the endpoint would return to a new user
+# with the cohort's features: new_user_recommender's preference vector for a representative member's
+# features, searched in the segment index view of the request when the model has one, and re-ranked
+# when RECIPROCAL_RERANK is on, as in recommender.py. Each list has one recommendation more than top_n,
+# so it still holds top_n after the Lambda excludes the user from it.
+#
+# The table is one binary file, read by external_lambda_functions/cohort_table.py:
+#
+#   b'RCOH'                          magic
+#   uint32 little-endian             length of the header
+#   header                           JSON: format, model_version, bucket_years, top_categories,
+#                                    category_rank, list_length, id_width, vocabulary_size and
+#                                    cohorts {"<gender>|<locationId>|<bucket>|<c1,c2,c3>": row}
+#   vocabulary                       the recommended user_ids, id_width bytes each, NUL padded
+#   rows                             list_length uint32 little-endian vocabulary positions per cohort,
+#                                    padded with 0xFFFFFFFF
+#
+# The ids are stored once in the vocabulary and the lists as 4-byte positions into it, so 20000 cohorts
+# of 101 recommendations take about 8 MB.
+
+from __future__ import print_function
+
+import os
+import json
+import time
+import struct
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+import reciprocal_scoring
+
+TABLE_FILE = 'cohort_table.bin'
+MAGIC = b'RCOH'
+FORMAT_VERSION = 1
+NO_ID = 0xFFFFFFFF
+DEFAULT_BUCKET_YEARS = 5
+DEFAULT_TOP_CATEGORIES = 3
+DEFAULT_MIN_USERS = 20
+DEFAULT_MAX_COHORTS = 20000
+
+# Set in the parent before the pool forks, read by the workers
+_model = None
+_settings = None
+
+
+def birth_buckets(birthdates, bucket_years=DEFAULT_BUCKET_YEARS):
+    """The first four-digit year of every birthdate (a year, 'YYYY-MM-DD', ...) rounded down to bucket_years."""
+    text = pd.Series(birthdates).astype(str)
+    years = pd.to_numeric(text.str.extract(r'(\d{4})', expand=False), errors='coerce')
+    buckets = (years - years % bucket_years).astype('Int64').astype(str)
+    # Birthdates without a year are their own bucket, as cohort_table.birth_bucket keeps them
+    return buckets.where(years.notna(), text).values
+
+
+def category_lists(values):
+    """followingCategories as lists of strings; lists, arrays and comma-joined strings are accepted."""
+    lists = []
+    for value in values:
+        if value is None or (isinstance(value, float) and np.isnan(value)):
+            lists.append([])
+        elif isinstance(value, str):
+            lists.append([c.strip() for c in value.split(',') if c.strip()])
+        elif np.ndim(value):
+            lists.append([str(c) for c in value])
+        else:
+            lists.append([str(value)])
+    return lists
+
+
+def rank_categories(lists):
+    """All categories, the most followed first (ties by name)."""
+    counts = pd.Series([c for categories in lists for c in set(categories)], dtype=object).value_counts()
+    return sorted(counts.index, key=lambda c: (-counts[c], c))
+
+
+def top_category_keys(lists, category_rank, top_categories=DEFAULT_TOP_CATEGORIES):
+    """The top_categories of every list by category_rank, comma-joined in name order."""
+    if top_categories <= 0:
+        return [''] * len(lists)
+    rank = dict((c, i) for i, c in enumerate(category_rank))
+    unranked = len(rank)
+    keys = []
+    for categories in lists:
+        top = sorted(set(categories), key=lambda c: (rank.get(c, unranked), c))[:top_categories]
+        keys.append(','.join(sorted(top)))
+    return keys
+
+
+def cohort_frame(profiles, bucket_years=DEFAULT_BUCKET_YEARS, top_categories=DEFAULT_TOP_CATEGORIES):
+    """
+    The cohort key of every profile row. Returns (frame with row, key, categories; category_rank).
+    Models whose profiles have no followingCategories get cohorts without categories.
+    """
+    columns = profiles.column_names if hasattr(profiles, 'column_names') else list(profiles.columns)
+    wanted = [c for c in ('gender', 'locationId', 'birthdate', 'followingCategories') if c in columns]
+    if hasattr(profiles, 'select'):
+        profiles = profiles.select(wanted).to_pandas()
+    profiles = profiles[wanted]
+
+    if 'followingCategories' in profiles.columns:
+        lists = category_lists(profiles['followingCategories'].values)
+    else:
+        lists = [[] for _ in range(len(profiles))]
+        top_categories = 0
+    category_rank = rank_categories(lists) if top_categories > 0 else []
+    categories = top_category_keys(lists, category_rank, top_categories)
+
+    keys = (profiles['gender'].astype(str) + '|' + profiles['locationId'].astype(str) + '|' +
+            pd.Series(birth_buckets(profiles['birthdate'].values, bucket_years), index=profiles.index) + '|' +
+            pd.Series(categories, index=profiles.index))
+    frame = pd.DataFrame({'row': np.arange(len(profiles)), 'key': keys.values, 'categories': categories,
+                          'gender': profiles['gender'].values, 'locationId': profiles['locationId'].values,
+                          'birthdate': profiles['birthdate'].values})
+    return frame, category_rank, top_categories
+
+
+def select_cohorts(frame, min_users=DEFAULT_MIN_USERS, max_cohorts=DEFAULT_MAX_COHORTS):
+    """One representative row per cohort with at least min_users members, the largest max_cohorts."""
+    sizes = frame['key'].value_counts()
+    sizes = sizes[sizes >= min_users].iloc[:max_cohorts]
+    representatives = frame.drop_duplicates('key').set_index('key').loc[sizes.index]
+    representatives['users'] = sizes.values
+    return representatives.reset_index()
+
+
+def score_cohorts(block):
+    """The recommendation lists of one block of cohorts, as (key, ids) pairs."""
+    import new_user_recommender
+    model = _model
+    list_length = _settings['top_n'] + 1
+    lists = []
+    for cohort in block:
+        rec_input = {'user_id': '', 'gender': cohort['gender'], 'locationId': cohort['locationId'],
+                     'birthdate': cohort['birthdate'],
+                     'followingCategories': cohort['categories'].split(',') if cohort['categories'] else []}
+        request_model = model
+        if _settings['segment_search'] and model.get('segments') is not None:
+            request_model = dict(model)
+            request_model['index'] = model['segments'].view(rec_input)
+        vector = new_user_recommender.generate_new_preferences(
+            rec_input['user_id'], rec_input['gender'], rec_input['locationId'], rec_input['birthdate'],
+            rec_input['followingCategories'], request_model)
+        if _settings['rerank']:
+            item_vector = new_user_recommender.generate_new_preferences(
+                rec_input['user_id'], rec_input['gender'], rec_input['locationId'], rec_input['birthdate'],
+                rec_input['followingCategories'], reciprocal_scoring.item_side_model(request_model))
+            result = reciprocal_scoring.rerank(rec_input['user_id'], vector, item_vector, request_model, list_length,
+                                               candidates=max(_settings['candidates'], list_length))
+        else:
+            result = new_user_recommender.generate_recommendations(rec_input['user_id'], vector, request_model,
+                                                                   list_length)
+        ids = result['recommendation_id']
+        lists.append((cohort['key'], ids.split(',') if isinstance(ids, str) else [str(i) for i in ids]))
+    return lists
+
+
+def write_table(path, lists, header):
+    """Write {key: ids} lists in the table format above, with header as extra header fields."""
+    keys = sorted(lists)
+    vocabulary = sorted(set(i for ids in lists.values() for i in ids))
+    positions = dict((i, p) for p, i in enumerate(vocabulary))
+    list_length = max([len(ids) for ids in lists.values()] or [0])
+    id_width = max([len(i.encode('utf-8')) for i in vocabulary] or [1])
+
+    rows = np.full((len(keys), list_length), NO_ID, dtype='<u4')
+    for row, key in enumerate(keys):
+        ids = lists[key]
+        rows[row, :len(ids)] = [positions[i] for i in ids]
+
+    header = dict(header, format=FORMAT_VERSION, list_length=list_length, id_width=id_width,
+                  vocabulary_size=len(vocabulary), cohorts=dict((key, row) for row, key in enumerate(keys)))
+    encoded_header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(encoded_header)))
+        f.write(encoded_header)
+        f.write(b''.join(i.encode('utf-8').ljust(id_width, b'\0') for i in vocabulary))
+        f.write(rows.tobytes())
+    return os.path.getsize(path)
+
+
+def build(model, output_dir, top_n, processes=1, bucket_years=DEFAULT_BUCKET_YEARS,
+          top_categories=DEFAULT_TOP_CATEGORIES, min_users=DEFAULT_MIN_USERS, max_cohorts=DEFAULT_MAX_COHORTS,
+          rerank=False, candidates=reciprocal_scoring.DEFAULT_CANDIDATES, segment_search=True, block_size=256):
+    """Score the common cohorts of model's profiles and write output_dir/TABLE_FILE. Returns a summary."""
+    global _model, _settings
+    start = time.time()
+    if model.get('profiles') is None:
+        print('The model has no profiles, no cohort table is built')
+        return None
+
+    frame, category_rank, top_categories = cohort_frame(model['profiles'], bucket_years, top_categories)
+    cohorts = select_cohorts(frame, min_users, max_cohorts)
+    covered = int(cohorts['users'].sum())
+    records = cohorts[['key', 'gender', 'locationId', 'birthdate', 'categories']].to_dict('records')
+    blocks = [records[i:i + block_size] for i in range(0, len(records), block_size)]
+
+    _model = model
+    _settings = {'top_n': top_n, 'rerank': rerank and reciprocal_scoring.has_item_vectors(model),
+                 'candidates': candidates, 'segment_search': segment_search}
+    if processes > 1 and len(blocks) > 1:
+        # fork, so the workers inherit the memory-mapped model, as for the users' lists
+        pool = multiprocessing.get_context('fork').Pool(processes)
+        try:
+            scored = [pair for pairs in pool.imap_unordered(score_cohorts, blocks) for pair in pairs]
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        scored = [pair for block in blocks for pair in score_cohorts(block)]
+
+    path = os.path.join(output_dir, TABLE_FILE)
+    size = write_table(path, dict(scored), {
+        'model_version': model.get('version'),
+        'created': int(start),
+        'bucket_years': bucket_years,
+        'top_categories': top_categories,
+        'category_rank': category_rank,
+    })
+    summary = {
+        'cohorts': len(scored),
+        'registered_users_covered': round(covered / float(max(len(frame), 1)), 4),
+        'table_bytes': size,
+        'cohort_seconds': round(time.time() - start, 3),
+    }
+    print(json.dumps(summary))
+    return summary
@@ -0,0 +1,158 @@
+# Data-parallel skip-gram with negative sampling on CPU, in numpy.
+#
+# Trains on the pair shards written by streaming_preprocessing.py (pairs/part-*.parquet with center,
+# context, count, and vocab.parquet), read through skipgram_input_pipeline. Every worker holds a full
+# replica of the two embedding matrices and reads its own share of the pair files. After every batch the
+# workers' sparse row gradients are summed with allreduce_sparse and every worker applies the same
+# averaged update, so the replicas never diverge.
+#
+# Run by the train entrypoint with hyperparameter training_script=cpu_skipgram.py, as one process or
+# as a distributed group (see distributed_utils). Rank 0 writes the model in the model_store layout,
+# with the center embeddings as preference vectors and the context embeddings as item vectors, the
+# default Annoy index and, given the users' profiles (--profiles), the profiles and the per-segment
+# indexes (see segment_index; --segment_config holds its regions, target_genders and neighbors).
+
+from __future__ import print_function
+
+import os
+import json
+import argparse
+
+import numpy as np
+
+import ann_index
+import model_store
+import training_metrics
+import distributed_utils
+import incremental_training
+import skipgram_input_pipeline
+
+
+def sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-np.clip(x, -30, 30)))
+
+
+def sgns_gradients(w_in, w_out, centers, contexts, negatives):
+    """Loss and sparse gradients of a batch: (rows of w_in, grads), (rows of w_out, grads)."""
+    v = w_in[centers]                                   # (B, d)
+    u_pos = w_out[contexts]                             # (B, d)
+    u_neg = w_out[negatives]                            # (B, k, d)
+    s_pos = sigmoid(np.einsum('bd,bd->b', v, u_pos))
+    s_neg = sigmoid(np.einsum('bkd,bd->bk', u_neg, v))
+    loss = -np.log(s_pos + 1e-7).sum() - np.log(1.0 - s_neg + 1e-7).sum()
+
+    g_pos = (s_pos - 1.0)[:, None]                      # d loss / d (v . u_pos)
+    g_neg = s_neg[:, :, None]                           # d loss / d (v . u_neg)
+    grad_v = g_pos * u_pos + (g_neg * u_neg).sum(axis=1)
+    grad_out = np.concatenate([g_pos * v, (g_neg * v[:, None, :]).reshape(-1, v.shape[1])])
+    out_rows = np.concatenate([contexts, negatives.ravel()])
+    return float(loss), (centers, grad_v.astype(np.float32)), (out_rows, grad_out.astype(np.float32))
+
+
+def read_profiles(profiles_path, ids):
+    """The profiles under profiles_path (parquet) in the row order of ids; unknown users get empty fields."""
+    import pandas as pd
+    profiles = pd.read_parquet(profiles_path)
+    profiles['user_id'] = profiles['user_id'].astype(str)
+    profiles = profiles.drop_duplicates('user_id').set_index('user_id').reindex(ids)
+    return profiles.rename_axis('user_id').reset_index()
+
+
+def save(model_dir, ids, w_in, w_out, n_trees=10, profiles_path=None, segment_indexes=True, segment_config=None):
+    """Write the model with its default index, and its profiles and segment indexes if profiles are given."""
+    ids = np.asarray(ids).astype(str)
+    index = ann_index.create_index(model_store.DEFAULT_BACKEND, w_in.shape[1]).build(w_in, n_trees=n_trees)
+    profiles = None
+    segments = None
+    if profiles_path and os.path.exists(profiles_path):
+        profiles = read_profiles(profiles_path, ids)
+        if segment_indexes:
+            segments = {'n_trees': n_trees}
+            if segment_config:
+                with open(segment_config, 'r') as f:
+                    segments.update(json.load(f))
+    model_store.save_model(model_dir, w_in, ids, profiles, {model_store.DEFAULT_INDEX_NAME: index},
+                           item_vectors=w_out, segments=segments)
+
+
+def train(pairs_root, model_dir, vector_size=50, epoch_count=5, batch_value=1024, learning_rate=0.025, seed=0,
+          warm_start_dir=None, communicator=None, n_trees=10, profiles_path=None, segment_indexes=True,
+          segment_config=None, **pipeline_options):
+    """Train on the pair shards under pairs_root; pipeline_options go to skipgram_input_pipeline.InputPipeline."""
+    comm = communicator or distributed_utils.get_communicator()
+    pipeline = skipgram_input_pipeline.InputPipeline(pairs_root, batch_value, rank=comm.rank, size=comm.size,
+                                                     seed=seed, **pipeline_options)
+
+    # Identical initial replicas on every worker. Incremental runs start from the previous model and keep
+    # all its users: the rows past the delta's vocabulary are never sampled, so they are saved unchanged
+    if warm_start_dir:
+        ids, w_in, w_out = incremental_training.warm_start_model(warm_start_dir, pipeline.ids, vector_size,
+                                                                 seed=seed)
+    else:
+        ids = pipeline.ids
+        w_in, _ = incremental_training.warm_start_vectors(None, ids.astype(str), vector_size, seed=seed)
+        w_out = np.zeros((len(ids), vector_size), dtype=np.float32)
+    no_batch = (np.empty(0, dtype=np.int64),) * 2 + (np.empty((0, pipeline.negatives), dtype=np.int64),)
+
+    metrics = training_metrics.EpochMetrics()
+    for epoch in range(1, epoch_count + 1):
+        metrics.start_epoch(epoch)
+        batches = iter(pipeline.epoch())
+        epoch_loss = 0.0
+        examples = 0
+        while True:
+            with metrics.data():
+                batch = next(batches, None)
+            # Subsampling makes the workers' batch counts differ; the ones done early send empty
+            # gradients until every worker is done, since all must join every allreduce
+            if comm.size > 1 and not comm.allreduce_max(int(batch is not None)):
+                break
+            if batch is None:
+                if comm.size == 1:
+                    break
+                batch = no_batch
+            centers, contexts, negatives = batch
+            with metrics.compute(examples=len(centers)):
+                loss, (in_rows, in_grads), (out_rows, out_grads) = sgns_gradients(
+                    w_in, w_out, centers, contexts, negatives)
+                in_rows, in_grads = comm.allreduce_sparse(in_rows, in_grads)
+                out_rows, out_grads = comm.allreduce_sparse(out_rows, out_grads)
+                # Averaged over the workers, like a single worker's batch of batch_value * size pairs
+                w_in[in_rows] -= (learning_rate / comm.size) * in_grads
+                w_out[out_rows] -= (learning_rate / comm.size) * out_grads
+                epoch_loss += loss
+                examples += len(centers)
+        totals = comm.allreduce(np.array([epoch_loss, examples, metrics.examples], dtype=np.float64))
+        metrics.examples = totals[2]
+        mean_loss = totals[0] / max(totals[1], 1)
+        if comm.rank == 0:
+            metrics.end_epoch(loss=round(float(mean_loss), 6), workers=comm.size)
+
+    if comm.rank == 0 and model_dir:
+        save(model_dir, ids, w_in, w_out, n_trees, profiles_path, segment_indexes, segment_config)
+    comm.close()
+    return w_in
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Data-parallel skip-gram on CPU')
+    parser.add_argument('--model-dir', required=True)
+    parser.add_argument('--pairs-dir', default=os.path.join('/opt/ml/input/data', 'training'))
+    parser.add_argument('--vector_size', type=int, default=50)
+    parser.add_argument('--epoch_count', type=int, default=5)
+    parser.add_argument('--batch_value', type=int, default=1024)
+    parser.add_argument('--learning_rate', type=float, default=0.025)
+    parser.add_argument('--warm_start_dir', default=None, help='Previous model, for incremental runs')
+    parser.add_argument('--n_trees', type=int, default=10)
+    parser.add_argument('--profiles', default=os.path.join('/opt/ml/input/data', 'profiles'),
+                        help='Parquet file or directory of user_id, gender, locationId, ... profiles')
+    parser.add_argument('--segment_indexes', default='true', help='Build the per-segment indexes (true/false)')
+    parser.add_argument('--segment_config', default=None, help='JSON file of regions, target_genders, neighbors')
+    skipgram_input_pipeline.add_arguments(parser)
+    args, _ = parser.parse_known_args()
+
+    train(args.pairs_dir, args.model_dir, args.vector_size, args.epoch_count, args.batch_value, args.learning_rate,
+          warm_start_dir=args.warm_start_dir, n_trees=args.n_trees, profiles_path=args.profiles,
+          segment_indexes=args.segment_indexes.lower() == 'true', segment_config=args.segment_config, negatives=args.negatives, noise_power=args.noise_power,
+          subsample_threshold=args.subsample_threshold, shuffle_buffer=args.shuffle_buffer,
+          prefetch_batches=args.prefetch_batches, max_pair_repeat=args.max_pair_repeat)
@@ -9,12 +9,17 @@ sm_client = boto3.client('sagemaker')
 
 BASE_PROCESSING_IMAGE = ''
 INPUT_DATA_PATH_MODEL_DATA = '/opt/ml/processing/model_data'
+INPUT_DATA_PATH_PREVIOUS_MODEL_DATA = '/opt/ml/processing/previous_model_data'
 
 PREDICTIONS_DATA_PATH = '/opt/ml/processing/processed_data'
+COHORT_TABLE_PATH = '/opt/ml/processing/cohort_table'
 DEFAULT_VOLUME_SIZE = 100
 DEFAULT_INSTANCE_TYPE = 'ml.m5.12xlarge'
 DEFAULT_INSTANCE_COUNT = 1
-PROCESSING_CODE = '/opt/ml/code/inference_script.py'
+DEFAULT_TRAINING_MODE = 'full'
+DEFAULT_TOP_N = 100
+# Scores each instance's shard of the users with a process pool, see batch_inference.py
+PROCESSING_CODE = '/opt/ml/code/batch_inference.py'
 
 
 def lambda_handler(event, context):
@@ -26,31 +31,62 @@ def lambda_handler(event, context):
     """
     configuration = event['Configuration']
     print(configuration)
+    processing_inputs = [
+        {
+            'InputName':'model_data',
+            'S3Input':{
+                'S3Uri':configuration['S3InputDataPathModelData'],
+                'LocalPath':INPUT_DATA_PATH_MODEL_DATA,
+                'S3DataType': 'S3Prefix',
+                'S3InputMode': 'File',
+                # Every instance needs the whole model; the users are split by batch_inference.py
+                'S3DataDistributionType': 'FullyReplicated',
+            }
+        }
+    ]
+    # Incremental runs re-score only the users the new model changed, found by comparing it with the
+    # previous one, see incremental_training.py
+    training_mode = configuration.get('TrainingMode', DEFAULT_TRAINING_MODE)
+    if training_mode == 'incremental':
+        processing_inputs.append({
+            'InputName':'previous_model_data',
+            'S3Input':{
+                'S3Uri':configuration['S3PreviousModelPath'],
+                'LocalPath':INPUT_DATA_PATH_PREVIOUS_MODEL_DATA,
+                'S3DataType': 'S3Prefix',
+                'S3InputMode': 'File',
+                'S3DataDistributionType': 'FullyReplicated',
+            }
+        })
+    
+    processing_outputs = [
+        {
+            'OutputName':'processed_data',
+            'S3Output':{
+                'LocalPath': PREDICTIONS_DATA_PATH,
+                'S3Uri': configuration['S3OutputDataPath'],
+                'S3UploadMode': 'EndOfJob'
+             }
+         }
+    ]
+    # The recommendations of the common cold-start cohorts, for the query Lambda to answer new users
+    # without the endpoint, see cohort_recommendations.py
+    cohort_table = bool(configuration.get('S3CohortTablePath'))
+    if cohort_table:
+        processing_outputs.append({
+            'OutputName':'cohort_table',
+            'S3Output':{
+                'LocalPath': COHORT_TABLE_PATH,
+                'S3Uri': configuration['S3CohortTablePath'],
+                'S3UploadMode': 'EndOfJob'
+             }
+        })
     
     try:
         response = sm_client.create_processing_job(
-            ProcessingInputs=[
-                {
-                    'InputName':'model_data',
-                    'S3Input':{
-                        'S3Uri':configuration['S3InputDataPathModelData'],
-                        'LocalPath':INPUT_DATA_PATH_MODEL_DATA,
-                        'S3DataType': 'S3Prefix',
-                        'S3InputMode': 'File',
-                    }
-                }
-            ],
+            ProcessingInputs=processing_inputs,
             ProcessingOutputConfig={
-                'Outputs': [
-                    {
-                        'OutputName':'processed_data',
-                        'S3Output':{
-                            'LocalPath': PREDICTIONS_DATA_PATH,
-                            'S3Uri': configuration['S3OutputDataPath'],
-                            'S3UploadMode': 'EndOfJob'
-                         }
-                     }
-                 ]
+                'Outputs': processing_outputs
             },
             ProcessingJobName=configuration['JobName'],
             ProcessingResources={
@@ -63,9 +99,15 @@ def lambda_handler(event, context):
             AppSpecification={
                 'ImageUri': configuration.get('EcrContainerUri', BASE_PROCESSING_IMAGE),
                 'ContainerEntrypoint': [
-                    'python3', PROCESSING_CODE
+                    'python3', configuration.get('ProcessingCode', PROCESSING_CODE)
                 ],
             },
+            Environment={
+                'TRAINING_MODE': training_mode,
+                'BATCH_PROCESSES': str(configuration.get('ProcessesPerInstance', 0)),
+                'BATCH_TOP_N': str(configuration.get('TopN', DEFAULT_TOP_N)),
+                'COHORT_TABLE': str(cohort_table).lower(),
+            },
             RoleArn=configuration['IAMRole'],
         )
         return {
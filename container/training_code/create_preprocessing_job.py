@@ -8,11 +8,16 @@ sm_client = boto3.client('sagemaker')
 
 BASE_PROCESSING_IMAGE = ''
 INPUT_DATA_PATH = '/opt/ml/processing/input_data'
+PREVIOUS_INPUT_DATA_PATH = '/opt/ml/processing/previous_input_data'
 
 PROCESSED_DATA_PATH = '/opt/ml/processing/processed_data'
 DEFAULT_VOLUME_SIZE = 100
 DEFAULT_INSTANCE_TYPE = 'ml.m5.12xlarge'
-PREPROCESSING_CODE = '/opt/ml/code/preprocssesing_script.py'
+DEFAULT_INSTANCE_COUNT = 1
+DEFAULT_TRAINING_MODE = 'full'
+DEFAULT_INPUT_MODE = 'File'
+# Reads the input in row-group batches with bounded memory, see streaming_preprocessing.py
+PREPROCESSING_CODE = '/opt/ml/code/streaming_preprocessing.py'
 
 
 def lambda_handler(event, context):
@@ -24,19 +29,45 @@ def lambda_handler(event, context):
     """
     configuration = event['Configuration']
     print(configuration)
+    environment = {}
+    # File:     the input is downloaded to the volume before the job starts
+    # FastFile: nothing is downloaded, the job reads the row groups it needs straight from S3 with
+    #           ranged GETs, so the volume only holds spill files and output
+    # Pipe is not offered: parquet keeps its metadata in a footer and cannot be read from a FIFO
+    input_mode = configuration.get('InputMode', DEFAULT_INPUT_MODE)
+    if input_mode == 'File':
+        processing_inputs = [
+            {
+                'InputName':'input_data',
+                'S3Input':{
+                    'S3Uri': configuration['S3InputDataPath'],
+                    'LocalPath': INPUT_DATA_PATH,
+                    'S3DataType': 'S3Prefix',
+                    'S3InputMode': 'File',
+                }
+            }
+        ]
+    elif input_mode == 'FastFile':
+        processing_inputs = []
+        environment['INPUT_S3_URI'] = configuration['S3InputDataPath']
+    else:
+        raise ValueError('Unsupported InputMode {}: use File or FastFile, parquet input cannot be '
+                         'streamed through Pipe mode.'.format(input_mode))
+    # Incremental runs skip the rows already in the previous snapshot, see streaming_preprocessing.py
+    training_mode = configuration.get('TrainingMode', DEFAULT_TRAINING_MODE)
+    if training_mode == 'incremental':
+        processing_inputs.append({
+            'InputName':'previous_input_data',
+            'S3Input':{
+                'S3Uri': configuration['S3PreviousInputDataPath'],
+                'LocalPath': PREVIOUS_INPUT_DATA_PATH,
+                'S3DataType': 'S3Prefix',
+                'S3InputMode': 'File',
+            }
+        })
     try:
         response = sm_client.create_processing_job(
-            ProcessingInputs=[
-                {
-                    'InputName':'input_data',
-                    'S3Input':{
-                        'S3Uri': configuration['S3InputDataPath'],
-                        'LocalPath': INPUT_DATA_PATH,
-                        'S3DataType': 'S3Prefix',
-                        'S3InputMode': 'File',
-                    }
-                }
-            ],
+            ProcessingInputs=processing_inputs,
             ProcessingOutputConfig={
                 'Outputs': [
                     {
@@ -60,9 +91,10 @@ def lambda_handler(event, context):
             AppSpecification={
                 'ImageUri': configuration.get('EcrContainerUri', BASE_PROCESSING_IMAGE),
                 'ContainerEntrypoint': [
-                    'python3', PREPROCESSING_CODE
+                    'python3', configuration.get('ProcessingCode', PREPROCESSING_CODE)
                 ],
             },
+            Environment=dict(environment, TRAINING_MODE=training_mode),
             RoleArn=configuration['IAMRole'],
         )
         return {
@@ -0,0 +1,234 @@
+# Multi-worker data-parallel training on CPU clusters: worker placement, launch and gradient allreduce.
+#
+# The train entrypoint reads /opt/ml/input/config/resourceconfig.json and starts workers_per_host
+# workers on every host:
+#
+#   mpirun          when it is installed (it is in the training image); the first host launches every
+#                   worker over ssh and the others only run sshd until the job is over
+#   process group   otherwise, on a single host: the workers are plain processes that talk to rank 0
+#                   over a local socket (DIST_* environment variables)
+#
+# Inside a worker, get_communicator() returns the matching communicator. Embedding gradients are sparse
+# (a batch touches few rows), so they are reduced as (row indices, row gradients) and summed per row
+# instead of allreducing the whole matrix.
+
+from __future__ import print_function
+
+import os
+import json
+import time
+import socket
+import subprocess
+from multiprocessing.connection import Listener, Client
+
+import numpy as np
+
+RESOURCE_CONFIG = '/opt/ml/input/config/resourceconfig.json'
+DEFAULT_PORT = 29500
+AUTHKEY = b'skipgram-workers'
+
+
+def read_resource_config(path=RESOURCE_CONFIG):
+    """The hosts of the training job; a single local host outside SageMaker."""
+    if not os.path.exists(path):
+        return {'current_host': 'localhost', 'hosts': ['localhost']}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def shard_files(files, rank, size):
+    """The files of worker rank, round-robin over the sorted list, so every worker reads a disjoint set."""
+    return sorted(files)[rank::size]
+
+
+def sum_rows(indices, values):
+    """Sum the rows of values that share an index. Returns (unique indices, summed rows)."""
+    indices = np.asarray(indices)
+    if not len(indices):
+        return indices, values
+    order = np.argsort(indices, kind='mergesort')
+    indices = indices[order]
+    starts = np.flatnonzero(np.concatenate([[True], indices[1:] != indices[:-1]]))
+    return indices[starts], np.add.reduceat(values[order], starts, axis=0)
+
+
+class Communicator(object):
+    """A single worker; the base of the multi-worker communicators."""
+
+    rank = 0
+    size = 1
+
+    def allreduce(self, array):
+        """Element-wise sum of array over all workers."""
+        return array
+
+    def allreduce_sparse(self, indices, values):
+        """Sum of the sparse row gradients (indices, values) of all workers, as (unique indices, rows)."""
+        return sum_rows(indices, values)
+
+    def allreduce_max(self, value):
+        return value
+
+    def broadcast(self, array):
+        """rank 0's array on every worker."""
+        return array
+
+    def barrier(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class MPICommunicator(Communicator):
+    """Workers started by mpirun, through mpi4py."""
+
+    def __init__(self):
+        from mpi4py import MPI
+        self.MPI = MPI
+        self.comm = MPI.COMM_WORLD
+        self.rank = self.comm.Get_rank()
+        self.size = self.comm.Get_size()
+
+    def allreduce(self, array):
+        result = np.empty_like(array)
+        self.comm.Allreduce(np.ascontiguousarray(array), result, op=self.MPI.SUM)
+        return result
+
+    def allreduce_sparse(self, indices, values):
+        gathered = self.comm.allgather((indices, values))
+        return sum_rows(np.concatenate([g[0] for g in gathered]), np.concatenate([g[1] for g in gathered]))
+
+    def allreduce_max(self, value):
+        return self.comm.allreduce(value, op=self.MPI.MAX)
+
+    def broadcast(self, array):
+        return self.comm.bcast(array, root=0)
+
+    def barrier(self):
+        self.comm.Barrier()
+
+
+class SocketCommunicator(Communicator):
+    """Workers of a local process group: rank 0 gathers, reduces and sends the result back."""
+
+    def __init__(self, rank, size, address=('127.0.0.1', DEFAULT_PORT), timeout=60):
+        self.rank = rank
+        self.size = size
+        self.connections = []
+        if rank == 0:
+            self.listener = Listener(address, authkey=AUTHKEY)
+            peers = {}
+            for _ in range(size - 1):
+                connection = self.listener.accept()
+                peers[connection.recv()] = connection
+            self.connections = [peers[r] for r in sorted(peers)]
+        else:
+            deadline = time.time() + timeout
+            while True:
+                try:
+                    connection = Client(address, authkey=AUTHKEY)
+                    break
+                except (ConnectionRefusedError, OSError):
+                    if time.time() > deadline:
+                        raise
+                    time.sleep(0.05)
+            connection.send(rank)
+            self.connections = [connection]
+
+    def _reduce(self, payload, combine):
+        if self.rank == 0:
+            result = combine([payload] + [c.recv() for c in self.connections])
+            for connection in self.connections:
+                connection.send(result)
+            return result
+        self.connections[0].send(payload)
+        return self.connections[0].recv()
+
+    def allreduce(self, array):
+        return self._reduce(array, lambda arrays: np.sum(arrays, axis=0))
+
+    def allreduce_sparse(self, indices, values):
+        return self._reduce((indices, values), lambda parts: sum_rows(
+            np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts])))
+
+    def allreduce_max(self, value):
+        return self._reduce(value, max)
+
+    def broadcast(self, array):
+        return self._reduce(array, lambda arrays: arrays[0])
+
+    def barrier(self):
+        self._reduce(None, lambda parts: None)
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+        if self.rank == 0:
+            self.listener.close()
+
+
+def get_communicator():
+    """The communicator of this worker, from the environment mpirun or launch_local set up."""
+    if 'OMPI_COMM_WORLD_SIZE' in os.environ or 'PMI_SIZE' in os.environ:
+        return MPICommunicator()
+    if int(os.environ.get('DIST_WORLD_SIZE', 1)) > 1:
+        return SocketCommunicator(int(os.environ['DIST_RANK']), int(os.environ['DIST_WORLD_SIZE']),
+                                  (os.environ.get('DIST_MASTER_ADDR', '127.0.0.1'),
+                                   int(os.environ.get('DIST_MASTER_PORT', DEFAULT_PORT))))
+    return Communicator()
+
+
+def mpirun_command(hosts, workers_per_host, cmd, env_names=('PATH', 'PYTHONPATH', 'LD_LIBRARY_PATH')):
+    """mpirun invocation running cmd workers_per_host times on every host, on CPU and plain TCP."""
+    mpi_cmd = ['mpirun',
+               '--host', ','.join('{}:{}'.format(host, workers_per_host) for host in hosts),
+               '-np', str(len(hosts) * workers_per_host),
+               '--bind-to', 'none', '--map-by', 'slot',
+               '--mca', 'btl_tcp_if_exclude', 'lo,docker0',
+               '--mca', 'plm_rsh_no_tree_spawn', '1',
+               '--mca', 'orte_abort_on_non_zero_status', '1']
+    for name in env_names:
+        if name in os.environ:
+            mpi_cmd += ['-x', name]
+    return mpi_cmd + list(cmd)
+
+
+def local_worker_env(rank, workers, port=DEFAULT_PORT):
+    """Environment of worker rank of a local process group."""
+    return dict(os.environ, DIST_RANK=str(rank), DIST_WORLD_SIZE=str(workers), DIST_MASTER_ADDR='127.0.0.1',
+                DIST_MASTER_PORT=str(port))
+
+
+def launch_local(workers, cmd, port=DEFAULT_PORT, ranks=None, **popen_kwargs):
+    """Start copies of cmd on this host as a process group (ranks, all by default); returns the Popens."""
+    ranks = range(workers) if ranks is None else ranks
+    return [subprocess.Popen(cmd, env=local_worker_env(rank, workers, port), **popen_kwargs) for rank in ranks]
+
+
+def wait_for_hosts(hosts, port=22, timeout=300):
+    """Wait until sshd answers on every host, before mpirun tries to reach them."""
+    deadline = time.time() + timeout
+    for host in hosts:
+        while True:
+            try:
+                socket.create_connection((host, port), timeout=5).close()
+                break
+            except (socket.error, OSError):
+                if time.time() > deadline:
+                    raise RuntimeError('Host {} not reachable on port {}'.format(host, port))
+                time.sleep(1)
+
+
+def wait_for_mpi_workers_to_finish(start_timeout=600, poll_seconds=5):
+    """On a non-launching host: wait for mpirun's orted to start here, then for it to exit."""
+    def orted_running():
+        return subprocess.call(['pgrep', '-f', 'orted'], stdout=subprocess.DEVNULL) == 0
+
+    deadline = time.time() + start_timeout
+    while not orted_running():
+        if time.time() > deadline:
+            raise RuntimeError('No MPI worker was started on this host')
+        time.sleep(poll_seconds)
+    while orted_running():
+        time.sleep(poll_seconds)
@@ -0,0 +1,353 @@
+# Bulk load of the batch recommendations into DynamoDB, writing only the users whose list changed.
+#
+# The recommendations parquet (user_id, recommendation_id) written by batch_inference.py is read one row
+# group at a time. Every user's list is hashed and compared with the hash recorded for the user by the
+# previous load, in a manifest parquet (user_id, list_hash, model_id, expiry_time):
+#
+#   changed     the list differs or the user is new: written with this load's model_id
+#   refreshed   the list is the same but the item written for it expires within the next
+#               REFRESH_FRACTION of the TTL: written again so the user never ends up without a live item
+#   skipped     the list is the same and its item stays live: not written, the query Lambda keeps
+#               serving the previous item
+#
+# Writes go through --WRITE_WORKERS threads calling batch_write_item with 25 items per request. A shared
+# AdaptiveRateLimiter paces them: it adds WRITE_RATE_INCREASE items/sec after every fully processed batch
+# and halves the rate when DynamoDB throttles (UnprocessedItems or a throughput exception). Unprocessed
+# items are retried with jittered exponential backoff. Users whose items could not be written after
+# MAX_ATTEMPTS keep their previous manifest entry, so the next load writes them again.
+#
+# In the packed layout (--STORAGE_FORMAT packed, see packed_recommendations.py) every partition's
+# chunks are written before the headers that point at them.
+#
+# With --COHORT_TABLE_URI, the prefix the batch prediction job wrote its cohort table to (see
+# cohort_recommendations.py), a load that wrote every item then points the SSM parameter
+# --COHORT_TABLE_PARAMETER at the table, so the query Lambda switches to the new model's cohort lists
+# together with the users' lists.
+#
+# Runs as the glue-batch-load-recs job (a Python shell job, with streaming_preprocessing.py and
+# packed_recommendations.py as extra Python files) or locally; the previous manifest is held in memory
+# as one hash per user. See benchmarks/bench_bulk_load.py for a run against a local DynamoDB stand-in.
+
+from __future__ import print_function
+
+import os
+import json
+import time
+import queue
+import random
+import argparse
+import threading
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import streaming_preprocessing
+
+DEFAULT_TABLE = 'recommendations'
+DEFAULT_TTL_DAYS = 14
+DEFAULT_WORKERS = 16
+DEFAULT_BATCH_ROWS = 100000
+DEFAULT_INITIAL_RATE = 1000.0
+DEFAULT_MAX_RATE = 40000.0
+MANIFEST_FILE = 'manifest.parquet'
+REFRESH_FRACTION = 0.5
+BATCH_WRITE_LIMIT = 25
+MAX_ATTEMPTS = 8
+WRITE_RATE_INCREASE = 50.0
+# The file cohort_recommendations.py writes under the cohort table prefix
+COHORT_TABLE_FILE = 'cohort_table.bin'
+DEFAULT_COHORT_TABLE_PARAMETER = 'recommender.cohort_table'
+THROTTLING_ERRORS = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded')
+
+
+def list_hashes(recommendation_ids):
+    """Stable 64-bit hashes of the comma-joined lists."""
+    return pd.util.hash_array(np.asarray(recommendation_ids, dtype=object))
+
+
+def _filesystem(path):
+    from pyarrow import fs
+    return fs.FileSystem.from_uri(path if path.startswith('s3://') else os.path.abspath(path))
+
+
+def read_manifest(path):
+    """The previous load's manifest indexed by user_id; empty when there is none."""
+    empty = pd.DataFrame({'list_hash': np.array([], dtype=np.uint64), 'model_id': np.array([], dtype=np.int64),
+                          'expiry_time': np.array([], dtype=np.int64)}, index=pd.Index([], name='user_id'))
+    if not path:
+        return empty
+    from pyarrow import fs
+    filesystem, file_path = _filesystem(path)
+    if filesystem.get_file_info(file_path).type == fs.FileType.NotFound:
+        return empty
+    with filesystem.open_input_file(file_path) as f:
+        return pq.read_table(f).to_pandas().set_index('user_id')
+
+
+def write_manifest(manifest, path):
+    filesystem, file_path = _filesystem(path)
+    if not path.startswith('s3://'):
+        filesystem.create_dir(os.path.dirname(file_path), recursive=True)
+    with filesystem.open_output_stream(file_path) as f:
+        pq.write_table(pa.Table.from_pandas(manifest.reset_index(), preserve_index=False), f)
+
+
+class AdaptiveRateLimiter(object):
+    """Token bucket of items/sec, additive increase after successes, multiplicative decrease on throttling."""
+
+    def __init__(self, rate=DEFAULT_INITIAL_RATE, min_rate=25.0, max_rate=DEFAULT_MAX_RATE,
+                 increase=WRITE_RATE_INCREASE, decrease=0.5):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.tokens = 0.0
+        self.last = time.time()
+        self.lock = threading.Lock()
+        self.throttles = 0
+
+    def acquire(self, n):
+        while True:
+            with self.lock:
+                now = time.time()
+                # At most one second of unused rate is banked
+                self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= n or self.tokens >= self.rate:
+                    self.tokens -= n
+                    return
+                wait = (n - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.throttles += 1
+
+
+class BulkWriter(object):
+    """batch_write_item from worker threads, each with its own DynamoDB resource from dynamodb_factory."""
+
+    def __init__(self, dynamodb_factory, workers=DEFAULT_WORKERS, limiter=None, max_attempts=MAX_ATTEMPTS,
+                 base_backoff=0.05):
+        self.dynamodb_factory = dynamodb_factory
+        self.limiter = limiter or AdaptiveRateLimiter()
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.queue = queue.Queue(maxsize=workers * 4)
+        self.lock = threading.Lock()
+        self.stats = {'items_written': 0, 'requests': 0, 'throttled_requests': 0, 'retried_items': 0,
+                      'failed_items': 0}
+        self.failed_users = set()
+        self.threads = [threading.Thread(target=self._work) for _ in range(workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def put_all(self, table_name, items):
+        for start in range(0, len(items), BATCH_WRITE_LIMIT):
+            self.queue.put((table_name, items[start:start + BATCH_WRITE_LIMIT]))
+
+    def flush(self):
+        """Wait until everything queued so far is written."""
+        self.queue.join()
+
+    def close(self):
+        self.flush()
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        return dict(self.stats, throttles=self.limiter.throttles, final_rate=round(self.limiter.rate, 1))
+
+    def _count(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                self.stats[name] += value
+
+    def _work(self):
+        dynamodb = None
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                # A batch that cannot be written is counted as failed, the worker carries on with the
+                # next one: a dead worker would leave put_all and flush waiting on the queue forever
+                try:
+                    dynamodb = dynamodb or self.dynamodb_factory()
+                    self._write(dynamodb, *task)
+                except Exception as e:
+                    print('Batch write to {} failed: {!r}'.format(task[0], e))
+                    self._fail(task[1])
+            finally:
+                self.queue.task_done()
+
+    def _write(self, dynamodb, table_name, items):
+        pending = items
+        for attempt in range(self.max_attempts):
+            if attempt:
+                self._count(retried_items=len(pending))
+                time.sleep(random.uniform(0, self.base_backoff * 2 ** attempt))
+            self.limiter.acquire(len(pending))
+            self._count(requests=1)
+            try:
+                response = dynamodb.batch_write_item(
+                    RequestItems={table_name: [{'PutRequest': {'Item': item}} for item in pending]})
+            except Exception as e:
+                code = getattr(e, 'response', {}).get('Error', {}).get('Code')
+                if code not in THROTTLING_ERRORS:
+                    # Not retried: only the items still pending are failed, earlier attempts may have written some
+                    print('Batch write to {} failed: {!r}'.format(table_name, e))
+                    self._fail(pending)
+                    return
+                self._count(throttled_requests=1)
+                self.limiter.on_throttle()
+                continue
+            unprocessed = [r['PutRequest']['Item'] for r in response.get('UnprocessedItems', {}).get(table_name, [])]
+            self._count(items_written=len(pending) - len(unprocessed))
+            if not unprocessed:
+                self.limiter.on_success()
+                return
+            self._count(throttled_requests=1)
+            self.limiter.on_throttle()
+            pending = unprocessed
+        self._fail(pending)
+
+    def _fail(self, items):
+        """Count items as not written; their users are left out of the manifest so the next load retries them."""
+        self._count(failed_items=len(items))
+        with self.lock:
+            self.failed_users.update(item['user_id'] for item in items)
+
+
+def string_items(frame, model_id, expiry_time):
+    return [{'user_id': u, 'model_id': model_id, 'recommendation_id': r, 'expiry_time': expiry_time}
+            for u, r in zip(frame['user_id'].values, frame['recommendation_id'].values)]
+
+
+def load(source, table_name=DEFAULT_TABLE, manifest_dir=None, model_id=None, ttl_days=DEFAULT_TTL_DAYS,
+         storage_format='string', workers=DEFAULT_WORKERS, initial_rate=DEFAULT_INITIAL_RATE,
+         max_rate=DEFAULT_MAX_RATE, batch_rows=DEFAULT_BATCH_ROWS, dynamodb_factory=None, chunk_table_name=None):
+    """Load source into table_name, skipping unchanged users. Returns the summary."""
+    start = time.time()
+    now = int(start)
+    model_id = int(model_id or now)
+    ttl_seconds = int(ttl_days * 24 * 3600)
+    expiry_time = model_id + ttl_seconds
+    refresh_before = now + int(REFRESH_FRACTION * ttl_seconds)
+    if dynamodb_factory is None:
+        import boto3
+        dynamodb_factory = lambda: boto3.session.Session().resource('dynamodb')  # noqa: E731
+    if storage_format == 'packed':
+        import packed_recommendations
+        chunk_table_name = chunk_table_name or packed_recommendations.CHUNK_TABLE_NAME
+
+    manifest_path = os.path.join(manifest_dir, MANIFEST_FILE) if manifest_dir else None
+    previous = read_manifest(manifest_path)
+    # A trailing sentinel is what the position -1 of users without a previous entry picks up
+    previous_hashes = np.append(previous['list_hash'].values.astype(np.uint64), np.uint64(0))
+    previous_expiry = np.append(previous['expiry_time'].values.astype(np.int64), np.int64(0))
+
+    writer = BulkWriter(dynamodb_factory, workers, AdaptiveRateLimiter(initial_rate, max_rate=max_rate))
+    counts = {'users': 0, 'changed': 0, 'refreshed': 0, 'skipped': 0}
+    written = []
+    for batch in streaming_preprocessing.iter_batches(source, ['user_id', 'recommendation_id'], batch_rows):
+        batch['user_id'] = batch['user_id'].astype(str)
+        hashes = list_hashes(batch['recommendation_id'].values)
+        positions = previous.index.get_indexer(batch['user_id'].values)
+        known = positions >= 0
+        same = known & (previous_hashes[positions] == hashes)
+        live = same & (previous_expiry[positions] >= refresh_before)
+        counts['users'] += len(batch)
+        counts['changed'] += int((~same).sum())
+        counts['refreshed'] += int((same & ~live).sum())
+        counts['skipped'] += int(live.sum())
+
+        to_write = batch[~live]
+        if storage_format == 'packed':
+            headers = []
+            chunks = []
+            for user_id, ids in zip(to_write['user_id'].values, to_write['recommendation_id'].values):
+                header, user_chunks = packed_recommendations.packed_items(user_id, model_id, ids, expiry_time)
+                headers.append(header)
+                chunks.extend(user_chunks)
+            writer.put_all(chunk_table_name, chunks)
+            writer.flush()
+            # A header is only written once all its chunks are, or readers would get a truncated list;
+            # the users of failed chunks are already in failed_users, so the manifest leaves them out
+            with writer.lock:
+                failed = set(writer.failed_users)
+            writer.put_all(table_name, [h for h in headers if h['user_id'] not in failed])
+        else:
+            writer.put_all(table_name, string_items(to_write, model_id, expiry_time))
+        written.append(pd.DataFrame({'user_id': to_write['user_id'].values, 'list_hash': hashes[~live],
+                                     'model_id': np.int64(model_id), 'expiry_time': np.int64(expiry_time)}))
+    stats = writer.close()
+    elapsed = time.time() - start
+
+    if manifest_path:
+        updates = pd.concat(written, ignore_index=True) if written else previous.reset_index()[:0]
+        if writer.failed_users:
+            updates = updates[~updates['user_id'].isin(writer.failed_users)]
+        updates = updates.set_index('user_id')
+        manifest = pd.concat([previous[~previous.index.isin(updates.index)], updates])
+        write_manifest(manifest, manifest_path)
+
+    summary = dict(counts, **stats)
+    summary.update({
+        'model_id': model_id,
+        'seconds': round(elapsed, 3),
+        'items_per_second': round(stats['items_written'] / elapsed, 1) if elapsed > 0 else None,
+        'users_per_second': round(counts['users'] / elapsed, 1) if elapsed > 0 else None,
+    })
+    print(json.dumps(summary))
+    return summary
+
+
+def publish_cohort_table(prefix, parameter=DEFAULT_COHORT_TABLE_PARAMETER, ssm_client=None, s3_client=None):
+    """Point parameter at the cohort table under prefix. Returns its URI, or None if there is no table."""
+    import boto3
+    from botocore.exceptions import ClientError
+    uri = prefix.rstrip('/') + '/' + COHORT_TABLE_FILE
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    try:
+        (s3_client or boto3.client('s3')).head_object(Bucket=bucket, Key=key)
+    except ClientError:
+        print('No cohort table at {}, {} is left unchanged'.format(uri, parameter))
+        return None
+    (ssm_client or boto3.client('ssm')).put_parameter(Name=parameter, Value=uri, Type='String', Overwrite=True)
+    print('Published the cohort table {} as {}'.format(uri, parameter))
+    return uri
+
+
+if __name__ == '__main__':
+    # Glue passes job arguments as --NAME value, plus arguments of its own
+    parser = argparse.ArgumentParser(description='Bulk load of batch recommendations into DynamoDB')
+    parser.add_argument('--S3_SOURCE', required=True, help='Recommendations parquet: file, directory or s3:// URI')
+    parser.add_argument('--DDB_DEST', default=DEFAULT_TABLE)
+    parser.add_argument('--S3_MANIFEST_PATH', default=None,
+                        help='Where the manifest of the previous load is read and the new one written')
+    parser.add_argument('--MODEL_ID', type=int, default=None, help='Defaults to the current time')
+    parser.add_argument('--TTL_DAYS', type=float, default=DEFAULT_TTL_DAYS)
+    parser.add_argument('--STORAGE_FORMAT', default='string', choices=['string', 'packed'])
+    parser.add_argument('--WRITE_WORKERS', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--INITIAL_WRITE_RATE', type=float, default=DEFAULT_INITIAL_RATE)
+    parser.add_argument('--MAX_WRITE_RATE', type=float, default=DEFAULT_MAX_RATE)
+    parser.add_argument('--COHORT_TABLE_URI', default=None, help='s3:// prefix of the cohort table to publish')
+    parser.add_argument('--COHORT_TABLE_PARAMETER', default=DEFAULT_COHORT_TABLE_PARAMETER)
+    args, _ = parser.parse_known_args()
+
+    summary = load(args.S3_SOURCE, args.DDB_DEST, args.S3_MANIFEST_PATH, args.MODEL_ID, args.TTL_DAYS,
+                   args.STORAGE_FORMAT, args.WRITE_WORKERS, args.INITIAL_WRITE_RATE, args.MAX_WRITE_RATE)
+    if summary['failed_items']:
+        raise SystemExit('{} items could not be written'.format(summary['failed_items']))
+    if args.COHORT_TABLE_URI:
+        publish_cohort_table(args.COHORT_TABLE_URI, args.COHORT_TABLE_PARAMETER)
@@ -0,0 +1,238 @@
+# Helpers for the incremental (delta) retraining path, see trigger_workflow in external_lambda_functions.
+#
+# Between two full retrains the pipeline only:
+#
+#   1. preprocessing: diffs the new input snapshot against the previous one and keeps the new rows
+#      (diff subcommand)
+#   2. training: starts every user's vectors from the last model instead of at random and trains the
+#      delta for a few epochs. The model keeps all the last model's users; the ones the delta does not
+#      touch keep their vectors unchanged (warm_start_model)
+#   3. batch inference: re-scores only the users whose vector moved, who are new, or who have one of
+#      those users among their nearest neighbours (rescore subcommand)
+#
+# The previous model is read from the model_store layout (preference_vectors.npy, user_ids.npy and, when
+# present, item_vectors.npy).
+#
+# Usage inside the processing containers:
+#   python3 incremental_training.py diff --previous <snapshot> --current <snapshot> --output <dir>
+#   python3 incremental_training.py rescore --previous-model-dir <dir> --model-dir <dir> --output <dir>
+
+from __future__ import print_function
+
+import os
+import json
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import ann_index
+import model_store
+
+DELTA_FILE = 'delta.parquet'
+TOUCHED_USERS_FILE = 'touched_users.npy'
+RESCORE_USERS_FILE = 'rescore_users.npy'
+DEFAULT_USER_COLUMNS = ('user_id',)
+DEFAULT_DRIFT_THRESHOLD = 0.05
+DEFAULT_NEIGHBORS = 100
+
+
+def row_hashes(frame):
+    """One 64-bit hash per row over all the columns, independent of the row order and index."""
+    return pd.util.hash_pandas_object(frame, index=False).values
+
+
+def diff_snapshots(previous, current):
+    """
+    Rows of current that are not in previous, and the number of previous rows no longer in current.
+
+    Both are DataFrames with the same columns; rows are compared by value.
+    """
+    current = current[sorted(current.columns)]
+    previous = previous[sorted(current.columns)]
+    previous_hashes = row_hashes(previous)
+    current_hashes = row_hashes(current)
+    new_rows = current[~np.isin(current_hashes, previous_hashes)]
+    n_removed = int((~np.isin(previous_hashes, current_hashes)).sum())
+    return new_rows, n_removed
+
+
+def touched_users(delta, user_columns=DEFAULT_USER_COLUMNS):
+    """The distinct users that appear in any of the user columns of the delta rows."""
+    columns = [c for c in user_columns if c in delta.columns]
+    if not columns:
+        raise KeyError('None of the user columns {} are in the snapshot columns {}'.format(
+            list(user_columns), list(delta.columns)))
+    return pd.unique(np.concatenate([delta[c].values for c in columns]))
+
+
+def load_vectors(model_dir, vectors_file=model_store.PREFERENCE_VECTORS_FILE):
+    """(user_ids, vectors) of a model directory in the model_store layout, memory-mapped."""
+    vectors = np.load(os.path.join(model_dir, vectors_file), mmap_mode='r')
+    user_ids = np.load(os.path.join(model_dir, model_store.USER_IDS_FILE), mmap_mode='r', allow_pickle=False)
+    return user_ids, vectors
+
+
+def previous_model(previous_model_dir, vector_size):
+    """
+    (user_ids, preference_vectors) of the previous model, or None if there is none to warm-start from:
+    missing, e.g. if the run that should have produced it failed, or of another vector_size.
+    """
+    if previous_model_dir is None or not os.path.exists(
+            os.path.join(previous_model_dir, model_store.PREFERENCE_VECTORS_FILE)):
+        print('No previous model found, starting from random vectors.')
+        return None
+    previous_ids, previous_vectors = load_vectors(previous_model_dir)
+    if previous_vectors.shape[1] != vector_size:
+        print('Previous model has vector_size {}, not {}; starting from random vectors.'.format(
+            previous_vectors.shape[1], vector_size))
+        return None
+    return previous_ids, previous_vectors
+
+
+def warm_start_vectors(previous_model_dir, user_ids, vector_size, scale=None, seed=0):
+    """
+    Initial vectors for user_ids: the previous model's vector where the user had one, random otherwise.
+
+    Returns (vectors, is_new) where is_new marks the users without a previous vector. Falls back to an
+    all-random start when there is no previous model (see previous_model).
+    """
+    rng = np.random.RandomState(seed)
+    user_ids = np.asarray(user_ids)
+    scale = 0.5 / vector_size if scale is None else scale
+    vectors = rng.uniform(-scale, scale, (len(user_ids), vector_size)).astype(np.float32)
+    is_new = np.ones(len(user_ids), dtype=bool)
+    previous = previous_model(previous_model_dir, vector_size)
+    if previous is None:
+        return vectors, is_new
+
+    previous_ids, previous_vectors = previous
+    positions = pd.Index(previous_ids).get_indexer(user_ids)
+    found = positions >= 0
+    vectors[found] = previous_vectors[positions[found]]
+    is_new[found] = False
+    print('Warm start: {} of {} users from the previous model.'.format(int(found.sum()), len(user_ids)))
+    return vectors, is_new
+
+
+def warm_start_model(previous_model_dir, user_ids, vector_size, seed=0):
+    """
+    The users and initial matrices of an incremental run over the vocabulary user_ids (the delta's).
+
+    Returns (model_ids, w_in, w_out). model_ids is user_ids followed by the previous model's users that
+    user_ids lacks, so the rows of user_ids keep their positions and the model keeps every previous user.
+    w_in starts from the previous preference vectors and w_out from the previous item vectors, where the
+    user had them (random and zero otherwise, as in a full run). The appended users get no gradients:
+    their vectors are carried over unchanged.
+    """
+    user_ids = np.asarray(user_ids).astype(str)
+    previous = previous_model(previous_model_dir, vector_size)
+    model_ids = user_ids
+    if previous is not None:
+        previous_ids = np.asarray(previous[0]).astype(str)
+        carried = previous_ids[~np.isin(previous_ids, user_ids)]
+        model_ids = np.concatenate([user_ids, carried])
+    w_in, _ = warm_start_vectors(previous_model_dir, model_ids, vector_size, seed=seed)
+    w_out = np.zeros((len(model_ids), vector_size), dtype=np.float32)
+    if previous is not None and os.path.exists(os.path.join(previous_model_dir, model_store.ITEM_VECTORS_FILE)):
+        previous_ids, item_vectors = load_vectors(previous_model_dir, model_store.ITEM_VECTORS_FILE)
+        positions = pd.Index(previous_ids).get_indexer(model_ids)
+        found = positions >= 0
+        w_out[found] = item_vectors[positions[found]]
+    if previous is not None:
+        print('Incremental model: {} users in the delta, {} carried over from the previous model.'.format(
+            len(user_ids), len(model_ids) - len(user_ids)))
+    return model_ids, w_in, w_out
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def users_to_rescore(previous_ids, previous_vectors, user_ids, vectors, drift_threshold=DEFAULT_DRIFT_THRESHOLD,
+                     neighbors=DEFAULT_NEIGHBORS, index=None, search_k=-1):
+    """
+    Users whose recommendations may have changed between two models.
+
+    A user is re-scored if it is new, if its vector moved by more than drift_threshold in cosine
+    distance, or if one of those changed users is among its neighbors nearest users in the new model
+    (its candidate list may now differ). The neighbours are looked up in index, the new model's ANN
+    index over vectors (an Annoy index is built if none is given), one query per changed user.
+    """
+    user_ids = np.asarray(user_ids)
+    unit = _normalize(vectors)
+    positions = pd.Index(previous_ids).get_indexer(user_ids)
+    changed = positions < 0
+    known = ~changed
+    if known.any():
+        previous_unit = _normalize(np.asarray(previous_vectors)[positions[known]])
+        drift = 1.0 - np.einsum('ij,ij->i', unit[known], previous_unit)
+        changed[np.flatnonzero(known)[drift > drift_threshold]] = True
+
+    rescore = changed.copy()
+    changed_rows = np.flatnonzero(changed)
+    if len(changed_rows) and neighbors > 0:
+        if index is None:
+            index = ann_index.create_index(ann_index.AnnoyBackend.kind, unit.shape[1]).build(unit)
+        # Neighbourhoods are symmetric enough for cosine similarity: the users nearest to a changed user
+        # are the ones likely to have it among their own candidates
+        k = min(neighbors, len(user_ids))
+        for row in changed_rows:
+            rescore[index.get_nns_by_vector(unit[row], k, search_k=search_k)] = True
+    return user_ids[rescore], {'users': int(len(user_ids)), 'changed': int(changed.sum()),
+                               'rescore': int(rescore.sum())}
+
+
+def _diff(args):
+    previous = pd.read_parquet(args.previous)
+    current = pd.read_parquet(args.current)
+    delta, n_removed = diff_snapshots(previous, current)
+    users = touched_users(delta, args.user_columns)
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    delta.to_parquet(os.path.join(args.output, DELTA_FILE), index=False)
+    np.save(os.path.join(args.output, TOUCHED_USERS_FILE), users)
+    print(json.dumps({'previous_rows': len(previous), 'current_rows': len(current), 'new_rows': len(delta),
+                      'removed_rows': n_removed, 'touched_users': len(users)}))
+
+
+def _rescore(args):
+    previous_ids, previous_vectors = load_vectors(args.previous_model_dir)
+    model = model_store.load_model(args.model_dir)
+    users, summary = users_to_rescore(previous_ids, previous_vectors, model['user_ids'], model['preference_vectors'],
+                                      args.drift_threshold, args.neighbors, index=model['index'],
+                                      search_k=args.search_k)
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    np.save(os.path.join(args.output, RESCORE_USERS_FILE), users)
+    print(json.dumps(summary))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Incremental retraining helpers')
+    subparsers = parser.add_subparsers(dest='command')
+
+    diff_parser = subparsers.add_parser('diff', help='Write the rows of a snapshot missing from the previous one')
+    diff_parser.add_argument('--previous', required=True)
+    diff_parser.add_argument('--current', required=True)
+    diff_parser.add_argument('--output', required=True)
+    diff_parser.add_argument('--user-columns', nargs='+', default=list(DEFAULT_USER_COLUMNS))
+
+    rescore_parser = subparsers.add_parser('rescore', help='Write the users to re-score after an incremental run')
+    rescore_parser.add_argument('--previous-model-dir', required=True)
+    rescore_parser.add_argument('--model-dir', required=True)
+    rescore_parser.add_argument('--output', required=True)
+    rescore_parser.add_argument('--drift-threshold', type=float, default=DEFAULT_DRIFT_THRESHOLD)
+    rescore_parser.add_argument('--neighbors', type=int, default=DEFAULT_NEIGHBORS)
+    rescore_parser.add_argument('--search-k', type=int, default=-1, help='Annoy search_k of the neighbour queries')
+
+    args = parser.parse_args()
+    if args.command == 'diff':
+        _diff(args)
+    elif args.command == 'rescore':
+        _rescore(args)
+    else:
+        parser.print_help()
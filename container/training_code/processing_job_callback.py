@@ -0,0 +1,80 @@
+import boto3
+import logging
+import json
+import os
+import time
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+sm_client = boto3.client('sagemaker')
+sfn_client = boto3.client('stepfunctions')
+token_table = boto3.resource('dynamodb').Table(os.environ.get('CALLBACK_TABLE', 'processing-job-callbacks'))
+
+# Event-driven completion of the workflow's processing jobs, instead of polling them.
+#
+# The workflow's "Wait For ..." steps invoke this function with .waitForTaskToken and the payload
+# {ProcessingJobName, TaskToken}: the token is stored under the job name and the step stays paused.
+# An EventBridge rule on "SageMaker Processing Job State Change" invokes the function again when the
+# job ends, which resumes the step with SendTaskSuccess, or with SendTaskFailure (error
+# ProcessingJobFailed) if the job failed or was stopped.
+#
+# The job can end before its token is stored, so registering also checks the job once. Whichever of the
+# two calls deletes the token sends the result, so it is sent exactly once. Tokens of abandoned
+# executions expire through the table's TTL on expires_at.
+TERMINAL_STATUSES = ('Completed', 'Failed', 'Stopped')
+TOKEN_TTL_SECONDS = int(os.environ.get('TOKEN_TTL_SECONDS', 7 * 24 * 3600))
+
+
+def lambda_handler(event, context):
+
+    if 'TaskToken' in event:
+        return register_task_token(event['ProcessingJobName'], event['TaskToken'])
+
+    if event.get('source') == 'aws.sagemaker':
+        detail = event['detail']
+        logger.info("Processing job:{} changed to status:{}.".format(detail['ProcessingJobName'],
+            detail['ProcessingJobStatus']))
+        if detail['ProcessingJobStatus'] in TERMINAL_STATUSES:
+            return {'statusCode': 200, 'Resumed': complete_task(detail)}
+        return {'statusCode': 200, 'Resumed': False}
+
+    raise KeyError('Expected a TaskToken registration or a SageMaker state change event!'+
+                   ' The input received was: {}.'.format(json.dumps(event)))
+
+
+def register_task_token(job_name, task_token):
+    token_table.put_item(Item={
+        'job_name': job_name,
+        'task_token': task_token,
+        'expires_at': int(time.time()) + TOKEN_TTL_SECONDS
+    })
+
+    # The state change event of a job that already ended found no token
+    try:
+        job = sm_client.describe_processing_job(ProcessingJobName=job_name)
+    except Exception as e:
+        # Not fatal: the state change event still resumes the workflow
+        print('Could not check processing job {}: {}'.format(job_name, e))
+        return {'statusCode': 200, 'Resumed': False}
+
+    resumed = job['ProcessingJobStatus'] in TERMINAL_STATUSES and complete_task(job)
+    return {'statusCode': 200, 'Resumed': resumed}
+
+
+def complete_task(job):
+    """Send the job's result to the waiting task, if this call is the one that claims its token."""
+    job_name = job['ProcessingJobName']
+    claimed = token_table.delete_item(Key={'job_name': job_name}, ReturnValues='ALL_OLD').get('Attributes')
+    if not claimed:
+        return False
+
+    status = job['ProcessingJobStatus']
+    if status == 'Completed':
+        sfn_client.send_task_success(taskToken=claimed['task_token'], output=json.dumps({
+            'ProcessingJobName': job_name,
+            'ProcessingJobStatus': status
+        }))
+    else:
+        sfn_client.send_task_failure(taskToken=claimed['task_token'], error='ProcessingJobFailed',
+            cause='Processing job {} {}: {}'.format(job_name, status.lower(), job.get('FailureReason', ''))[:32768])
+    return True
@@ -1,11 +1,38 @@
 import boto3
 import logging
 import json
+import os
+import datetime
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 sm_client = boto3.client('sagemaker')
 
+# Adaptive backoff for the workflow's polling loop: the next query comes after WAIT_FRACTION of the time
+# the job has been running, within [MIN_WAIT_SECONDS, MAX_WAIT_SECONDS]. Short jobs are checked often,
+# long ones rarely, and a job is noticed at most about WAIT_FRACTION of its run time after it finishes.
+# The workflow's Wait state reads WaitSeconds from the result (SecondsPath).
+MIN_WAIT_SECONDS = int(os.environ.get('MIN_WAIT_SECONDS', 30))
+MAX_WAIT_SECONDS = int(os.environ.get('MAX_WAIT_SECONDS', 300))
+WAIT_FRACTION = float(os.environ.get('WAIT_FRACTION', 0.05))
+
+
+class ProcessingStatusUnavailable(Exception):
+    """describe_processing_job failed; the workflow retries the query with backoff, then fails."""
+
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def wait_seconds(response, now=None):
+    started = response.get('ProcessingStartTime') or response.get('CreationTime')
+    if started is None:
+        return MIN_WAIT_SECONDS
+    elapsed = ((now or utcnow()) - started).total_seconds()
+    return int(min(MAX_WAIT_SECONDS, max(MIN_WAIT_SECONDS, WAIT_FRACTION * elapsed)))
+
+
 #Retrieve processsing job name from event and return processing job status
 def lambda_handler(event, context):
 
@@ -24,13 +51,15 @@ def lambda_handler(event, context):
         print(response)
 
     except Exception as e:
-        response = ('Failed to read processing status!'+ 
-                    ' The processing job may not exist or the job name may be incorrect.'+ 
-                    ' Check SageMaker to confirm the job name.')
+        message = ('Failed to read processing status!'+
+                   ' The processing job may not exist or the job name may be incorrect.'+
+                   ' Check SageMaker to confirm the job name.')
         print(e)
-        print('{} Attempted to read job name: {}.'.format(response, job_name))
+        print('{} Attempted to read job name: {}.'.format(message, job_name))
+        raise ProcessingStatusUnavailable('{} Job name: {}. Error: {}'.format(message, job_name, e))
 
     return {
         'statusCode': 200,
-        'ProcessingJobStatus': response['ProcessingJobStatus']
-    }
\ No newline at end of file
+        'ProcessingJobStatus': response['ProcessingJobStatus'],
+        'WaitSeconds': wait_seconds(response)
+    }
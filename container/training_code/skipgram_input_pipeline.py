@@ -0,0 +1,227 @@
+# Skip-gram input pipeline: (center, context, negatives) batches from the pre-generated pair shards.
+#
+# Builds the training batches off the training loop's critical path:
+#
+#   shards        pairs/part-*.parquet from streaming_preprocessing.py, split between the workers with
+#                 distributed_utils.shard_files and read one shard at a time
+#   subsampling   frequent items are dropped with the word2vec keep probability
+#                 (sqrt(f / t) + 1) * t / f of their frequency f, for threshold t (0 turns it off);
+#                 a pair is kept when both its items are
+#   shuffling     within a buffer of shuffle_buffer pairs, so memory stays bounded by the buffer
+#   negatives     drawn from the unigram^noise_power distribution with an alias table, O(1) per draw
+#   prefetch      a background thread keeps up to prefetch_batches batches ready in a bounded queue;
+#                 numpy releases the GIL in the heavy parts, so this overlaps with the training step
+#
+# The options come from hyperparameters.json through the train entrypoint, which passes every
+# hyperparameter as --<name> <value>; add_arguments declares them for the training scripts.
+# as_tf_dataset wraps the pipeline for a tf.data based script.
+
+from __future__ import print_function
+
+import os
+import glob
+import queue
+import threading
+
+import numpy as np
+import pandas as pd
+
+import distributed_utils
+
+DEFAULT_NEGATIVES = 5
+DEFAULT_NOISE_POWER = 0.75
+DEFAULT_SUBSAMPLE_THRESHOLD = 1e-3
+DEFAULT_SHUFFLE_BUFFER = 1000000
+DEFAULT_PREFETCH_BATCHES = 8
+DEFAULT_MAX_PAIR_REPEAT = 5
+
+
+def add_arguments(parser):
+    """The pipeline's hyperparameters, as options of a training script's argument parser."""
+    parser.add_argument('--negatives', type=int, default=DEFAULT_NEGATIVES)
+    parser.add_argument('--noise_power', type=float, default=DEFAULT_NOISE_POWER)
+    parser.add_argument('--subsample_threshold', type=float, default=DEFAULT_SUBSAMPLE_THRESHOLD)
+    parser.add_argument('--shuffle_buffer', type=int, default=DEFAULT_SHUFFLE_BUFFER)
+    parser.add_argument('--prefetch_batches', type=int, default=DEFAULT_PREFETCH_BATCHES)
+    parser.add_argument('--max_pair_repeat', type=int, default=DEFAULT_MAX_PAIR_REPEAT)
+    return parser
+
+
+def keep_probabilities(counts, threshold=DEFAULT_SUBSAMPLE_THRESHOLD):
+    """word2vec subsampling: the probability of keeping an occurrence of each item."""
+    counts = np.asarray(counts, dtype=np.float64)
+    if threshold <= 0 or not len(counts):
+        return np.ones(len(counts))
+    frequencies = counts / counts.sum()
+    ratio = frequencies / threshold
+    with np.errstate(divide='ignore', invalid='ignore'):
+        keep = (np.sqrt(ratio) + 1) / ratio
+    return np.where(frequencies > 0, np.minimum(keep, 1.0), 1.0)
+
+
+class AliasTable(object):
+    """Walker/Vose alias table: samples from a fixed discrete distribution in O(1) per draw."""
+
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        n = len(weights)
+        scaled = weights * (n / weights.sum())
+        self.probability = np.ones(n)
+        self.alias = np.arange(n)
+        small = list(np.flatnonzero(scaled < 1.0))
+        large = list(np.flatnonzero(scaled >= 1.0))
+        while small and large:
+            s = small.pop()
+            l = large[-1]
+            self.probability[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            if scaled[l] < 1.0:
+                small.append(large.pop())
+        # Whatever is left is 1 up to rounding
+        self.probability[small] = 1.0
+        self.probability[large] = 1.0
+
+    def sample(self, rng, size):
+        columns = rng.randint(0, len(self.probability), size)
+        use_alias = rng.random_sample(size) >= self.probability[columns]
+        return np.where(use_alias, self.alias[columns], columns)
+
+
+class Prefetcher(object):
+    """Iterates over iterable in a background thread, keeping up to depth items ready."""
+
+    _done = object()
+
+    def __init__(self, iterable, depth=DEFAULT_PREFETCH_BATCHES):
+        self.queue = queue.Queue(maxsize=max(depth, 1))
+        self.error = None
+        self.stopped = False
+        self.thread = threading.Thread(target=self._fill, args=(iterable,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _fill(self, iterable):
+        try:
+            for item in iterable:
+                if self.stopped:
+                    return
+                self.queue.put(item)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.queue.put(self._done)
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is self._done:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield item
+
+    def close(self):
+        """Stop the background thread early, e.g. when the consumer does not exhaust the iterator."""
+        self.stopped = True
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+class InputPipeline(object):
+    """Batches of (centers, contexts, negatives) as vocabulary positions, for one worker of size."""
+
+    def __init__(self, pairs_root, batch_value, negatives=DEFAULT_NEGATIVES, noise_power=DEFAULT_NOISE_POWER,
+                 subsample_threshold=DEFAULT_SUBSAMPLE_THRESHOLD, shuffle_buffer=DEFAULT_SHUFFLE_BUFFER,
+                 prefetch_batches=DEFAULT_PREFETCH_BATCHES, max_pair_repeat=DEFAULT_MAX_PAIR_REPEAT,
+                 rank=0, size=1, seed=0):
+        vocab = pd.read_parquet(os.path.join(pairs_root, 'vocab.parquet'))
+        self.ids = vocab['id'].values
+        self.id_index = pd.Index(self.ids)
+        counts = vocab['count'].values.astype(np.float64)
+        self.keep = keep_probabilities(counts, subsample_threshold)
+        self.noise = AliasTable(counts ** noise_power)
+        self.files = distributed_utils.shard_files(glob.glob(os.path.join(pairs_root, 'pairs', '*.parquet')),
+                                                   rank, size)
+        self.batch_value = batch_value
+        self.negatives = negatives
+        self.shuffle_buffer = max(shuffle_buffer, batch_value)
+        self.prefetch_batches = prefetch_batches
+        self.max_pair_repeat = max_pair_repeat
+        self.rng = np.random.RandomState(seed + 1 + rank)
+
+    def _read_shard(self, path):
+        frame = pd.read_parquet(path)
+        repeat = np.minimum(frame['count'].values, self.max_pair_repeat)
+        centers = np.repeat(self.id_index.get_indexer(frame['center'].values), repeat)
+        contexts = np.repeat(self.id_index.get_indexer(frame['context'].values), repeat)
+        known = (centers >= 0) & (contexts >= 0)
+        centers = centers[known]
+        contexts = contexts[known]
+        kept = self.rng.random_sample(len(centers)) < self.keep[centers] * self.keep[contexts]
+        return centers[kept], contexts[kept]
+
+    def _buffers(self):
+        """Shuffled buffers of about shuffle_buffer pairs, over the shards in a random order."""
+        pending_centers, pending_contexts, pending = [], [], 0
+        for position in self.rng.permutation(len(self.files)):
+            centers, contexts = self._read_shard(self.files[position])
+            pending_centers.append(centers)
+            pending_contexts.append(contexts)
+            pending += len(centers)
+            if pending >= self.shuffle_buffer:
+                yield self._shuffled(pending_centers, pending_contexts)
+                pending_centers, pending_contexts, pending = [], [], 0
+        if pending:
+            yield self._shuffled(pending_centers, pending_contexts)
+
+    def _shuffled(self, centers, contexts):
+        centers = np.concatenate(centers)
+        contexts = np.concatenate(contexts)
+        order = self.rng.permutation(len(centers))
+        return centers[order], contexts[order]
+
+    def batches(self):
+        """One epoch of batches, built in the calling thread."""
+        carry_centers = carry_contexts = np.empty(0, dtype=np.int64)
+        for centers, contexts in self._buffers():
+            centers = np.concatenate([carry_centers, centers])
+            contexts = np.concatenate([carry_contexts, contexts])
+            full = len(centers) - len(centers) % self.batch_value
+            for start in range(0, full, self.batch_value):
+                yield self._batch(centers[start:start + self.batch_value], contexts[start:start + self.batch_value])
+            carry_centers, carry_contexts = centers[full:], contexts[full:]
+        if len(carry_centers):
+            yield self._batch(carry_centers, carry_contexts)
+
+    def _batch(self, centers, contexts):
+        return centers, contexts, self.noise.sample(self.rng, (len(centers), self.negatives))
+
+    def epoch(self):
+        """One epoch of batches, prefetched in a background thread unless prefetch_batches is 0."""
+        if self.prefetch_batches <= 0:
+            return self.batches()
+        return Prefetcher(self.batches(), self.prefetch_batches)
+
+
+def from_args(pairs_root, args, rank=0, size=1, seed=0):
+    """An InputPipeline configured from the options declared by add_arguments."""
+    return InputPipeline(pairs_root, args.batch_value, negatives=args.negatives, noise_power=args.noise_power,
+                         subsample_threshold=args.subsample_threshold, shuffle_buffer=args.shuffle_buffer,
+                         prefetch_batches=args.prefetch_batches, max_pair_repeat=args.max_pair_repeat,
+                         rank=rank, size=size, seed=seed)
+
+
+def as_tf_dataset(pipeline):
+    """One epoch of the pipeline as a prefetching tf.data.Dataset of ((centers, contexts), negatives)."""
+    import tensorflow as tf
+    # output_types/output_shapes rather than output_signature, which needs TF 2.4 (the image ships 2.1)
+    dataset = tf.data.Dataset.from_generator(
+        lambda: (((c, x), n) for c, x, n in pipeline.batches()),
+        output_types=((tf.int64, tf.int64), tf.int64),
+        output_shapes=((tf.TensorShape([None]), tf.TensorShape([None])),
+                       tf.TensorShape([None, pipeline.negatives])))
+    return dataset.prefetch(pipeline.prefetch_batches or tf.data.experimental.AUTOTUNE)
@@ -0,0 +1,253 @@
+# Streaming preprocessing: interaction snapshot -> skip-gram pair counts, in bounded memory.
+#
+# The snapshot is never loaded whole. Its parquet row groups are read one batch at a time and the work
+# is done in three passes over hash partitions spilled to local disk:
+#
+#   1. rows       every batch is routed by hash(user) to one of --partitions spill files, so all the
+#                 interactions of a user end up in the same partition
+#   2. pairs      each row partition is loaded alone, sorted into one sentence per user (its items in
+#                 time order) and the (center, context) pairs within --window are routed by hash(center)
+#                 to the pair spill files. Item frequencies are counted on the way.
+#   3. counts     each pair partition is loaded alone, its pairs counted and written as a shard
+#
+# Peak memory is about one batch plus one partition, so more partitions handle larger snapshots.
+#
+# Output, in --output:
+#   pairs/part-<partition>.parquet   center, context, count (the co-occurrence counts within the window)
+#   vocab.parquet                    id, count (item frequencies, for subsampling and negative sampling)
+#   summary.json                     row, pair and throughput counters
+#
+# --input is a file, a directory of parquet files or, in FastFile mode, an s3:// URI read with ranged
+# GETs; parquet needs random access to its footer, so it cannot be read from a Pipe-mode FIFO.
+# In incremental mode (TRAINING_MODE=incremental) rows already in --previous are skipped.
+
+from __future__ import print_function
+
+import os
+import glob
+import json
+import time
+import shutil
+import argparse
+import resource
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+INPUT_DATA_PATH = '/opt/ml/processing/input_data'
+PREVIOUS_INPUT_DATA_PATH = '/opt/ml/processing/previous_input_data'
+PROCESSED_DATA_PATH = '/opt/ml/processing/processed_data'
+PAIRS_DIR = 'pairs'
+VOCAB_FILE = 'vocab.parquet'
+SUMMARY_FILE = 'summary.json'
+
+DEFAULT_USER_COLUMN = 'user_id'
+DEFAULT_ITEM_COLUMN = 'target_id'
+DEFAULT_PARTITIONS = 64
+DEFAULT_BATCH_ROWS = 1000000
+DEFAULT_WINDOW = 5
+
+
+def parquet_sources(path):
+    """The parquet files to read for path, opened for random access (ranged GETs for s3:// URIs)."""
+    if path.startswith('s3://'):
+        from pyarrow import fs
+        s3, key = fs.FileSystem.from_uri(path)
+        info = s3.get_file_info(key)
+        if info.type == fs.FileType.Directory:
+            selector = fs.FileSelector(key, recursive=True)
+            keys = sorted(i.path for i in s3.get_file_info(selector) if i.type == fs.FileType.File)
+        else:
+            keys = [key]
+        return [s3.open_input_file(k) for k in keys]
+    if os.path.isdir(path):
+        return sorted(p for p in glob.glob(os.path.join(path, '**', '*'), recursive=True) if os.path.isfile(p))
+    return [path]
+
+
+def iter_batches(path, columns, batch_rows=DEFAULT_BATCH_ROWS):
+    """Yield DataFrames of at most batch_rows rows, one row group at a time."""
+    for source in parquet_sources(path):
+        parquet_file = pq.ParquetFile(source)
+        for row_group in range(parquet_file.num_row_groups):
+            table = parquet_file.read_row_group(row_group, columns=columns)
+            for offset in range(0, table.num_rows, batch_rows):
+                yield table.slice(offset, batch_rows).to_pandas()
+
+
+def partition_of(values, n_partitions):
+    return (pd.util.hash_array(np.asarray(values)) % np.uint64(n_partitions)).astype(np.int64)
+
+
+class HashSpill(object):
+    """Parquet spill files on local disk, one per hash partition of key_column."""
+
+    def __init__(self, directory, n_partitions, key_column):
+        self.directory = directory
+        self.n_partitions = n_partitions
+        self.key_column = key_column
+        self.writers = {}
+        self.rows = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def path(self, partition):
+        return os.path.join(self.directory, 'spill-{:05d}.parquet'.format(partition))
+
+    def append(self, frame):
+        if not len(frame):
+            return
+        partitions = partition_of(frame[self.key_column].values, self.n_partitions)
+        order = np.argsort(partitions, kind='mergesort')
+        partitions = partitions[order]
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(partitions)) + 1])
+        for start, rows in zip(starts, np.split(order, starts[1:])):
+            partition = int(partitions[start])
+            table = pa.Table.from_pandas(frame.iloc[rows], preserve_index=False)
+            if partition not in self.writers:
+                self.writers[partition] = pq.ParquetWriter(self.path(partition), table.schema)
+            self.writers[partition].write_table(table)
+        self.rows += len(frame)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+    def partitions(self):
+        """Yield every non-empty partition as a DataFrame, deleting its file once read."""
+        self.close()
+        for partition in sorted(self.writers):
+            path = self.path(partition)
+            frame = pq.read_table(path).to_pandas()
+            os.remove(path)
+            yield partition, frame
+
+
+def sentence_pairs(frame, user_column, item_column, time_column=None, window=DEFAULT_WINDOW):
+    """(center, context) pairs of every user's items within window of each other, both directions."""
+    sort_columns = [user_column] + ([time_column] if time_column else [])
+    frame = frame.sort_values(sort_columns, kind='mergesort')
+    users = frame[user_column].values
+    items = frame[item_column].values
+    centers = []
+    contexts = []
+    for offset in range(1, window + 1):
+        if offset >= len(items):
+            break
+        same_user = users[:-offset] == users[offset:]
+        left = items[:-offset][same_user]
+        right = items[offset:][same_user]
+        centers.extend([left, right])
+        contexts.extend([right, left])
+    if not centers:
+        return pd.DataFrame({'center': items[:0], 'context': items[:0]})
+    return pd.DataFrame({'center': np.concatenate(centers), 'context': np.concatenate(contexts)})
+
+
+def previous_row_hashes(path, columns, batch_rows):
+    """Sorted hashes of every row of the previous snapshot, for skipping unchanged rows."""
+    hashes = [pd.util.hash_pandas_object(batch[columns], index=False).values
+              for batch in iter_batches(path, columns, batch_rows)]
+    return np.unique(np.concatenate(hashes)) if hashes else np.array([], dtype=np.uint64)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def preprocess(input_path, output_dir, user_column=DEFAULT_USER_COLUMN, item_column=DEFAULT_ITEM_COLUMN,
+               time_column=None, window=DEFAULT_WINDOW, partitions=DEFAULT_PARTITIONS,
+               batch_rows=DEFAULT_BATCH_ROWS, previous_path=None, spill_dir=None):
+    """Run the three passes described at the top of the module. Returns the summary."""
+    start = time.time()
+    columns = [user_column, item_column] + ([time_column] if time_column else [])
+    spill_dir = spill_dir or os.path.join(output_dir, '_spill')
+    pairs_dir = os.path.join(output_dir, PAIRS_DIR)
+    if not os.path.exists(pairs_dir):
+        os.makedirs(pairs_dir)
+
+    skip_hashes = previous_row_hashes(previous_path, columns, batch_rows) if previous_path else None
+
+    # Pass 1: rows by user
+    row_spill = HashSpill(os.path.join(spill_dir, 'rows'), partitions, user_column)
+    input_rows = 0
+    for batch in iter_batches(input_path, columns, batch_rows):
+        input_rows += len(batch)
+        if skip_hashes is not None:
+            hashes = pd.util.hash_pandas_object(batch[columns], index=False).values
+            batch = batch[~np.isin(hashes, skip_hashes)]
+        row_spill.append(batch)
+    read_done = time.time()
+
+    # Pass 2: sentences -> pairs by center, and the item frequencies
+    pair_spill = HashSpill(os.path.join(spill_dir, 'pairs'), partitions, 'center')
+    vocab = None
+    for _, rows in row_spill.partitions():
+        counts = rows[item_column].value_counts()
+        vocab = counts if vocab is None else vocab.add(counts, fill_value=0)
+        pair_spill.append(sentence_pairs(rows, user_column, item_column, time_column, window))
+
+    # Pass 3: count the pairs of each partition and write it as a shard
+    shards = 0
+    distinct_pairs = 0
+    for partition, pairs in pair_spill.partitions():
+        counts = pairs.groupby(['center', 'context'], sort=False).size().reset_index(name='count')
+        counts['count'] = counts['count'].astype(np.int64)
+        counts.to_parquet(os.path.join(pairs_dir, 'part-{:05d}.parquet'.format(partition)), index=False)
+        shards += 1
+        distinct_pairs += len(counts)
+
+    if vocab is None:
+        vocab = pd.Series([], dtype=np.int64)
+    vocab = vocab.astype(np.int64).sort_values(ascending=False, kind='mergesort')
+    pd.DataFrame({'id': vocab.index.values, 'count': vocab.values}).to_parquet(
+        os.path.join(output_dir, VOCAB_FILE), index=False)
+    shutil.rmtree(spill_dir, ignore_errors=True)
+
+    elapsed = time.time() - start
+    summary = {
+        'input_rows': int(input_rows),
+        'rows': int(row_spill.rows),
+        'pairs': int(pair_spill.rows),
+        'distinct_pairs': int(distinct_pairs),
+        'vocab': int(len(vocab)),
+        'shards': shards,
+        'partitions': partitions,
+        'read_seconds': round(read_done - start, 3),
+        'seconds': round(elapsed, 3),
+        'rows_per_second': round(input_rows / elapsed, 1) if elapsed > 0 else None,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+    with open(os.path.join(output_dir, SUMMARY_FILE), 'w') as f:
+        json.dump(summary, f)
+    print(json.dumps(summary))
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Streaming skip-gram preprocessing')
+    parser.add_argument('--input', default=os.environ.get('INPUT_S3_URI', INPUT_DATA_PATH),
+                        help='Parquet file, directory or s3:// URI (FastFile mode)')
+    parser.add_argument('--output', default=PROCESSED_DATA_PATH)
+    parser.add_argument('--previous', default=None, help='Previous snapshot, for incremental runs')
+    parser.add_argument('--user-column', default=os.environ.get('PREPROCESS_USER_COLUMN', DEFAULT_USER_COLUMN))
+    parser.add_argument('--item-column', default=os.environ.get('PREPROCESS_ITEM_COLUMN', DEFAULT_ITEM_COLUMN))
+    parser.add_argument('--time-column', default=os.environ.get('PREPROCESS_TIME_COLUMN') or None)
+    parser.add_argument('--window', type=int, default=int(os.environ.get('PREPROCESS_WINDOW', DEFAULT_WINDOW)))
+    parser.add_argument('--partitions', type=int,
+                        default=int(os.environ.get('PREPROCESS_PARTITIONS', DEFAULT_PARTITIONS)))
+    parser.add_argument('--batch-rows', type=int,
+                        default=int(os.environ.get('PREPROCESS_BATCH_ROWS', DEFAULT_BATCH_ROWS)))
+    parser.add_argument('--spill-dir', default=None, help='Local scratch space; defaults to <output>/_spill')
+    args = parser.parse_args()
+
+    previous = args.previous
+    if previous is None and os.environ.get('TRAINING_MODE') == 'incremental' and \
+            os.path.exists(PREVIOUS_INPUT_DATA_PATH):
+        previous = PREVIOUS_INPUT_DATA_PATH
+
+    preprocess(args.input, args.output, args.user_column, args.item_column, args.time_column, args.window,
+               args.partitions, args.batch_rows, previous, args.spill_dir)
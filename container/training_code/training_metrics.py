@@ -0,0 +1,158 @@
+# Per-epoch training instrumentation shared by the training script and the train entrypoint.
+#
+# The training script times every epoch with EpochMetrics (or the Keras callback from keras_callback)
+# and prints one structured line per epoch:
+#
+#   epoch_metrics {"epoch": 1, "loss": 0.41, "examples_per_sec": 123456.0, ...}
+#
+# The train entrypoint picks these lines out of the script's stdout, appends them to the JSON metrics
+# file in /opt/ml/output/data and prints them as a key/value line that the estimator's metric
+# definitions match, e.g. 'train:loss' with '.*loss:\s*(\S+).*'.
+
+from __future__ import print_function
+
+import sys
+import json
+import time
+import resource
+from contextlib import contextmanager
+
+METRICS_PREFIX = 'epoch_metrics '
+
+# Printed by format_metric_line, in this order; regexes of the estimator's metric definitions
+METRIC_DEFINITIONS = [
+    {'Name': 'train:loss', 'Regex': '.*loss:\\s*(\\S+).*'},
+    {'Name': 'train:examples_per_sec', 'Regex': '.*examples_per_sec:\\s*(\\S+).*'},
+    {'Name': 'train:epoch_seconds', 'Regex': '.*epoch_seconds:\\s*(\\S+).*'},
+    {'Name': 'train:data_seconds', 'Regex': '.*data_seconds:\\s*(\\S+).*'},
+    {'Name': 'train:compute_seconds', 'Regex': '.*compute_seconds:\\s*(\\S+).*'},
+    {'Name': 'train:peak_memory_mb', 'Regex': '.*peak_memory_mb:\\s*(\\S+).*'},
+]
+
+
+def peak_memory_mb():
+    """Peak RSS of this process and its finished children, in MB (ru_maxrss is in KB on Linux)."""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024.0
+
+
+class EpochMetrics(object):
+    """Splits each epoch's wall time into data loading and compute and counts the examples seen."""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self.epoch = 0
+        self.history = []
+        self._reset()
+
+    def _reset(self):
+        self.examples = 0
+        self.data_seconds = 0.0
+        self.compute_seconds = 0.0
+        self.epoch_start = time.time()
+
+    def start_epoch(self, epoch=None):
+        self.epoch = self.epoch + 1 if epoch is None else epoch
+        self._reset()
+
+    @contextmanager
+    def data(self):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.data_seconds += time.time() - start
+
+    @contextmanager
+    def compute(self, examples=0):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.compute_seconds += time.time() - start
+            self.examples += examples
+
+    def end_epoch(self, loss=None, **extra):
+        """Close the epoch, print its structured line and return the metrics."""
+        epoch_seconds = time.time() - self.epoch_start
+        metrics = {
+            'epoch': self.epoch,
+            'loss': None if loss is None else float(loss),
+            'examples': int(self.examples),
+            'examples_per_sec': round(self.examples / epoch_seconds, 1) if epoch_seconds > 0 else None,
+            'epoch_seconds': round(epoch_seconds, 3),
+            'data_seconds': round(self.data_seconds, 3),
+            'compute_seconds': round(self.compute_seconds, 3),
+            'peak_memory_mb': round(peak_memory_mb(), 1),
+        }
+        metrics.update(extra)
+        self.history.append(metrics)
+        print(METRICS_PREFIX + json.dumps(metrics), file=self.stream)
+        self.stream.flush()
+        return metrics
+
+
+def keras_callback(metrics=None, batch_size=None):
+    """
+    A tf.keras callback feeding EpochMetrics: the time between batches counts as data loading, the time
+    inside a batch as compute.
+    """
+    import tensorflow as tf
+    metrics = metrics or EpochMetrics()
+
+    class EpochMetricsCallback(tf.keras.callbacks.Callback):
+
+        def on_epoch_begin(self, epoch, logs=None):
+            metrics.start_epoch(epoch + 1)
+            self.batch_end = time.time()
+
+        def on_train_batch_begin(self, batch, logs=None):
+            self.batch_start = time.time()
+            metrics.data_seconds += self.batch_start - self.batch_end
+
+        def on_train_batch_end(self, batch, logs=None):
+            self.batch_end = time.time()
+            metrics.compute_seconds += self.batch_end - self.batch_start
+            metrics.examples += (logs or {}).get('size', batch_size or 0)
+
+        def on_epoch_end(self, epoch, logs=None):
+            logs = logs or {}
+            metrics.end_epoch(logs.get('loss'), **dict((k, float(v)) for k, v in logs.items() if k != 'loss'))
+
+    return EpochMetricsCallback()
+
+
+def parse_line(line):
+    """The metrics of a structured epoch line, or None for any other line."""
+    if not line.startswith(METRICS_PREFIX):
+        return None
+    try:
+        return json.loads(line[len(METRICS_PREFIX):])
+    except ValueError:
+        return None
+
+
+def format_metric_line(metrics):
+    """'epoch: 1 loss: 0.41 examples_per_sec: ...' for the estimator's metric definition regexes."""
+    keys = ['epoch'] + [d['Name'].split(':', 1)[1] for d in METRIC_DEFINITIONS]
+    return ' '.join('{}: {}'.format(k, metrics[k]) for k in keys if metrics.get(k) is not None)
+
+
+def summarize(history):
+    """Totals over the epochs so far, to find whether loading or compute bounds the run."""
+    if not history:
+        return {}
+    total_seconds = sum(m['epoch_seconds'] for m in history)
+    data_seconds = sum(m['data_seconds'] for m in history)
+    compute_seconds = sum(m['compute_seconds'] for m in history)
+    examples = sum(m['examples'] for m in history)
+    return {
+        'epochs': len(history),
+        'seconds': round(total_seconds, 3),
+        'examples_per_sec': round(examples / total_seconds, 1) if total_seconds > 0 else None,
+        'data_fraction': round(data_seconds / total_seconds, 4) if total_seconds > 0 else None,
+        'compute_fraction': round(compute_seconds / total_seconds, 4) if total_seconds > 0 else None,
+        'peak_memory_mb': max(m['peak_memory_mb'] for m in history),
+        'final_loss': history[-1].get('loss'),
+    }
@@ -0,0 +1,139 @@
+import re
+import sys
+import json
+import time
+import array
+import struct
+import threading
+
+# Lookup of the precomputed recommendations of the common cold-start cohorts
+#
+# The batch prediction job writes the table (container/training_code/cohort_recommendations.py, which
+# also describes the file format) and the Glue load publishes its S3 URI in an SSM parameter once the
+# users' lists of the same model are loaded. An unregistered user whose (gender, locationId, birth year
+# bucket, top categories) is in the table is answered from it, with the user excluded from the list;
+# other users still go to the endpoint.
+#
+# The key is built here the same way the job builds it from the registered users' profiles: the
+# bucket_years, top_categories and category_rank it used are read from the table's header.
+
+MAGIC = b'RCOH'
+NO_ID = 0xFFFFFFFF
+_YEAR = re.compile(r'(\d{4})')
+
+
+def birth_bucket(birthdate, bucket_years):
+    """The first four-digit year of birthdate rounded down to bucket_years, or birthdate itself."""
+    match = _YEAR.search(str(birthdate))
+    if match is None:
+        return str(birthdate)
+    year = int(match.group(1))
+    return str(year - year % bucket_years)
+
+
+def category_list(categories):
+    if categories is None:
+        return []
+    if isinstance(categories, str):
+        return [c.strip() for c in categories.split(',') if c.strip()]
+    if isinstance(categories, (list, tuple)):
+        return [str(c) for c in categories]
+    return [str(categories)]
+
+
+class CohortTable(object):
+    """A table file held in memory; lists are decoded only for the cohorts that are looked up."""
+
+    def __init__(self, data):
+        data = memoryview(data)
+        if bytes(data[:4]) != MAGIC:
+            raise ValueError('Not a cohort table')
+        header_length = struct.unpack('<I', bytes(data[4:8]))[0]
+        self.header = json.loads(bytes(data[8:8 + header_length]).decode('utf-8'))
+        self.cohorts = self.header['cohorts']
+        self.list_length = int(self.header['list_length'])
+        self.id_width = int(self.header['id_width'])
+        self.bucket_years = int(self.header['bucket_years'])
+        self.top_categories = int(self.header['top_categories'])
+        self.category_rank = dict((c, i) for i, c in enumerate(self.header['category_rank']))
+        vocabulary_start = 8 + header_length
+        self.rows_start = vocabulary_start + int(self.header['vocabulary_size']) * self.id_width
+        self.vocabulary = data[vocabulary_start:self.rows_start]
+        self.data = data
+
+    def __len__(self):
+        return len(self.cohorts)
+
+    @property
+    def model_version(self):
+        return self.header.get('model_version')
+
+    def key(self, features):
+        """The cohort key of a new user's features (gender, locationId, birthdate, followingCategories)."""
+        categories = ''
+        if self.top_categories > 0:
+            unranked = len(self.category_rank)
+            chosen = sorted(set(category_list(features.get('followingCategories'))),
+                            key=lambda c: (self.category_rank.get(c, unranked), c))[:self.top_categories]
+            categories = ','.join(sorted(chosen))
+        return '|'.join([str(features['gender']), str(features['locationId']),
+                         birth_bucket(features['birthdate'], self.bucket_years), categories])
+
+    def lookup(self, features, exclude=None, top_n=None):
+        """The cohort's recommendation ids without exclude, at most top_n; None if the cohort is not in the table."""
+        row = self.cohorts.get(self.key(features))
+        if row is None:
+            return None
+        start = self.rows_start + row * self.list_length * 4
+        positions = array.array('I')
+        positions.frombytes(bytes(self.data[start:start + self.list_length * 4]))
+        if sys.byteorder == 'big':
+            positions.byteswap()
+        width = self.id_width
+        ids = []
+        for position in positions:
+            if position == NO_ID:
+                break
+            encoded = bytes(self.vocabulary[position * width:(position + 1) * width])
+            recommendation_id = encoded.rstrip(b'\0').decode('utf-8')
+            if recommendation_id != str(exclude):
+                ids.append(recommendation_id)
+        return ids[:top_n] if top_n else ids
+
+
+def read_bytes(uri, s3_client=None):
+    """The contents of an s3:// URI or a local path."""
+    if uri.startswith('s3://'):
+        bucket, _, key = uri[len('s3://'):].partition('/')
+        return s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+    with open(uri, 'rb') as f:
+        return f.read()
+
+
+class TableHolder(object):
+    """
+    The table of the current URI, loaded once per warm container and again when the URI changes. A
+    table that fails to load is tried again after retry_seconds; meanwhile get returns None.
+    """
+
+    def __init__(self, retry_seconds=300):
+        self.retry_seconds = retry_seconds
+        self.uri = None
+        self.table = None
+        self.failed_at = None
+        self.lock = threading.Lock()
+
+    def get(self, uri, s3_client=None):
+        if not uri:
+            return None
+        with self.lock:
+            stale = uri != self.uri or (self.failed_at is not None and
+                                        time.time() - self.failed_at >= self.retry_seconds)
+            if stale:
+                self.uri, self.table, self.failed_at = uri, None, None
+                try:
+                    self.table = CohortTable(read_bytes(uri, s3_client))
+                except Exception:
+                    self.failed_at = time.time()
+                    raise
+            return self.table
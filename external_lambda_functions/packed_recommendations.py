@@ -0,0 +1,111 @@
+import os
+import math
+from boto3.dynamodb.conditions import Key
+
+# Packed, chunked storage of recommendation lists in DynamoDB
+#
+# The original layout keeps a user's whole list in one comma-joined 'recommendation_id' string, so every
+# page request reads and splits the full list. In the packed layout:
+#
+# - the item in the 'recommendations' table (user_id, model_id) stays the header: expiry_time plus
+#   rec_count, id_width and chunk_size instead of the list itself
+# - the ids are stored in a 'recommendation_chunks' table, chunk_size ids per item, keyed by
+#   (user_id, chunk_key='<model_id>#<chunk number>'). Each chunk is one Binary attribute of fixed-width
+#   ids, NUL padded, so id i of a chunk is bytes [i*id_width, (i+1)*id_width).
+#
+# A page or range request reads only the chunks that overlap the slice and decodes only the ids in it.
+# Items in the original layout are still read the original way.
+
+CHUNK_TABLE_NAME = os.environ.get('RECOMMENDATION_CHUNKS_TABLE', 'recommendation_chunks')
+DEFAULT_CHUNK_SIZE = 100
+
+
+def is_packed(item):
+    return 'recommendation_id' not in item and 'rec_count' in item
+
+
+def chunk_key(model_id, chunk):
+    return '{}#{:06d}'.format(int(model_id), chunk)
+
+
+def pack_ids(ids):
+    """Encode ids as one fixed-width bytes blob. Returns (blob, id_width)."""
+    encoded = [str(i).encode('utf-8') for i in ids]
+    width = max([len(e) for e in encoded] or [1])
+    return b''.join(e.ljust(width, b'\0') for e in encoded), width
+
+
+def unpack_ids(blob, width, start=0, end=None):
+    """Decode ids [start, end) of a blob written by pack_ids, without touching the rest."""
+    view = memoryview(blob)
+    count = len(view) // width
+    end = count if end is None else min(end, count)
+    return [bytes(view[i * width:(i + 1) * width]).rstrip(b'\0').decode('utf-8') for i in range(start, end)]
+
+
+def slice_bounds(count, start, end):
+    """[start, end) normalised exactly like list[start:end], so page semantics are unchanged."""
+    start, end, _ = slice(start, end).indices(count)
+    return start, max(start, end)
+
+
+def read_slice(chunk_table, item, start=None, end=None):
+    """
+    Return ids [start, end) of a recommendations item, with list slicing semantics.
+
+    Original items are split in memory. Packed items fetch only the overlapping chunks with one query.
+    """
+    if not is_packed(item):
+        return item['recommendation_id'].split(',')[start:end]
+
+    count = int(item['rec_count'])
+    start, end = slice_bounds(count, start, end)
+    if start == end:
+        return []
+
+    chunk_size = int(item.get('chunk_size', DEFAULT_CHUNK_SIZE))
+    width = int(item['id_width'])
+    first_chunk, last_chunk = start // chunk_size, (end - 1) // chunk_size
+    response = chunk_table.query(
+        KeyConditionExpression=Key('user_id').eq(item['user_id']) &
+        Key('chunk_key').between(chunk_key(item['model_id'], first_chunk), chunk_key(item['model_id'], last_chunk))
+    )
+
+    ids = []
+    for chunk in sorted(response['Items'], key=lambda c: c['chunk_key']):
+        chunk_start = int(chunk['chunk_key'].split('#')[1]) * chunk_size
+        blob = chunk['ids'].value if hasattr(chunk['ids'], 'value') else chunk['ids']
+        ids.extend(unpack_ids(blob, width, max(start - chunk_start, 0), end - chunk_start))
+    return ids
+
+
+def packed_items(user_id, model_id, ids, expiry_time, chunk_size=DEFAULT_CHUNK_SIZE):
+    """The header item and the chunk items of a recommendation list in the packed layout."""
+    if isinstance(ids, str):
+        ids = ids.split(',') if ids else []
+    blob, width = pack_ids(ids)
+    n_chunks = int(math.ceil(len(ids) / float(chunk_size)))
+    chunks = [{
+        'user_id': user_id,
+        'chunk_key': chunk_key(model_id, chunk),
+        'ids': blob[chunk * chunk_size * width:(chunk + 1) * chunk_size * width],
+        'expiry_time': expiry_time,
+    } for chunk in range(n_chunks)]
+    header = {
+        'user_id': user_id,
+        'model_id': model_id,
+        'rec_count': len(ids),
+        'id_width': width,
+        'chunk_size': chunk_size,
+        'expiry_time': expiry_time,
+    }
+    return header, chunks
+
+
+def write_packed(table, chunk_table, user_id, model_id, ids, expiry_time, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Write a recommendation list in the packed layout: the chunks first, then the header item."""
+    header, chunks = packed_items(user_id, model_id, ids, expiry_time, chunk_size)
+    with chunk_table.batch_writer(overwrite_by_pkeys=['user_id', 'chunk_key']) as batch:
+        for chunk in chunks:
+            batch.put_item(Item=chunk)
+    return table.put_item(Item=header)
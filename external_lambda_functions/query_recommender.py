@@ -1,39 +1,110 @@
 import json
+import logging
 import boto3
 from boto3.dynamodb.conditions import Key
 import time
-sm_rt_client = boto3.client('runtime.sagemaker')
-ssm_client = boto3.client('ssm')
-db_client = boto3.resource('dynamodb')
+import os
+import cohort_table
+import packed_recommendations
+import rank_fusion
+import request_timing
+import warm_cache
+import write_behind
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+# The clients are created on first use: a registered user's GET only needs DynamoDB, so its cold start
+# skips the SageMaker runtime, SSM and S3 clients
+sm_rt_client = warm_cache.LazyClient(lambda: boto3.client('runtime.sagemaker'))
+ssm_client = warm_cache.LazyClient(lambda: boto3.client('ssm'))
+s3_client = warm_cache.LazyClient(lambda: boto3.client('s3'))
+db_client = warm_cache.LazyClient(lambda: boto3.resource('dynamodb'))
 # Connect to recommendations table in DDB
-recommendations = db_client.Table('recommendations')
+recommendations = warm_cache.LazyClient(lambda: db_client.Table('recommendations'))
+# Chunks of the lists stored in the packed layout, see packed_recommendations
+recommendation_chunks = warm_cache.LazyClient(lambda: db_client.Table(packed_recommendations.CHUNK_TABLE_NAME))
 sm_endpoint_name = 'recommender-endpoint'
+# Layout new-user recommendations are written in: 'string' (comma-joined) or 'packed'
+storage_format = os.environ.get('RECOMMENDATION_STORAGE', 'string')
+
+# Caches kept across invocations while the container is warm:
+# the retrain frequency from SSM, refreshed every SSM_REFRESH_SECONDS, and the recommendation items of
+# recently queried users, kept until their expiry_time but at most USER_CACHE_MAX_AGE_SECONDS so a new
+# batch of recommendations is picked up
+ssm_refresh_seconds = int(os.environ.get('SSM_REFRESH_SECONDS', 300))
+user_cache = warm_cache.TTLCache(int(os.environ.get('USER_CACHE_SIZE', 1024)),
+                                 int(os.environ.get('USER_CACHE_MAX_AGE_SECONDS', 300)))
+config_cache = warm_cache.TTLCache(16, ssm_refresh_seconds)
+cache_stats = warm_cache.CacheStats('ssm', 'users', 'blends', 'cohorts')
+
+# Unregistered users are answered from the precomputed cohort table when their cohort is in it, and from
+# the endpoint otherwise (see cohort_table). The table's URI is read from the SSM parameter
+# COHORT_TABLE_PARAMETER, refreshed with the other SSM settings; COHORT_TABLE=off always uses the endpoint
+cohort_table_enabled = os.environ.get('COHORT_TABLE', 'on').lower() == 'on'
+cohort_table_parameter = os.environ.get('COHORT_TABLE_PARAMETER', 'recommender.cohort_table')
+cohort_tables = cohort_table.TableHolder(int(os.environ.get('COHORT_TABLE_RETRY_SECONDS', 300)))
+# Recommendations per unregistered user, as many as the endpoint returns
+new_user_top_n = 100
+
+# BLENDED_QUERY: the lists of all of a user's non-expired model_ids fused into one with BLEND_METHOD
+# ('rrf' or 'interleave', or q_blend in the query), newer model_ids weighted by BLEND_RECENCY_DECAY.
+# The fused list is kept for the user's page session, BLEND_CACHE_MAX_AGE_SECONDS at most
+blend_method = os.environ.get('BLEND_METHOD', 'rrf')
+blend_rrf_k = int(os.environ.get('BLEND_RRF_K', rank_fusion.DEFAULT_RRF_K))
+blend_recency_decay = float(os.environ.get('BLEND_RECENCY_DECAY', 1.0))
+if not blend_recency_decay > 0:
+    raise ValueError('BLEND_RECENCY_DECAY must be positive, got {}'.format(blend_recency_decay))
+blend_cache = warm_cache.TTLCache(int(os.environ.get('BLEND_CACHE_SIZE', 1024)),
+                                  int(os.environ.get('BLEND_CACHE_MAX_AGE_SECONDS', 900)))
+
+# How new-user recommendations are written to DynamoDB:
+# 'off'      (default) synchronous put before the response is built
+# 'deferred' queued and written by a background thread, so the new user's POST returns without waiting
+#            for DynamoDB. Lambda freezes the container as soon as the handler returns, so a write the
+#            thread has not finished by then completes when the container thaws, while the next
+#            invocation runs. Before returning, every invocation waits for the writes queued before it
+#            started (at most WRITE_BEHIND_FLUSH_SECONDS), so a write is at most one invocation late,
+#            and logs the ones still pending or lost. Writes queued in a container that Lambda reclaims
+#            while frozen are lost; the user then has no stored list, is asked for their attributes
+#            again and their next POST recomputes it.
+write_behind_mode = os.environ.get('WRITE_BEHIND', 'off')
+write_behind_flush_seconds = float(os.environ.get('WRITE_BEHIND_FLUSH_SECONDS', 5))
+write_queue = write_behind.WriteBehindQueue()
+
+# Per-stage timings of each invocation, logged as one structured line (see request_timing)
+timings = request_timing.StageTimings()
 
 def lambda_handler(event, context):
+    timings.reset()
+    query_type, status_code = None, 500
+    carried_writes = write_queue.mark()
     try:
         
         #print("Got event\n", event)
         
         # Process POST request for unregistered users
         if 'body' in event and event['body'] is not None:
+            query_type = 'NEW_USER'
             response_body, status_code = handle_new_user_query(event['body'])
         
         # Process GET request for registered users    
         else:
+            query_type = event['queryStringParameters'].get('q_type')
             query_user_id = event['queryStringParameters']['q_user_id']
-            ddb_query_response = recommendations.query(
-                    KeyConditionExpression=Key('user_id').eq(query_user_id)
-            )
             query_model_id = -1
             if 'q_model_id' in event['queryStringParameters'].keys():
                 query_model_id = int(event['queryStringParameters']['q_model_id'])
+            if event['queryStringParameters']['q_type'] == 'BLENDED_QUERY':
+                # Every model_id is blended; the fused list may already be cached for this user
+                ddb_items = []
+            else:
+                ddb_items = get_user_items(query_user_id, query_model_id)
         
             # Check if user_id has got pre-computed recommendations
             # Otherwise, potential new user, ask for user attributes
-            item_exists = check_if_item_exists(event, ddb_query_response['Items'])
+            item_exists = check_if_item_exists(event, ddb_items)
 
             if item_exists:
-                ddb_recs = ddb_query_response['Items'][query_model_id]
+                ddb_recs = dict(ddb_items[query_model_id])
                 
             # Requests are abstracted as queries based on model_id
             # model_id is a flexible indicator for any concept in future, depending on the use case.
@@ -55,6 +126,12 @@ def lambda_handler(event, context):
                     response_body, status_code = handle_potential_new_user(event)
                 else:
                     response_body, status_code = handle_range_query(event['queryStringParameters'], ddb_recs)
+
+            elif event['queryStringParameters']['q_type'] == 'BLENDED_QUERY':
+                if 'q_page_id' in event['queryStringParameters'].keys():
+                    response_body, status_code = handle_blended_query(event, event['queryStringParameters'])
+                else:
+                    response_body, status_code = handle_malformed_query(event, ['page_id'])
     
             else:
                 response_body, status_code = handle_malformed_query(event, ['query_type', 'user_id', 'page_id', 'model_id'])
@@ -64,7 +141,8 @@ def lambda_handler(event, context):
         if 'model_id' in response_body:
             response_body['model_id'] = str(response_body['model_id'])
 
-        string_body  = json.dumps(response_body)
+        with timings.stage('encode'):
+            string_body  = json.dumps(response_body)
         response_object = {
             'statusCode': status_code,
             'headers': {'Content-Type': 'application/json'},
@@ -77,7 +155,106 @@ def lambda_handler(event, context):
         
     else:
         return response_object
+    finally:
+        flush_write_behind(carried_writes)
+        logger.info('Warm cache: ' + json.dumps(cache_stats.summary()))
+        timings.log(query_type, status_code, request_id=getattr(context, 'aws_request_id', None))
+
+def flush_write_behind(carried_writes):
+    '''
+    Wait, at most write_behind_flush_seconds, for the writes queued before this invocation started
+    (write_queue.mark()), and report the ones still pending or lost.
+    '''
+    if not write_queue.pending() and write_queue.failed == write_queue.reported_failed:
+        return
+    with timings.stage('flush'):
+        drained = write_queue.flush(write_behind_flush_seconds, through=carried_writes)
+    stats = write_queue.stats()
+    if not drained:
+        logger.warning('Write-behind still pending after {}s: {}'.format(write_behind_flush_seconds,
+                                                                         json.dumps(stats)))
+    if stats['failed'] > write_queue.reported_failed:
+        logger.error('Write-behind lost {} writes: {}'.format(stats['failed'] - write_queue.reported_failed,
+                                                              json.dumps(stats)))
+        write_queue.reported_failed = stats['failed']
+
+def get_user_items(user_id, query_model_id=-1):
+    '''
+    Get the recommendation items of a user, oldest model_id first, from the warm cache or DynamoDB.
+
+    For the default query_model_id of -1 only the latest item is needed, so only that one is read;
+    any other value reads all of them.
+    '''
+    if query_model_id == -1:
+        cache_key = ('latest', user_id)
+    else:
+        cache_key = ('all', user_id)
+
+    items = user_cache.get(cache_key)
+    if items is not None:
+        cache_stats.hit('users')
+        return items
+    cache_stats.miss('users')
+
+    with timings.stage('ddb_query'):
+        if query_model_id == -1:
+            ddb_query_response = recommendations.query(
+                    KeyConditionExpression=Key('user_id').eq(user_id),
+                    ScanIndexForward=False,
+                    Limit=1
+            )
+        else:
+            ddb_query_response = recommendations.query(
+                    KeyConditionExpression=Key('user_id').eq(user_id)
+            )
+    items = ddb_query_response['Items']
+
+    if items:
+        # Keep the items no longer than the earliest of them expires
+        expiry_times = [int(item['expiry_time']) for item in items if 'expiry_time' in item]
+        user_cache.put(cache_key, items, min(expiry_times) if expiry_times else None)
+    return items
+
+def get_retrain_freq_in_days():
+    '''Retrain frequency from SSM, cached for ssm_refresh_seconds'''
+    retrain_freq_in_days = config_cache.get('recommender.retrain_freq')
+    if retrain_freq_in_days is not None:
+        cache_stats.hit('ssm')
+        return retrain_freq_in_days
+    cache_stats.miss('ssm')
+    with timings.stage('ssm'):
+        retrain_freq_in_days = (ssm_client.get_parameter(Name='recommender.retrain_freq', WithDecryption=True))['Parameter']['Value']
+    config_cache.put('recommender.retrain_freq', retrain_freq_in_days)
+    return retrain_freq_in_days
     
+def get_cohort_table():
+    '''The current cohort table, or None when there is none or it cannot be loaded'''
+    if not cohort_table_enabled:
+        return None
+    uri = config_cache.get(cohort_table_parameter)
+    if uri is None:
+        cache_stats.miss('ssm')
+        with timings.stage('ssm'):
+            try:
+                uri = ssm_client.get_parameter(Name=cohort_table_parameter)['Parameter']['Value']
+            except ssm_client.exceptions.ParameterNotFound:
+                uri = ''
+            except Exception as e:
+                # e.g. throttling or a missing permission: no table until the next refresh, so the
+                # requests meanwhile neither fail nor each retry SSM
+                logger.warning('Cohort table parameter {} not read, using the endpoint: {}'.format(
+                    cohort_table_parameter, e))
+                uri = ''
+        config_cache.put(cohort_table_parameter, uri)
+    else:
+        cache_stats.hit('ssm')
+    try:
+        with timings.stage('cohort_load'):
+            return cohort_tables.get(uri, s3_client)
+    except Exception as e:
+        logger.warning('Cohort table {} not loaded, using the endpoint: {}'.format(uri, e))
+        return None
+
 def handle_paginated_query(event, recommendations_resp):
     ''' Get paginated recommendations for a given (user_id, page_id) pair'''
     
@@ -89,7 +266,7 @@ def handle_paginated_query(event, recommendations_resp):
     recs_per_page = 10
     page_start = (query_page_id-1)*recs_per_page
     page_end = (query_page_id-1)*recs_per_page+recs_per_page
-    response_body['recommendation_id'] = response_body['recommendation_id'].split(',')[page_start: page_end]
+    response_body['recommendation_id'] = read_recommendations(response_body, page_start, page_end)
     response_body['message'] = 'Paginated response for the requested page_id.'
     status_code = 200
     return response_body, status_code
@@ -109,14 +286,86 @@ def handle_range_query(event, recommendations_resp):
         recs_per_page = 100
         page_start = (rec_start-1)*recs_per_page
         page_end = (rec_end-1)*recs_per_page+recs_per_page
-        response_body['recommendation_id'] = response_body['recommendation_id'].split(',')[page_start: page_end]
+        response_body['recommendation_id'] = read_recommendations(response_body, page_start, page_end)
     else:
-        response_body['recommendation_id'] = response_body['recommendation_id'].split(',')
+        response_body['recommendation_id'] = read_recommendations(response_body)
         
     response_body['message'] = 'Range query response. Returning the set of recommendations for the requested range.'
     status_code = 200
     return response_body, status_code
     
+def handle_blended_query(event, query):
+    '''Get a page of the user's recommendations fused across all non-expired model_ids'''
+    user_id = query['q_user_id']
+    method = query.get('q_blend', blend_method)
+    if method not in rank_fusion.METHODS:
+        return handle_malformed_query(event, ['blend_method'])
+
+    blended = get_blended_recommendations(user_id, method)
+    if blended is None:
+        return handle_potential_new_user(event)
+
+    # Same page size as PAGINATED_QUERY
+    recs_per_page = 10
+    query_page_id = int(query['q_page_id'])
+    page_start = (query_page_id-1)*recs_per_page
+    page_end = (query_page_id-1)*recs_per_page+recs_per_page
+    response_body = {
+        'user_id': user_id,
+        'model_id': ','.join(str(m) for m in blended['model_ids']),
+        'blend_method': method,
+        'recommendation_id': blended['recommendation_id'][page_start:page_end],
+        'message': 'Blended response for the requested page_id.',
+    }
+    status_code = 200
+    return response_body, status_code
+
+def get_blended_recommendations(user_id, method):
+    '''
+    The user's lists of all non-expired model_ids fused with method, newest model_id first, or None
+    if the user has no recommendations.
+
+    The fused list is cached until the earliest of the blended items expires, so the following pages of
+    the session are served without reading DynamoDB or fusing again.
+    '''
+    cache_key = (user_id, method)
+    blended = blend_cache.get(cache_key)
+    if blended is not None:
+        cache_stats.hit('blends', saved_round_trips=0)
+        return blended
+    cache_stats.miss('blends')
+
+    items = get_user_items(user_id, query_model_id=None)
+    if not items:
+        return None
+    now = time.time()
+    live = [item for item in items if 'expiry_time' not in item or int(item['expiry_time']) > now]
+    # Expired items linger until DynamoDB's TTL deletes them; fall back to the latest one
+    live = live or items[-1:]
+    live = sorted(live, key=lambda item: int(item['model_id']), reverse=True)
+
+    lists = [read_recommendations(dict(item)) for item in live]
+    weights = rank_fusion.recency_weights(len(lists), blend_recency_decay)
+    params = {'k': blend_rrf_k} if method == 'rrf' else {}
+    with timings.stage('fusion'):
+        fused = rank_fusion.fuse(lists, method, weights, **params)
+    blended = {
+        'model_ids': [int(item['model_id']) for item in live],
+        'recommendation_id': fused,
+    }
+    expiry_times = [int(item['expiry_time']) for item in live if 'expiry_time' in item]
+    blend_cache.put(cache_key, blended, min(expiry_times) if expiry_times else None)
+    return blended
+
+def read_recommendations(recommendations_resp, start=None, end=None):
+    '''Read recommendations [start, end) of an item, decoding only that slice when it is stored packed'''
+    with timings.stage('read_slice'):
+        ids = packed_recommendations.read_slice(recommendation_chunks, recommendations_resp, start, end)
+    # Keep the response shape of the comma-joined layout
+    for key in ('rec_count', 'id_width', 'chunk_size'):
+        recommendations_resp.pop(key, None)
+    return ids
+    
 def handle_potential_new_user(event):
     response_body = "Potential new user. Send user's features as a separate query."
     status_code = 202
@@ -133,7 +382,8 @@ def check_if_item_exists(event, recommendations_resp):
     return True
     
 def handle_new_user_query(event):
-    event = json.loads(event)
+    with timings.stage('decode'):
+        event = json.loads(event)
 
     payload = {
                'user_id':event['new_user_id'],
@@ -143,34 +393,67 @@ def handle_new_user_query(event):
                'followingCategories': event['followingCategories']
               }
 
-    # Get recommendaitons for unregistered users from the latest model
-    response = sm_rt_client.invoke_endpoint(EndpointName=sm_endpoint_name, Body=json.dumps(payload), ContentType='application/json')
-    recommendations_new = json.loads(response['Body'].read().decode("utf-8"))
+    # Get recommendations for unregistered users from the cohort table, or else from the latest model
+    table = get_cohort_table()
+    cohort_ids = None
+    if table is not None:
+        with timings.stage('cohort'):
+            cohort_ids = table.lookup(payload, exclude=payload['user_id'], top_n=new_user_top_n)
+    if cohort_ids is not None:
+        cache_stats.hit('cohorts')
+        recommendations_new = {'user_id': payload['user_id'], 'recommendation_id': ','.join(cohort_ids)}
+    else:
+        if table is not None:
+            cache_stats.miss('cohorts')
+        with timings.stage('endpoint'):
+            response = sm_rt_client.invoke_endpoint(EndpointName=sm_endpoint_name, Body=json.dumps(payload), ContentType='application/json')
+            recommendations_new = json.loads(response['Body'].read().decode("utf-8"))
     
     
     # Write the recommendations to DynamoDB
-    del recommendations_new['index']
+    recommendations_new.pop('index', None)
     curr_time_ddb = int(time.time())
-    retrain_freq_in_days = (ssm_client.get_parameter(Name='recommender.retrain_freq', WithDecryption=True))['Parameter']['Value']
+    retrain_freq_in_days = get_retrain_freq_in_days()
     ttl_in_days = int(retrain_freq_in_days) * 2
     ttl_in_seconds = int(ttl_in_days)*24*3600 #14 days
     expiry_time_ddb = curr_time_ddb + ttl_in_seconds
     recommendations_new['model_id'] = curr_time_ddb
     recommendations_new['expiry_time'] = expiry_time_ddb
 
-    ddb_put_response = recommendations.put_item(
-        Item={
-            'user_id': recommendations_new['user_id'],
-            'model_id': recommendations_new['model_id'],
-            'recommendation_id': recommendations_new['recommendation_id'],
-            'expiry_time': recommendations_new['expiry_time']
-        }
-    )
-    # print("PutItem succeeded: ", ddb_put_response)
+    new_item = {
+        'user_id': recommendations_new['user_id'],
+        'model_id': recommendations_new['model_id'],
+        'recommendation_id': recommendations_new['recommendation_id'],
+        'expiry_time': recommendations_new['expiry_time']
+    }
+    if write_behind_mode == 'off':
+        if storage_format == 'packed':
+            ddb_put_response = packed_recommendations.write_packed(
+                recommendations, recommendation_chunks, new_item['user_id'], new_item['model_id'],
+                new_item['recommendation_id'], new_item['expiry_time'])
+        else:
+            ddb_put_response = recommendations.put_item(Item=new_item)
+        # print("PutItem succeeded: ", ddb_put_response)
+    elif storage_format == 'packed':
+        # Chunks are queued before their header so the header never points at missing chunks
+        header, chunks = packed_recommendations.packed_items(
+            new_item['user_id'], new_item['model_id'], new_item['recommendation_id'], new_item['expiry_time'])
+        for chunk in chunks:
+            write_queue.put(recommendation_chunks, chunk, key_names=('user_id', 'chunk_key'))
+        write_queue.put(recommendations, header)
+    else:
+        write_queue.put(recommendations, new_item)
+
+    # Serve this user's next GETs from the warm cache, also while the write may still be queued
+    user_cache.invalidate(('all', new_item['user_id']))
+    for method in rank_fusion.METHODS:
+        blend_cache.invalidate((new_item['user_id'], method))
+    user_cache.put(('latest', new_item['user_id']), [new_item], new_item['expiry_time'])
 
     # Return response    
     event['q_model_id'] = '-1'
-    if event['q_type'] == 'PAGINATED_QUERY':
+    # A new user has a single list, so a blended query is a paginated one
+    if event['q_type'] in ('PAGINATED_QUERY', 'BLENDED_QUERY'):
         if 'q_page_id' in event.keys():
             response_body, status_code = handle_paginated_query(event, recommendations_new)
         else:
@@ -0,0 +1,81 @@
+import math
+from collections import OrderedDict
+
+# Merging several ranked recommendation lists of a user into one, without duplicates.
+#
+# reciprocal_rank_fusion: every list votes weight / (k + rank) for each of its ids and the ids are sorted
+#   by their summed votes. Ids ranked high in several lists rise to the top; k damps the head of each list.
+# weighted_interleave: the lists take turns, each contributing ids in proportion to its weight, skipping
+#   ids already taken. Keeps each list's own order. Lists of weight 0 are left out.
+#
+# Both are deterministic: ties keep the order in which ids were first seen, lists in the given order.
+
+DEFAULT_RRF_K = 60
+
+
+def reciprocal_rank_fusion(lists, weights=None, k=DEFAULT_RRF_K):
+    weights = weights or [1.0] * len(lists)
+    scores = OrderedDict()
+    for ids, weight in zip(lists, weights):
+        for rank, rec_id in enumerate(ids, 1):
+            scores[rec_id] = scores.get(rec_id, 0.0) + weight / (k + rank)
+    order = sorted(enumerate(scores.items()), key=lambda s: (-s[1][1], s[0]))
+    return [rec_id for _, (rec_id, _) in order]
+
+
+def weighted_interleave(lists, weights=None):
+    weights = check_weights(weights or [1.0] * len(lists))
+    # Lists without weight contribute nothing, as in reciprocal_rank_fusion, unless no list has any
+    active = [i for i, w in enumerate(weights) if w > 0] or list(range(len(lists)))
+    top = max(weights) if max(weights or [0]) > 0 else 1.0
+    # Scaled so the heaviest list takes one id per turn; a list of weight w takes its n-th id on turn
+    # ceil(n / w). The next id comes from the list with the earliest turn, the first listed on a tie, so
+    # the work does not depend on how small a weight is.
+    scale = dict((i, weights[i] / top if weights[i] > 0 else 1.0) for i in active)
+    positions = [0] * len(lists)
+    taken = [0] * len(lists)
+    seen = set()
+    fused = []
+    while True:
+        candidates = [i for i in active if positions[i] < len(lists[i])]
+        if not candidates:
+            return fused
+        i = min(candidates, key=lambda j: (_turn(taken[j] + 1, scale[j]), j))
+        rec_id = lists[i][positions[i]]
+        positions[i] += 1
+        # An id another list already took is skipped without using up the list's turn
+        if rec_id not in seen:
+            seen.add(rec_id)
+            fused.append(rec_id)
+            taken[i] += 1
+
+
+def _turn(n, scale):
+    turn = n / scale
+    # Whole turns, tolerating rounding; too large to matter (or infinite) for tiny weights
+    return math.ceil(turn - 1e-9) if turn < 2 ** 53 else turn
+
+
+def check_weights(weights):
+    if any(w < 0 for w in weights):
+        raise ValueError('Blend weights must not be negative: {}'.format(weights))
+    return weights
+
+
+METHODS = {
+    'rrf': reciprocal_rank_fusion,
+    'interleave': weighted_interleave,
+}
+
+
+def fuse(lists, method='rrf', weights=None, **params):
+    if method not in METHODS:
+        raise ValueError('Unknown blend method {}; expected one of {}'.format(method, sorted(METHODS)))
+    return METHODS[method](lists, weights, **params)
+
+
+def recency_weights(n, decay=1.0):
+    """Weights of n lists ordered newest first: 1, decay, decay**2, ...; decay must be positive."""
+    if not decay > 0:
+        raise ValueError('The recency decay must be positive, got {}'.format(decay))
+    return [decay ** i for i in range(n)]
@@ -0,0 +1,78 @@
+# Per-stage timings of a query Lambda invocation, logged as one structured line per invocation.
+#
+# The handler times its stages (the body decode, DynamoDB reads and writes, the SSM lookup, the endpoint
+# call, fusion, serialization) with StageTimings.stage and calls log() once at the end. The line is in
+# the CloudWatch embedded metric format: Logs Insights can query its fields, and CloudWatch also
+# extracts each stage as a metric of the Recommender/QueryLambda namespace by query type, without any
+# PutMetricData call on the request path.
+#
+#   REQUEST_TIMING_LOG   emf (default), json (the same fields without the metric directive) or off
+
+from __future__ import print_function
+
+import os
+import json
+import time
+from contextlib import contextmanager
+
+NAMESPACE = 'Recommender/QueryLambda'
+log_format = os.environ.get('REQUEST_TIMING_LOG', 'emf').lower()
+
+
+class StageTimings(object):
+    """Milliseconds spent in each stage of the current invocation; a stage entered twice adds up."""
+
+    def __init__(self):
+        self.cold_start = True
+        self.reset()
+
+    def reset(self):
+        self.start = time.time()
+        self.stages = {}
+        self.calls = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, (time.time() - start) * 1000.0)
+
+    def add(self, name, ms):
+        self.stages[name] = self.stages.get(name, 0.0) + ms
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def record(self, query_type, status_code, **fields):
+        """The structured record of the invocation."""
+        total_ms = (time.time() - self.start) * 1000.0
+        record = dict(fields)
+        record.update({
+            'event': 'request_timing',
+            'QueryType': query_type or 'UNKNOWN',
+            'status_code': status_code,
+            'cold_start': self.cold_start,
+            'total_ms': round(total_ms, 3),
+        })
+        for name, ms in self.stages.items():
+            record[name + '_ms'] = round(ms, 3)
+        if self.calls:
+            record['calls'] = dict(self.calls)
+        if log_format == 'emf':
+            metric_names = ['total_ms'] + sorted(name + '_ms' for name in self.stages)
+            record['_aws'] = {
+                'Timestamp': int(self.start * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': NAMESPACE,
+                    'Dimensions': [['QueryType']],
+                    'Metrics': [{'Name': name, 'Unit': 'Milliseconds'} for name in metric_names],
+                }],
+            }
+        return record
+
+    def log(self, query_type, status_code, **fields):
+        """Print the record (the EMF needs the bare JSON line, without the logger's prefix) and reset."""
+        if log_format != 'off':
+            print(json.dumps(self.record(query_type, status_code, **fields)))
+        self.cold_start = False
+        self.reset()
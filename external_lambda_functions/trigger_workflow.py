@@ -3,11 +3,39 @@ import urllib.parse
 import boto3
 import uuid
 import re
+import os
+import datetime
 
 s3_client = boto3.client('s3')
 stepFunctions_client = boto3.client('stepfunctions')
 project_name = 'reciprocal_rec_system'
 
+# Incremental retraining: with TRAINING_MODE=incremental, a full retrain only runs every
+# FULL_RETRAIN_EVERY_DAYS days. The runs in between preprocess only the rows that are new since the
+# previous snapshot, warm-start from the last model for INCREMENTAL_EPOCH_COUNT epochs and re-score only
+# the users whose recommendations may have changed (see container/training_code/incremental_training.py).
+# The last successful runs are recorded in state_key. This Lambda only computes the record and passes it
+# in the WorkflowState input; the workflow's 'Record Workflow Run' step writes it once the run has
+# succeeded, so a failed or aborted run never counts. The snapshot a run replaces is kept under
+# previous_input_key, and the date of the snapshot under input_key in its snapshot_date metadata.
+# Every run is a full retrain unless TRAINING_MODE is exactly 'incremental'. That needs the training job
+# to run with training_script=cpu_skipgram.py, the trainer that keeps every user of the previous model in
+# the incremental one (the train entrypoint fails an incremental run of any other script).
+training_mode = 'incremental' if os.environ.get('TRAINING_MODE', 'full').strip().lower() == 'incremental' else 'full'
+full_retrain_every_days = int(os.environ.get('FULL_RETRAIN_EVERY_DAYS', 7))
+incremental_epoch_count = int(os.environ.get('INCREMENTAL_EPOCH_COUNT', 3))
+# callback: the workflow waits for the processing jobs' state change events (processing_job_callback.py)
+# poll:     it polls query_processing_status with adaptive backoff
+completion_mode = os.environ.get('COMPLETION_MODE', 'callback')
+# endpoint: deploy the new model with an endpoint update
+# hot_swap: point the running endpoint's model version marker at it (container/serving_code/model_versions.py);
+#           needs CREATE_NEW_ENDPOINT=false
+model_update_mode = os.environ.get('MODEL_UPDATE_MODE', 'endpoint')
+create_new_endpoint = os.environ.get('CREATE_NEW_ENDPOINT', 'true').lower() == 'true'
+input_key = project_name + '/data/input/input.parquet.gzip'
+previous_input_key = project_name + '/data/previous_input/input.parquet.gzip'
+state_key = project_name + '/data/state/workflow_state.json'
+
 def lambda_handler(event, context):
 
     bucket = event['Records'][0]['s3']['bucket']['name']
@@ -16,8 +44,11 @@ def lambda_handler(event, context):
     wf_status = None
 
     if re.match("input_20\d{2}\d{2}\d{2}",input_filename):
-        copy_status = copy_files(bucket, key)
-        wf_status = execute_workflow(bucket)
+        snapshot_date = input_filename[len('input_'):len('input_')+8]
+        state = read_state(bucket)
+        mode = choose_training_mode(bucket, state, snapshot_date)
+        copy_status = copy_files(bucket, key, snapshot_date)
+        wf_status = execute_workflow(bucket, mode, state, snapshot_date)
         
     else:
         # print("Input filename did not match pattern")
@@ -25,23 +56,102 @@ def lambda_handler(event, context):
     
     return wf_status
 
-def copy_files(bucket, input_source_key):
+def copy_files(bucket, input_source_key, snapshot_date):
     
     copy_input_source = {
       'Bucket': bucket,
       'Key': input_source_key
     }
     
-    input_dest_key = project_name + '/data/input/input.parquet.gzip'
+    input_dest_key = input_key
+
+    # Keep the snapshot being replaced, it is what the next incremental run is diffed against
+    if object_exists(bucket, input_dest_key):
+        s3_client.copy({'Bucket': bucket, 'Key': input_dest_key}, bucket, previous_input_key)
     
-    s3_client.copy(copy_input_source, bucket, input_dest_key)
+    s3_client.copy(copy_input_source, bucket, input_dest_key,
+                   ExtraArgs={'Metadata': {'snapshot_date': snapshot_date}, 'MetadataDirective': 'REPLACE'})
 
     return 'Data copied successfully'
 
 
-def execute_workflow(bucket):
+def object_metadata(bucket, key):
+    '''The user metadata of an object, or None if it does not exist'''
+    try:
+        return s3_client.head_object(Bucket=bucket, Key=key).get('Metadata', {})
+    except Exception:
+        return None
+
+
+def object_exists(bucket, key):
+    return object_metadata(bucket, key) is not None
+
+
+def read_state(bucket):
+    '''The record of the last runs, or an empty one before the first run'''
+    try:
+        body = s3_client.get_object(Bucket=bucket, Key=state_key)['Body'].read()
+    except Exception:
+        return {}
+    return json.loads(body)
+
+
+def next_state(state, mode, snapshot_date, model_path):
+    '''The record of the runs once this one has succeeded'''
+    state = dict(state, last_run_date=snapshot_date, last_mode=mode, last_model_path=model_path)
+    if mode == 'full':
+        state['last_full_run_date'] = snapshot_date
+    return state
+
+
+def model_artifact_key(s3_model_path):
+    '''S3 key of the model.tar.gz a training job writes under S3ModelPath'''
+    return s3_model_path.split('/', 3)[3].rstrip('/') + '/model.tar.gz'
+
+
+def choose_training_mode(bucket, state, snapshot_date):
+    '''
+    'full' or 'incremental' for the snapshot of snapshot_date (YYYYMMDD).
+
+    Full unless TRAINING_MODE=incremental. Incremental runs also need a previous full run within the
+    cadence, the last model artifact and, as the snapshot to diff against, the one the last successful
+    run trained on; without any of them, e.g. after a failed run, the retrain is full.
+    '''
+    if training_mode != 'incremental' or 'last_full_run_date' not in state or 'last_model_path' not in state:
+        return 'full'
+    days_since_full = (datetime.datetime.strptime(snapshot_date, '%Y%m%d') -
+                       datetime.datetime.strptime(state['last_full_run_date'], '%Y%m%d')).days
+    if days_since_full >= full_retrain_every_days:
+        return 'full'
+    # The snapshot this one replaces becomes the diff base; its rows must all have been trained on
+    previous_snapshot = object_metadata(bucket, input_key)
+    if previous_snapshot is None or previous_snapshot.get('snapshot_date') != state.get('last_run_date'):
+        return 'full'
+    if not object_exists(bucket, model_artifact_key(state['last_model_path'])):
+        return 'full'
+    return 'incremental'
+
+
+def prepare_warm_start(bucket, mode, state, warm_start_prefix):
+    '''
+    Write the warm_start training channel: run.json describing the run and, for incremental runs, the
+    last model artifact. The channel is never empty, so full runs use the same workflow definition.
+    '''
+    run = {'mode': mode}
+    if mode == 'incremental':
+        run['epoch_count'] = incremental_epoch_count
+        run['previous_model_path'] = state['last_model_path']
+        s3_client.copy({'Bucket': bucket, 'Key': model_artifact_key(state['last_model_path'])},
+                       bucket, warm_start_prefix + 'model.tar.gz')
+    s3_client.put_object(Bucket=bucket, Key=warm_start_prefix + 'run.json', Body=json.dumps(run).encode('utf-8'))
+
+
+def execute_workflow(bucket, mode='full', state=None, snapshot_date=None):
     
     id = uuid.uuid4().hex
+    state = state or {}
+    warm_start_prefix = '{}/data/warm_start/{}/'.format(project_name, id)
+    prepare_warm_start(bucket, mode, state, warm_start_prefix)
 
     
     state_machine_arn = 'arn:aws:states:ap-northeast-1:987654321:stateMachine:End2End-Routine-865a33537be64feb96147899936e61c5'
@@ -49,6 +159,7 @@ def execute_workflow(bucket):
     
     
     processing_function_name = 'query-processing-status'
+    processing_callback_function_name = 'processing-job-callback'
     create_preprocessing_function_name = 'create-preprocessing-job'
     create_batch_pred_function_name = 'create-batch-pred-job'
     glue_job_name = 'glue-batch-load-recs'
@@ -57,6 +168,9 @@ def execute_workflow(bucket):
     
     inputs={
             'ProcessingLambdaFunctionName': processing_function_name,
+            'CallbackLambdaFunctionName': processing_callback_function_name,
+            'CompletionMode': completion_mode,
+            'ModelUpdateMode': model_update_mode,
             'CreatePreprocessingLambdaFunctionName': create_preprocessing_function_name,
             'CreateBatchPredLambdaFunctionName': create_batch_pred_function_name,        
             'PreprocessingJobName': 'user-transform-etl-{}'.format(id),
@@ -68,11 +182,18 @@ def execute_workflow(bucket):
             'S3ModelPath': 's3://{}/{}/data/model/train-{}/output'.format(bucket, project_name, id),
             'S3PreprocessedPath': 's3://{}/{}/data/train/preprocessed-{}'.format(bucket, project_name, id),
             'S3RecommendationsPath': 's3://{}/{}/data/output/recommendations-{}'.format(bucket, project_name, id),
+            'S3CohortTablePath': 's3://{}/{}/data/output/cohorts-{}'.format(bucket, project_name, id),
+            'TrainingMode': mode,
+            'S3PreviousInputPath': 's3://{}/{}'.format(bucket, previous_input_key),
+            'S3PreviousModelPath': state.get('last_model_path', ''),
+            'S3WarmStartPath': 's3://{}/{}'.format(bucket, warm_start_prefix),
             'DoPreprocessing':True,
             'DoTraining':True,
             'DoBatchRecommend':True,
-            'CreateNewEndpoint':True
+            'CreateNewEndpoint':create_new_endpoint
         }
+    # Written to state_key by the workflow's last step, only if the run succeeds
+    inputs['WorkflowState'] = json.dumps(next_state(state, mode, snapshot_date, inputs['S3ModelPath']))
     
     stepFunctions_client.start_execution(
         stateMachineArn=state_machine_arn,
@@ -80,5 +201,5 @@ def execute_workflow(bucket):
         input=json.dumps(inputs)
     )
     
-    return 'Workflow execution started' 
+    return 'Workflow execution started ({} retrain)'.format(mode)
 
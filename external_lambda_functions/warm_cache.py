@@ -0,0 +1,96 @@
+import time
+import threading
+from collections import OrderedDict
+
+# Caches that live at module level and so survive between invocations of a warm Lambda container.
+# Nothing here is shared between containers; every entry is bounded by a maximum age.
+
+
+class TTLCache(object):
+    """Small LRU cache where every entry carries its own expiry time (epoch seconds)."""
+
+    def __init__(self, maxsize, max_age_seconds):
+        self.maxsize = maxsize
+        self.max_age_seconds = max_age_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, expires_at=None):
+        """Cache value until expires_at, but never for longer than max_age_seconds."""
+        latest = time.time() + self.max_age_seconds
+        expires_at = latest if expires_at is None else min(float(expires_at), latest)
+        if self.maxsize <= 0 or expires_at <= time.time():
+            return
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CacheStats(object):
+    """Hit/miss counters for the lifetime of the container, plus the DynamoDB/SSM round trips saved."""
+
+    def __init__(self, *names):
+        self.counters = OrderedDict()
+        for name in names:
+            self.counters[name] = {'hits': 0, 'misses': 0}
+        self.saved_round_trips = 0
+
+    def hit(self, name, saved_round_trips=1):
+        self.counters[name]['hits'] += 1
+        self.saved_round_trips += saved_round_trips
+
+    def miss(self, name):
+        self.counters[name]['misses'] += 1
+
+    def summary(self):
+        summary = OrderedDict()
+        for name, counter in self.counters.items():
+            total = counter['hits'] + counter['misses']
+            summary[name] = dict(counter, hit_rate=round(counter['hits'] / float(total), 4) if total else None)
+        summary['saved_round_trips'] = self.saved_round_trips
+        return summary
+
+
+class LazyClient(object):
+    """
+    A boto3 client (or resource, or table) made by factory on first use and kept for the life of the
+    container, so a cold start only pays for the clients its request needs. Attributes are those of
+    the client.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
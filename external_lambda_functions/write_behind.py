@@ -0,0 +1,122 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger()
+
+# Write-behind queue for DynamoDB puts that do not need to finish before the response is built.
+#
+# Puts are queued per table and key, so a second put of the same key before the queue is drained
+# replaces the first. A background thread drains the queue in batch_writer batches. Every put overwrites
+# the whole item under its key, so a batch that fails is simply retried; retrying is idempotent.
+#
+# A Lambda container is frozen as soon as the handler returns, and the thread with it. A write queued
+# late in an invocation is therefore finished during the container's next invocation, alongside that
+# invocation's own work: the handler takes mark() when it starts and, before returning, waits (bounded)
+# with flush(through=mark) for the writes queued before it started, not for its own.
+
+
+class WriteBehindQueue(object):
+
+    def __init__(self, max_retries=5, base_backoff_seconds=0.05):
+        self.max_retries = max_retries
+        self.base_backoff_seconds = base_backoff_seconds
+        self._pending = OrderedDict()       # (table name, key) -> (table, key names, item)
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self.written = self.coalesced = self.retries = self.failed = 0
+        self.reported_failed = 0            # failed writes already logged by the handler
+        self._queued_seq = 0                # sequence number of the last put
+        self._done_seq = 0                  # every put up to this one has been written or has failed
+
+    def put(self, table, item, key_names=('user_id', 'model_id')):
+        """Queue a put of item into table; returns immediately."""
+        key = (table.name, tuple(item[k] for k in key_names))
+        with self._cond:
+            if key in self._pending:
+                self.coalesced += 1
+                del self._pending[key]
+            self._pending[key] = (table, list(key_names), item)
+            self._queued_seq += 1
+            self._ensure_thread()
+            self._cond.notify_all()
+
+    def mark(self):
+        """The position of the last queued put, for flush(through=...)."""
+        with self._cond:
+            return self._queued_seq
+
+    def flush(self, timeout=None, through=None):
+        """
+        Wait until every queued put, or every put up to the mark through, is written (or has failed).
+        Returns False if timeout expired first.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while (self._done_seq < through) if through is not None else (self._pending or self._in_flight):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def pending(self):
+        with self._cond:
+            return len(self._pending) + self._in_flight
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='ddb-write-behind')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                batch = list(self._pending.values())
+                batch_seq = self._queued_seq
+                self._pending.clear()
+                self._in_flight = len(batch)
+            try:
+                self._write(batch)
+            finally:
+                with self._cond:
+                    self._in_flight = 0
+                    self._done_seq = batch_seq
+                    self._cond.notify_all()
+
+    def _write(self, batch):
+        # One batch_writer per table, in the order the tables were first queued
+        by_table = OrderedDict()
+        for table, key_names, item in batch:
+            by_table.setdefault(table.name, (table, key_names, []))[2].append(item)
+
+        for table, key_names, items in by_table.values():
+            for attempt in range(self.max_retries + 1):
+                try:
+                    with table.batch_writer(overwrite_by_pkeys=key_names) as writer:
+                        for item in items:
+                            writer.put_item(Item=item)
+                    self.written += len(items)
+                    break
+                except Exception as e:
+                    if attempt == self.max_retries:
+                        self.failed += len(items)
+                        logger.error('Write-behind to {} failed after {} retries: {}'.format(
+                            table.name, self.max_retries, e))
+                        break
+                    self.retries += 1
+                    time.sleep(self.base_backoff_seconds * (2 ** attempt))
+
+    def stats(self):
+        return {
+            'written': self.written,
+            'coalesced': self.coalesced,
+            'retries': self.retries,
+            'failed': self.failed,
+            'pending': self.pending(),
+        }
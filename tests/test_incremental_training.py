@@ -0,0 +1,69 @@
+"""
+Incremental retraining keeps the previous model's users.
+
+Runs streaming_preprocessing and cpu_skipgram as the workflow does: a full run over a snapshot, then an
+incremental run over the next snapshot, diffed against the first and warm-started from the full model.
+
+Usage:
+    python -m pytest tests
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+here = os.path.dirname(os.path.abspath(__file__))
+for code in ('training_code', 'serving_code'):
+    sys.path.insert(0, os.path.join(here, '..', 'container', code))
+
+import cpu_skipgram  # noqa: E402
+import model_store  # noqa: E402
+import streaming_preprocessing  # noqa: E402
+
+USERS = 500
+VECTOR_SIZE = 8
+
+
+def snapshot(rng, rows):
+    return pd.DataFrame({'user_id': rng.randint(0, USERS, rows).astype(str),
+                         'target_id': rng.randint(0, USERS, rows).astype(str)})
+
+
+def train(tmp_path, name, input_path, previous_path=None, warm_start_dir=None):
+    pairs_dir = str(tmp_path / (name + '_pairs'))
+    model_dir = str(tmp_path / (name + '_model'))
+    streaming_preprocessing.preprocess(input_path, pairs_dir, partitions=4, previous_path=previous_path)
+    cpu_skipgram.train(pairs_dir, model_dir, vector_size=VECTOR_SIZE, epoch_count=1, batch_value=256,
+                       warm_start_dir=warm_start_dir, n_trees=2)
+    return model_store.load_model(model_dir), model_dir
+
+
+def test_incremental_model_keeps_every_previous_user(tmp_path):
+    rng = np.random.RandomState(0)
+    first = snapshot(rng, 20000)
+    # The next snapshot adds a few rows that touch only part of the users
+    second = pd.concat([first, snapshot(rng, 40)], ignore_index=True)
+    first_path, second_path = str(tmp_path / 'first.parquet'), str(tmp_path / 'second.parquet')
+    first.to_parquet(first_path, index=False)
+    second.to_parquet(second_path, index=False)
+
+    full, full_dir = train(tmp_path, 'full', first_path)
+    incremental, _ = train(tmp_path, 'incremental', second_path, previous_path=first_path,
+                           warm_start_dir=full_dir)
+
+    full_ids = np.asarray(full['user_ids']).astype(str)
+    incremental_ids = np.asarray(incremental['user_ids']).astype(str)
+    delta_vocab = pd.read_parquet(str(tmp_path / 'incremental_pairs' / streaming_preprocessing.VOCAB_FILE))
+    assert len(delta_vocab) < len(full_ids)
+    assert set(full_ids) <= set(incremental_ids)
+
+    # Users the delta does not touch keep both their vectors
+    untouched = np.setdiff1d(full_ids, delta_vocab['id'].astype(str).values)
+    before = pd.Index(full_ids).get_indexer(untouched)
+    after = pd.Index(incremental_ids).get_indexer(untouched)
+    np.testing.assert_array_equal(np.asarray(incremental['preference_vectors'])[after],
+                                  np.asarray(full['preference_vectors'])[before])
+    np.testing.assert_array_equal(np.asarray(incremental['item_vectors'])[after],
+                                  np.asarray(full['item_vectors'])[before])